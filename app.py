@@ -6,6 +6,16 @@ from fastapi.responses import HTMLResponse
 from fastapi import Request
 from src.api.router import router
 from src.pool import session_pool
+from src.service.image_process import shutdown_executor
+from src.service.attachment_ingest import close_client
+from src.service.browser_pool import browser_pool
+from src.service import video_resolver
+from src.service.video_scheduler import video_scheduler
+from src.service.video_storage import VideoStorage
+from src.service.webhooks import webhook_dispatcher
+from src.service.change_feed import change_feed
+from src.service.url_refresher import url_refresher
+from src.service.video_cache import video_cache
 import uvicorn
 
 
@@ -36,6 +46,36 @@ async def index(request: Request):
 async def startup():
     await session_pool.fetch_guest_session(0)
     print("成功获取游客Session")
+    try:
+        await browser_pool.start()
+        print("浏览器池已启动")
+    except Exception as e:
+        # 启动失败不影响其他接口，首次获取视频时会再次尝试启动
+        print(f"浏览器池启动失败: {str(e)}")
+    # 在后台恢复重启前未完成的视频任务
+    video_scheduler.start_recovery()
+    # 继续投递重启前未完成的回调
+    webhook_dispatcher.start()
+    # 定期压缩和清理任务变更流
+    change_feed.start()
+    # 后台刷新即将过期的视频链接
+    url_refresher.start()
+    # 开启本地缓存时预先下载已完成的视频
+    video_cache.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await video_cache.stop()
+    await url_refresher.stop()
+    await video_scheduler.stop()
+    await webhook_dispatcher.stop()
+    await change_feed.stop()
+    shutdown_executor()
+    await close_client()
+    await video_resolver.close_client()
+    await browser_pool.stop()
+    VideoStorage.close()
 
 app.include_router(router, prefix="/api")
 
@@ -0,0 +1,133 @@
+"""
+基准测试 - VideoTask / DoubaoSession 的内存占用和属性访问耗时
+对比旧表示（普通对象 + ISO 时间字符串 + 列表，pydantic 模型）与当前表示（__slots__ + 时间戳 + 元组，slots 数据类）
+
+用法: python bench_compact_models.py [任务数] [session 数]
+"""
+import gc
+import json
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+
+from pydantic import BaseModel
+
+from src.pool.session_pool import DoubaoSession
+from src.service.video_storage import VideoTask
+
+TASKS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+SESSIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+URL = "https://v26-show.douyinvod.com/69195902f20452e9ce165db9b47eb430/68fef44a/video/tos/cn/tos-cn-v-9ecd54/o0xBncPiU5BBIswn/?a=6383&br=1234&bt=1234&lr=video_gen_watermark"
+
+
+class LegacyVideoTask:
+  """旧的 VideoTask 表示"""
+  def __init__(self, conversation_id: str, message_id: str):
+    self.conversation_id = conversation_id
+    self.message_id = message_id
+    self.content_type = 2020
+    self.prompt_kind = "text"
+    self.status = "pending"
+    self.video_urls: list[str] = []
+    self.retry_count = 0
+    self.max_retries = 10
+    self.created_at = datetime.now().isoformat()
+    self.updated_at = datetime.now().isoformat()
+    self.error = None
+    self.last_miss_at = None
+    self.job: dict = {}
+
+  @classmethod
+  def from_dict(cls, data: dict):
+    task = cls(data["conversation_id"], data["message_id"])
+    task.content_type = data["content_type"]
+    task.prompt_kind = data["prompt_kind"]
+    task.status = data["status"]
+    task.video_urls = data["video_urls"]
+    task.retry_count = data["retry_count"]
+    task.max_retries = data["max_retries"]
+    task.created_at = data["created_at"]
+    task.updated_at = data["updated_at"]
+    task.error = data["error"]
+    task.last_miss_at = data["last_miss_at"]
+    task.job = data["job"]
+    return task
+
+
+class LegacyDoubaoSession(BaseModel):
+  """旧的 DoubaoSession 表示"""
+  cookie: str
+  device_id: str
+  tea_uuid: str
+  web_id: str
+  room_id: str
+  x_flow_trace: str
+
+
+def task_records(n: int) -> list[str]:
+  """模拟从存储加载：每个任务是一条独立解析的 JSON 记录"""
+  records = []
+  for i in range(n):
+    task = VideoTask(str(10 ** 16 + i // 4), str(2 * 10 ** 16 + i))
+    task.status = "completed" if i % 50 else "pending"
+    task.video_urls = (URL,) if task.status == "completed" else ()
+    task.retry_count = 2
+    task.last_miss_at = task.created_at + 120
+    records.append(json.dumps(task.to_dict(), ensure_ascii=False))
+  return records
+
+
+def session_data(i: int) -> dict:
+  return {
+    "cookie": f"sessionid={i:032x}; ttwid={i:064x}; s_v_web_id=verify_{i:024x}",
+    "device_id": str(7 * 10 ** 18 + i),
+    "tea_uuid": str(7 * 10 ** 18 + i),
+    "web_id": str(7 * 10 ** 18 + i),
+    "room_id": str(10 ** 16 + i),
+    "x_flow_trace": f"04-{i:032x}-{i:016x}-01",
+  }
+
+
+def measure_memory(build) -> tuple[float, list]:
+  """返回 (占用 MB, 对象列表)，只统计构建对象时新分配的内存（不含原始 JSON 文本）"""
+  gc.collect()
+  tracemalloc.start()
+  objects = build()
+  current, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return current / 1024 / 1024, objects
+
+
+def access_tasks(tasks: list):
+  for task in tasks:
+    task.status, task.retry_count, task.updated_at, task.video_urls
+
+
+def access_sessions(sessions: list):
+  for session in sessions:
+    session.cookie, session.device_id, session.tea_uuid, session.web_id, session.room_id, session.x_flow_trace
+
+
+def main():
+  records = task_records(TASKS)
+  print(f"VideoTask x {TASKS}")
+  results = {}
+  for name, cls in (("旧表示", LegacyVideoTask), ("当前表示", VideoTask)):
+    memory, tasks = measure_memory(lambda: [cls.from_dict(json.loads(r)) for r in records])
+    access = min(timeit.repeat(lambda: access_tasks(tasks), number=1, repeat=5))
+    results[name] = memory
+    print(f"  {name:<6} 内存 {memory:8.1f}MB  每任务 {memory * 1024 * 1024 / TASKS:6.0f}B  遍历读取属性 {access * 1000:7.1f}ms")
+    del tasks
+  print(f"  内存减少 {(1 - results['当前表示'] / results['旧表示']) * 100:.0f}%")
+
+  print(f"DoubaoSession x {SESSIONS}")
+  for name, cls in (("旧表示", LegacyDoubaoSession), ("当前表示", DoubaoSession)):
+    memory, sessions = measure_memory(lambda: [cls(**session_data(i)) for i in range(SESSIONS)])
+    access = min(timeit.repeat(lambda: access_sessions(sessions), number=20, repeat=5)) / 20
+    print(f"  {name:<6} 内存 {memory:8.2f}MB  每 session {memory * 1024 * 1024 / SESSIONS:6.0f}B  遍历读取属性 {access * 1000:7.3f}ms")
+    del sessions
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,78 @@
+"""
+基准测试 - 自适应探测策略模拟
+用合成的视频完成耗时分布（文生视频/图生视频两组）对比固定间隔探测与自适应探测：
+- 视频完成到被探测到的等待时间（time-to-URL）
+- 每个任务消耗的探测次数（浏览器/HTTP 探测）
+
+用法: python bench_probe_policy.py [训练样本数] [测试样本数]
+"""
+import random
+import statistics
+import sys
+from types import SimpleNamespace
+
+from src.service.probe_policy import ProbePolicy
+
+TRAIN = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+TEST = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+MAX_RETRIES = 10
+FIXED_FIRST, FIXED_INTERVAL = 180, 180
+
+# 各分组完成耗时的对数正态分布参数（中位数秒数, sigma）
+GROUPS = {"text": (200, 0.25), "image": (420, 0.35)}
+
+
+def sample(kind: str, rng: random.Random) -> float:
+  median, sigma = GROUPS[kind]
+  return rng.lognormvariate(0, sigma) * median
+
+
+def fake_task(kind: str, duration: float | None = None):
+  return SimpleNamespace(
+    content_type=2020, prompt_kind=kind, status="completed" if duration else "pending",
+    created_at=0.0, updated_at=duration, completed_at=duration, last_miss_at=None, retry_count=0, max_retries=MAX_RETRIES
+  )
+
+
+def simulate(offsets_for, rng: random.Random) -> dict:
+  waits, probes, missed = [], [], 0
+  for _ in range(TEST):
+    kind = rng.choice(list(GROUPS))
+    completion = sample(kind, rng)
+    offsets = offsets_for(kind)
+    hit = next((i for i, offset in enumerate(offsets) if offset >= completion), None)
+    if hit is None:
+      missed += 1
+      probes.append(len(offsets))
+      continue
+    waits.append(offsets[hit] - completion)
+    probes.append(hit + 1)
+  waits.sort()
+  return {
+    "wait_mean": statistics.mean(waits),
+    "wait_p90": waits[int(len(waits) * 0.9)],
+    "probes_mean": statistics.mean(probes),
+    "miss_rate": missed / TEST,
+  }
+
+
+def main():
+  rng = random.Random(42)
+  train = [fake_task(kind, sample(kind, rng)) for kind in GROUPS for _ in range(TRAIN // len(GROUPS))]
+  policy = ProbePolicy(FIXED_FIRST, FIXED_INTERVAL, enabled=True).fit(train)
+  policy._maybe_refresh = lambda: None  # 模拟中不从存储刷新
+
+  fixed = [FIXED_FIRST + FIXED_INTERVAL * i for i in range(MAX_RETRIES)]
+  results = {
+    "固定间隔": simulate(lambda kind: fixed, random.Random(7)),
+    "自适应": simulate(lambda kind: policy.schedule(fake_task(kind)), random.Random(7)),
+  }
+  for kind in GROUPS:
+    print(f"自适应探测时间点[{kind}]: {[round(o) for o in policy.schedule(fake_task(kind))]}")
+  print(f"\n{'策略':<8} {'平均等待(s)':>12} {'p90等待(s)':>12} {'平均探测次数':>12} {'未命中率':>8}")
+  for name, r in results.items():
+    print(f"{name:<8} {r['wait_mean']:>12.1f} {r['wait_p90']:>12.1f} {r['probes_mean']:>12.2f} {r['miss_rate']:>8.2%}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,108 @@
+"""
+基准测试 - 并发上传大文件时的事件循环延迟
+调用实际的 upload_file，网络阶段（prepare/apply/upload/commit）替换为 asyncio.sleep 模拟，对比：
+- 事件循环内：asyncio.to_thread 替换为直接调用，CRC32/MD5 在事件循环内计算（改动前的行为）
+- 线程计算：upload_file 当前实现，CRC32 在线程中与网络阶段并行计算
+commit-upload 是否返回 ImageMd5 可选，返回时不计算 MD5
+
+用法: python bench_upload_hashing.py [并发数] [文件大小MB] [返回ImageMd5: 0/1]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+import src.service.doubao_service as doubao_service
+from src.service.doubao_service import upload_file
+
+CONCURRENCY = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+FILE_MB = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+RETURN_MD5 = (sys.argv[3] if len(sys.argv) > 3 else "0") == "1"
+NETWORK_DELAY = 0.2  # 每个网络阶段的模拟耗时（秒）
+TICK = 0.01
+
+
+class _FakeSession:
+    cookie = "sessionid=bench"
+
+
+async def _fake_prepare(client, session, file_type):
+    await asyncio.sleep(NETWORK_DELAY)
+    return {"service_id": "bench", "upload_auth_token": {}}
+
+
+async def _fake_apply(client, auth, service_id, file_name, file_size):
+    await asyncio.sleep(NETWORK_DELAY)
+    return "store/uri", "store-auth", "session-key"
+
+
+async def _fake_commit(client, auth, service_id, session_key):
+    await asyncio.sleep(NETWORK_DELAY)
+    result = {"ImageUri": "bench/uri", "ImageSize": FILE_MB * 1024 * 1024}
+    if RETURN_MD5:
+        result["ImageMd5"] = "0" * 32
+    return result
+
+
+async def _fake_tos(request: httpx.Request) -> httpx.Response:
+    await asyncio.sleep(NETWORK_DELAY)
+    return httpx.Response(200, json={"message": "Success"})
+
+
+def _stub_network():
+    """替换网络阶段，其余逻辑（校验值计算、任务调度）使用实际实现"""
+    doubao_service._get_upload_session = lambda: _FakeSession()
+    doubao_service._prepare_upload = _fake_prepare
+    doubao_service._apply_upload = _fake_apply
+    doubao_service._commit_upload = _fake_commit
+    doubao_service._build_upload_auth = lambda upload_info: None
+    real_client = httpx.AsyncClient
+    doubao_service.httpx.AsyncClient = lambda *args, **kwargs: real_client(transport=httpx.MockTransport(_fake_tos))
+
+
+async def _inline_to_thread(func, *args):
+    return func(*args)
+
+
+async def monitor_lag(stop: asyncio.Event, lags: list[float]):
+    """每 10ms 唤醒一次，记录实际唤醒延迟"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(TICK)
+        lags.append((loop.time() - start - TICK) * 1000)
+
+
+async def run(name: str, payloads: list[bytes]):
+    stop = asyncio.Event()
+    lags: list[float] = []
+    monitor = asyncio.create_task(monitor_lag(stop, lags))
+    start = time.perf_counter()
+    # 文档类型（1）会用到 MD5
+    await asyncio.gather(*[upload_file(1, f"bench_{i}.bin", data) for i, data in enumerate(payloads)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    print(f"{name:<10} 总耗时 {elapsed:6.2f}s | 循环延迟 平均 {statistics.mean(lags):7.1f}ms  p99 {p99:7.1f}ms  最大 {lags[-1]:7.1f}ms")
+
+
+async def main():
+    print(f"并发 {CONCURRENCY} 个 {FILE_MB}MB 上传，commit 返回 ImageMd5: {RETURN_MD5}")
+    _stub_network()
+    payloads = [os.urandom(FILE_MB * 1024 * 1024) for _ in range(CONCURRENCY)]
+    to_thread = doubao_service.asyncio.to_thread
+    doubao_service.asyncio.to_thread = _inline_to_thread
+    try:
+        await run("事件循环内", payloads)
+    finally:
+        doubao_service.asyncio.to_thread = to_thread
+    await run("线程计算", payloads)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,103 @@
+"""
+基准测试 - 无浏览器视频链接解析
+在本地启动一个消息接口替身，测量 HTTP 解析一次视频链接的耗时；
+如果本机安装了 Playwright Chromium，同时测量常驻浏览器池（browser_pool，即回退路径）
+打开同等页面的耗时作对比，浏览器启动不计入耗时
+
+用法: python bench_video_resolver.py [探测次数]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from aiohttp import web
+
+PORT = 18731
+os.environ["DOUBAO_MESSAGE_LIST_URL"] = f"http://127.0.0.1:{PORT}/samantha/message/list"
+
+from src.pool.session_pool import session_pool  # noqa: E402
+from src.service.browser_pool import browser_pool  # noqa: E402
+from src.service.video_resolver import fetch_video_urls, close_client  # noqa: E402
+
+PROBES = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+VIDEO_URL = "https://v26-show.douyinvod.com/0123456789abcdef/68fef44a/video/tos/cn/tos-cn-v-9ecd54/oAsset/?br=2781&mime_type=video_mp4"
+
+
+def fake_messages() -> dict:
+  """构造与页面 XHR 结构相近的消息数据，视频信息嵌套在 content JSON 字符串中"""
+  messages = []
+  for i in range(20):
+    content = {"text": f"消息 {i}"}
+    if i == 0:
+      content = {"creations": [{"video": {"status": 2, "play_info": {"main_url": VIDEO_URL}}}]}
+    messages.append({"message_id": str(1000 + i), "content_type": 2020 if i == 0 else 2001, "content": json.dumps(content)})
+  return {"code": 0, "data": {"messages": messages, "has_more": False}}
+
+
+async def handle_list(request):
+  return web.json_response(fake_messages())
+
+
+async def handle_page(request):
+  return web.Response(text=f"<html><body><video src='{VIDEO_URL}'></video></body></html>", content_type="text/html")
+
+
+def summary(name: str, samples: list[float]):
+  samples.sort()
+  print(f"{name:<12} 次数 {len(samples):4d} | 平均 {statistics.mean(samples):8.2f}ms  p50 {samples[len(samples) // 2]:8.2f}ms  p99 {samples[int(len(samples) * 0.99) - 1]:8.2f}ms")
+
+
+async def bench_http():
+  samples = []
+  for _ in range(PROBES):
+    start = time.perf_counter()
+    result = await fetch_video_urls("bench", "1000")
+    samples.append((time.perf_counter() - start) * 1000)
+    assert result["video_urls"] == [VIDEO_URL], result
+  summary("HTTP 解析", samples)
+  await close_client()
+
+
+async def bench_browser_pool():
+  try:
+    await browser_pool.start()
+  except Exception as e:
+    print(f"跳过浏览器池对比: {str(e).splitlines()[0]}")
+    await browser_pool.stop()
+    return
+  try:
+    session = session_pool.get_session()
+    samples = []
+    for _ in range(min(PROBES, 20)):
+      start = time.perf_counter()
+      async with browser_pool.page(session) as page:
+        await page.goto(f"http://127.0.0.1:{PORT}/chat/bench")
+        await page.evaluate("() => document.querySelector('video').src")
+      samples.append((time.perf_counter() - start) * 1000)
+    summary("浏览器池", samples)
+  finally:
+    await browser_pool.stop()
+
+
+async def main():
+  session_pool.create_session(
+    guest=False, cookie="sessionid=bench", device_id="1", tea_uuid="1", web_id="1", room_id="1", x_flow_trace=""
+  )
+  app = web.Application()
+  app.router.add_post("/samantha/message/list", handle_list)
+  app.router.add_get("/chat/{conversation_id}", handle_page)
+  runner = web.AppRunner(app)
+  await runner.setup()
+  await web.TCPSite(runner, "127.0.0.1", PORT).start()
+  try:
+    await bench_http()
+    await bench_browser_pool()
+  finally:
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+  asyncio.run(main())
@@ -0,0 +1,129 @@
+"""
+基准测试 - 视频任务存储后端
+对比 JSON 文件（每次操作整体读写）、SQLite（索引 + WAL）和内存索引 + 日志（journal）
+在不同任务总量下的单次操作耗时：
+- get_task: 查询单个任务（状态接口）
+- save_task: 更新单个任务（探测过程中的状态变化）
+- get_tasks_by_conversation: 查询会话下的任务
+- get_tasks_by_status: 查询未完成任务（启动恢复）
+- query_page: 分页列表查询的一页（100 个任务，从该任务的位置开始）
+
+以及 save_task 的写放大（进程实际写入的字节数 / 任务数据字节数，取自 /proc/self/io，仅 Linux）
+
+JSON 后端每次操作都要读写整个文件，任务数超过 JSON_MAX_TASKS 时跳过
+
+用法: python bench_video_storage.py [任务总量，逗号分隔，默认 10000,100000,1000000]
+"""
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from src.service.video_storage import VideoTask, _JsonBackend, _SqliteBackend, _JournalBackend
+
+SIZES = [int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else "10000,100000,1000000").split(",")]
+JSON_MAX_TASKS = 100000
+OPS = {"sqlite": 2000, "journal": 2000, "json": 5}
+TASKS_PER_CONVERSATION = 4
+URL = "https://v26-show.douyinvod.com/69195902f20452e9ce165db9b47eb430/68fef44a/video/tos/cn/tos-cn-v-9ecd54/o0xBncPiU5BBIswn/?a=6383&br=1234&bt=1234&lr=video_gen_watermark"
+
+
+def make_tasks(n: int) -> list[VideoTask]:
+  now = time.time()
+  tasks = []
+  for i in range(n):
+    task = VideoTask(str(10 ** 16 + i // TASKS_PER_CONVERSATION), str(2 * 10 ** 16 + i))
+    task.status = "completed" if i % 50 else "pending"
+    task.video_urls = (URL,) if task.status == "completed" else ()
+    task.retry_count = 2
+    task.created_at = task.updated_at = now
+    tasks.append(task)
+  return tasks
+
+
+def written_bytes() -> int | None:
+  """进程通过 write 系列系统调用写出的字节数"""
+  try:
+    with open("/proc/self/io") as f:
+      return next(int(line.split()[1]) for line in f if line.startswith("wchar:"))
+  except (OSError, StopIteration):
+    return None
+
+
+def measure(fn, ops: int, rng: random.Random, tasks: list[VideoTask]) -> tuple[float, float]:
+  """返回 (p50, p99) 毫秒"""
+  samples = []
+  for _ in range(ops):
+    data = rng.choice(tasks)
+    start = time.perf_counter()
+    fn(data)
+    samples.append((time.perf_counter() - start) * 1000)
+  samples.sort()
+  return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+
+
+def bench(name: str, backend, tasks: list[VideoTask]):
+  rng = random.Random(0)
+  ops = OPS[name]
+
+  logical = 0
+
+  def update(task: VideoTask):
+    nonlocal logical
+    task = task.copy()
+    task.status = "processing"
+    task.updated_at = time.time()
+    logical += len(json.dumps(task.to_dict(), ensure_ascii=False).encode("utf-8"))
+    backend.save(task)
+
+  cases = {
+    "get_task": lambda t: backend.get(t.conversation_id, t.message_id),
+    "save_task": update,
+    "get_tasks_by_conversation": lambda t: backend.by_conversation(t.conversation_id),
+    "get_tasks_by_status": lambda t: backend.by_status(("pending", "processing")),
+    "query_page": lambda t: backend.query((), None, t.created_at, None, None, 100),
+  }
+  for case, fn in cases.items():
+    before = written_bytes()
+    # 按状态查询会返回大量任务，减少次数
+    p50, p99 = measure(fn, max(1, ops // 100) if case == "get_tasks_by_status" else ops, rng, tasks)
+    extra = ""
+    if case == "save_task":
+      if hasattr(backend, "flush"):
+        backend.flush()
+      if before is not None:
+        extra = f"  写放大 {(written_bytes() - before) / logical:8.1f}x"
+    print(f"  {name:<7} {case:<26} p50 {p50:9.3f}ms  p99 {p99:9.3f}ms{extra}")
+
+
+def main():
+  for n in SIZES:
+    tasks = make_tasks(n)
+    print(f"任务总量 {n}")
+    with tempfile.TemporaryDirectory() as tmp:
+      start = time.perf_counter()
+      sqlite = _SqliteBackend(Path(tmp) / "video_tasks.db")
+      sqlite.save_many(tasks)
+      print(f"  sqlite  批量写入耗时 {time.perf_counter() - start:.1f}s")
+      bench("sqlite", sqlite, tasks)
+      sqlite.close()
+      start = time.perf_counter()
+      journal = _JournalBackend(Path(tmp) / "video_tasks.journal")
+      journal.save_many(tasks)
+      journal.flush()
+      print(f"  journal 批量写入耗时 {time.perf_counter() - start:.1f}s")
+      bench("journal", journal, tasks)
+      journal.close()
+      if n <= JSON_MAX_TASKS:
+        json_backend = _JsonBackend(Path(tmp) / "video_links.json")
+        json_backend.save_many(tasks)
+        bench("json", json_backend, tasks)
+      else:
+        print(f"  json    任务数超过 {JSON_MAX_TASKS}，跳过")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,39 @@
+"""
+条件请求（ETag / If-None-Match）
+客户端带上次响应的 ETag 请求时，内容未变化则直接返回 304，不构造和序列化响应体
+"""
+from typing import Any, Callable
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+
+def task_etag(task) -> str:
+    """单个任务的 ETag，由任务最后更新时间（微秒）生成"""
+    return f'"t-{int(task.updated_at * 1_000_000):x}"'
+
+
+def store_etag(version: str) -> str:
+    """列表的 ETag，由存储版本生成（同一 URL 的查询条件相同）"""
+    return f'"s-{version}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match 是否匹配（弱比较）"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def conditional_response(request: Request, etag: str, build: Callable[[], Any]) -> Response:
+    """ETag 匹配时返回 304，否则调用 build 构造 JSON 响应"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(jsonable_encoder(build()), headers=headers)
+
+
+__all__ = ["task_etag", "store_etag", "etag_matches", "conditional_response"]
@@ -2,7 +2,8 @@ from fastapi import APIRouter, Body, Query, HTTPException
 from src.service import chat_completion, delete_conversation
 from src.model.response import CompletionResponse, DeleteResponse
 from src.model.request import CompletionRequest
-from src.service.video_storage import start_video_fetch_task
+from src.service.video_scheduler import start_video_fetch_task
+from src.service.attachment_ingest import ingest_urls
 
 
 router = APIRouter()
@@ -17,20 +18,26 @@ async def api_completions(completion: CompletionRequest = Body()):
     3. 目前如果使用未登录账号，那么不支持上下文
     """
     try:
+        attachments = list(completion.attachments)
+        if completion.attachment_urls:
+            attachments += await ingest_urls(completion.attachment_urls)
+
+        video_job = {} if completion.content_type == 2020 else None
         text, imgs, conv_id, msg_id, sec_id = await chat_completion(
             prompt=completion.prompt,
             guest=completion.guest,
             conversation_id=completion.conversation_id,
             section_id=completion.section_id,
-            attachments=completion.attachments,
+            attachments=attachments,
             use_auto_cot=completion.use_auto_cot,
             use_deep_think=completion.use_deep_think,
-            content_type=completion.content_type
+            content_type=completion.content_type,
+            video_job=video_job
         )
 
         # 如果是视频生成请求 (content_type=2020)，启动后台任务获取视频链接
         if completion.content_type == 2020:
-            start_video_fetch_task(conv_id, msg_id, timeout=25000)
+            await start_video_fetch_task(conv_id, msg_id, timeout=25000, prompt_kind="image" if attachments else "text", job=video_job)
 
         return CompletionResponse(
             text=text,
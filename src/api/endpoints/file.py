@@ -1,7 +1,10 @@
-from fastapi import APIRouter, Body, Query, HTTPException
-from src.service import upload_file
-from src.model.response import UploadResponse
+from fastapi import APIRouter, Body, Query, HTTPException, Response
+from src.service import upload_file, prepare_direct_upload, finalize_direct_upload
+from src.service.image_process import preprocess_image
+from src.model.response import UploadResponse, DirectUploadResponse
+from src.model.request import DirectUploadFinalizeRequest, ImageFormat
 import traceback
+import time
 from loguru import logger
 
 
@@ -9,11 +12,61 @@ router = APIRouter()
 
 
 @router.post("/upload", response_model=UploadResponse)
-async def api_upload(file_type: int = Query(), file_name: str = Query(), file_bytes: bytes = Body()):
-    """上传图片或文件到豆包服务器"""
+async def api_upload(
+    response: Response,
+    file_type: int = Query(),
+    file_name: str = Query(),
+    file_bytes: bytes = Body(),
+    max_dimension: int | None = Query(None, gt=0, description="图片最大边长（可选，仅图片）"),
+    quality: int = Query(85, ge=1, le=100, description="图片压缩质量"),
+    image_format: ImageFormat | None = Query(None, description="图片转换格式（可选）: jpeg, png, webp")
+):
+    """
+    上传图片或文件到豆包服务器
+    - 图片（file_type=2）可通过 max_dimension/quality/image_format 开启上传前缩放压缩
+    - 响应头 X-Upload-Bytes-Saved 为预处理节省的字节数，X-Upload-Latency-Ms 为总耗时
+    """
     try:
-        return await upload_file(file_type, file_name, file_bytes)
+        start = time.perf_counter()
+        original_size = len(file_bytes)
+        if file_type == 2:
+            file_name, file_bytes = await preprocess_image(file_name, file_bytes, max_dimension, quality, image_format)
+        result = await upload_file(file_type, file_name, file_bytes)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        response.headers["X-Upload-Bytes-Saved"] = str(original_size - len(file_bytes))
+        response.headers["X-Upload-Latency-Ms"] = f"{elapsed_ms:.0f}"
+        logger.info(f"上传完成: {file_name}, 上传 {len(file_bytes)} 字节, 节省 {original_size - len(file_bytes)} 字节, 总耗时 {elapsed_ms:.0f}ms")
+        return result
     except Exception as e:
         logger.error(f"上传文件失败: {str(e)}")
         logger.error(f"详细错误: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"生成文件失败：{str(e)}")
+
+
+@router.post("/upload/prepare", response_model=DirectUploadResponse)
+async def api_upload_prepare(file_type: int = Query(), file_name: str = Query(), file_size: int = Query(gt=0)):
+    """
+    直传模式第一步：获取直传存储的地址和鉴权信息，文件内容不经过本服务
+    1. 客户端使用返回的 method/upload_url/headers 直接上传文件内容
+    2. 请求头中需要额外附带 `crc32_header` 指定的 CRC32 校验值（8位十六进制小写）
+    3. 上传成功后调用 `/api/file/upload/finalize` 获取附件信息
+    """
+    try:
+        return DirectUploadResponse(**await prepare_direct_upload(file_type, file_name, file_size))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"准备直传失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"准备直传失败：{str(e)}")
+
+
+@router.post("/upload/finalize", response_model=UploadResponse)
+async def api_upload_finalize(request: DirectUploadFinalizeRequest = Body()):
+    """直传模式第二步：确认上传并返回附件信息，可直接用于聊天接口的 attachments 参数"""
+    try:
+        return await finalize_direct_upload(request.upload_id, request.md5)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"确认直传失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"确认直传失败：{str(e)}")
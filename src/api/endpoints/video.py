@@ -1,6 +1,17 @@
-from fastapi import APIRouter, Query, HTTPException
-from src.service.video_service import get_video_url
+import asyncio
+from fastapi import APIRouter, Depends, Path, Query, HTTPException, Request
+from fastapi.responses import FileResponse, RedirectResponse
+from src.service.video_resolver import resolve_video_url
 from src.service.video_storage import VideoStorage
+from src.service.browser_pool import browser_pool
+from src.service.video_scheduler import video_scheduler
+from src.service.task_events import task_events, parse_since, updated_since
+from src.service.webhooks import webhook_dispatcher
+from src.service.change_feed import change_feed, CursorExpired
+from src.service.url_refresher import url_refresher
+from src.service.video_cache import video_cache, VIDEO_CACHE_WAIT
+from src.api.conditional import conditional_response, task_etag, store_etag
+from src.api.listing import TaskListQuery, task_list_response
 from pydantic import BaseModel
 
 
@@ -34,7 +45,7 @@ async def api_get_video_url(
   timeout: int = Query(15000, description="超时时间（毫秒）")
 ):
   """
-  从豆包网页获取视频链接
+  从豆包获取视频链接（优先通过接口数据解析，失败时回退到浏览器渲染页面）
   
   - **conversation_id**: 会话ID（必填）
   - **message_id**: 消息ID（可选）
@@ -43,7 +54,7 @@ async def api_get_video_url(
   返回视频URL列表
   """
   try:
-    result = await get_video_url(conversation_id, message_id, timeout)
+    result = await resolve_video_url(conversation_id, message_id, timeout)
     return VideoResponse(**result)
   except Exception as e:
     raise HTTPException(status_code=500, detail=f"获取视频链接失败: {str(e)}")
@@ -51,14 +62,21 @@ async def api_get_video_url(
 
 @router.get("/task_status")
 async def api_get_video_task_status(
+  request: Request,
   conversation_id: str = Query(..., description="会话ID"),
-  message_id: str = Query(None, description="消息ID（可选）")
+  message_id: str = Query(None, description="消息ID（可选）"),
+  wait: int = Query(0, ge=0, description="长轮询等待秒数，0 表示立即返回"),
+  since: str = Query(None, description="上次获取到的 updated_at，任务在此之后有更新时立即返回")
 ):
   """
   查询视频生成任务状态
   
   - **conversation_id**: 会话ID（必填）
   - **message_id**: 消息ID（可选，不提供则返回该会话的所有视频任务）
+  - **wait**: 长轮询等待秒数（可选），任务在 since 之后有更新（未提供 since 时直到任务全部结束）或超时后返回
+  - **since**: 上次获取到的 updated_at（可选），查询会话时取其中最大的 updated_at
+  
+  响应带 ETag，请求时通过 If-None-Match 带上次的 ETag，没有变化时返回 304
   
   返回任务状态：
   - **pending**: 等待中
@@ -66,23 +84,51 @@ async def api_get_video_task_status(
   - **completed**: 已完成
   - **failed**: 失败
   """
+  try:
+    since_ts = parse_since(since)
+  except ValueError:
+    raise HTTPException(status_code=400, detail="since 格式错误，应为 updated_at 时间或时间戳")
   try:
     if message_id:
       # 查询单个任务
-      task = VideoStorage.get_task(conversation_id, message_id)
+      load = lambda: VideoStorage.get_task_async(conversation_id, message_id)
+      if wait:
+        task = await task_events.wait_for_update(
+          conversation_id, message_id, load,
+          is_fresh=lambda t: t is None or updated_since(t, since_ts),
+          timeout=wait
+        )
+      else:
+        task = await load()
       if not task:
         raise HTTPException(status_code=404, detail="未找到该视频任务")
-      return VideoTaskResponse(**task.to_dict())
+      # 视频链接已过期时先刷新
+      task = await url_refresher.ensure_fresh(task)
+      return conditional_response(request, task_etag(task), lambda: VideoTaskResponse(**task.to_dict()))
     else:
       # 查询该会话的所有任务
-      tasks = VideoStorage.get_tasks_by_conversation(conversation_id)
+      load = lambda: VideoStorage.get_tasks_by_conversation_async(conversation_id)
+
+      def is_fresh(tasks: list) -> bool:
+        # 有 since 时任一任务更新即返回，否则等待全部任务结束
+        if not tasks:
+          return True
+        if since_ts is None:
+          return all(updated_since(t, None) for t in tasks)
+        return any(updated_since(t, since_ts) for t in tasks)
+
+      if wait:
+        await task_events.wait_for_update(conversation_id, None, load, is_fresh, timeout=wait)
+      # 先取版本再读取，读取期间有写入时下次请求会重新获取
+      etag = store_etag(VideoStorage.version())
+      tasks = await load()
       if not tasks:
         raise HTTPException(status_code=404, detail="该会话没有视频任务")
-      return {
+      return conditional_response(request, etag, lambda: {
         "conversation_id": conversation_id,
         "total": len(tasks),
         "tasks": [task.to_dict() for task in tasks]
-      }
+      })
   except HTTPException:
     raise
   except Exception as e:
@@ -90,17 +136,101 @@ async def api_get_video_task_status(
 
 
 @router.get("/all_tasks")
-async def api_get_all_video_tasks():
+async def api_get_all_video_tasks(request: Request, query: TaskListQuery = Depends()):
   """
-  获取所有视频任务列表
+  获取视频任务列表（按创建时间排序）
+  
+  - **status** / **conversation_id** / **created_after** / **created_before**: 过滤条件（可选）
+  - **limit** / **cursor**: 分页（可选），不提供 limit 时返回全部任务；响应中的 next_cursor 不为空时用它请求下一页
+  - **fields**: 只返回指定字段（可选）
+  - **format**: json（默认）或 ndjson（每行一个任务，流式输出）
   
-  返回所有视频生成任务的状态
+  响应带 ETag（任意任务变化后改变），没有变化时返回 304
   """
   try:
-    tasks = VideoStorage.get_all_tasks()
-    return {
-      "total": len(tasks),
-      "tasks": [task.to_dict() for task in tasks]
-    }
+    return await task_list_response(request, query)
   except Exception as e:
     raise HTTPException(status_code=500, detail=f"获取任务列表失败: {str(e)}")
+
+
+@router.get("/changes")
+async def api_get_video_task_changes(
+  cursor: int = Query(None, ge=0, description="上次响应中的 next_cursor，不提供则从保留的最早变更开始"),
+  limit: int = Query(100, ge=1, le=1000, description="每次最多返回的变更数"),
+  wait: int = Query(0, ge=0, description="没有新变更时的长轮询等待秒数，0 表示立即返回")
+):
+  """
+  获取视频任务状态变更流，用于增量同步
+
+  - 变更类型: created / processing / retry / completed / failed，每条带序号 seq 和变更后的任务数据
+  - 用响应中的 next_cursor 请求下一批，has_more 为 false 时表示已同步到最新
+  - 较早的变更会按任务压缩为最新一条（不影响游标）；超过保留期被删除时返回 410，需要通过 /all_tasks 全量重新同步
+  """
+  try:
+    load = lambda: asyncio.to_thread(change_feed.read, cursor, limit + 1)
+    if wait:
+      changes = await task_events.wait_for_update(None, None, load, is_fresh=bool, timeout=wait)
+    else:
+      changes = await load()
+  except CursorExpired as e:
+    raise HTTPException(status_code=410, detail=str(e))
+  except Exception as e:
+    raise HTTPException(status_code=500, detail=f"获取任务变更失败: {str(e)}")
+  has_more = len(changes) > limit
+  changes = changes[:limit]
+  return {
+    "changes": changes,
+    "next_cursor": changes[-1]["seq"] if changes else cursor,
+    "has_more": has_more
+  }
+
+
+@router.api_route("/file/{conversation_id}/{message_id}/{index}", methods=["GET", "HEAD"])
+async def api_get_video_file(
+  conversation_id: str,
+  message_id: str,
+  index: int = Path(..., ge=0, description="视频序号（对应 video_urls 中的位置）")
+):
+  """
+  获取视频文件（稳定链接，不随原链接过期而失效）
+
+  - 开启本地缓存（VIDEO_CACHE_ENABLED=1）时从缓存发送，支持 Range 请求；未缓存时先下载，
+    等待超过 VIDEO_CACHE_WAIT 秒或下载失败时重定向到原链接
+  - 未开启缓存时重定向到原链接（链接已过期时先刷新）
+  """
+  task = await VideoStorage.get_task_async(conversation_id, message_id)
+  if not task or task.status != "completed" or index >= len(task.video_urls):
+    raise HTTPException(status_code=404, detail="视频不存在")
+  if video_cache.enabled:
+    try:
+      path = await asyncio.wait_for(video_cache.fetch(task, index), VIDEO_CACHE_WAIT)
+      return FileResponse(path, media_type="video/mp4", headers={"Cache-Control": "public, max-age=86400"})
+    except Exception:
+      # 下载在后台继续，下次请求时直接从缓存发送
+      pass
+  task = await url_refresher.ensure_fresh(task)
+  return RedirectResponse(task.video_urls[index], status_code=307)
+
+
+@router.get("/metrics")
+async def api_get_video_metrics():
+  """
+  获取视频链接获取相关的运行指标
+
+  - **browser_pool**: 浏览器池状态，包括排队等待时间（wait_ms）、页面 JS 堆大小（page_js_heap_mb）和浏览器进程内存（browser_rss_mb）
+  - **scheduler**: 视频任务调度器状态，包括队列深度（queue_depth）和探测耗时（probe_latency_ms）
+  - **task_events**: 任务事件订阅者数量和因消费过慢断开的次数
+  - **webhooks**: 回调投递队列状态，包括待投递（pending）和放弃投递（dead_letters）的数量
+  - **change_feed**: 任务变更流的记录数和序号范围
+  - **url_refresher**: 视频链接过期刷新的请求数、成功和失败次数
+  - **video_cache**: 视频本地缓存的文件数、占用字节数、命中和淘汰次数
+  """
+  return {
+    "browser_pool": await browser_pool.metrics(),
+    "scheduler": video_scheduler.stats(),
+    "task_events": task_events.stats(),
+    "webhooks": await asyncio.to_thread(webhook_dispatcher.stats),
+    "change_feed": await asyncio.to_thread(change_feed.stats),
+    "url_refresher": url_refresher.stats(),
+    "video_cache": video_cache.stats()
+  }
@@ -2,25 +2,54 @@
 视频生成 API 接口
 支持图生视频和文生视频
 """
-from fastapi import APIRouter, Body, Query, HTTPException
+import json
+from fastapi import APIRouter, Body, Depends, Query, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from src.service import chat_completion, upload_file
-from src.service.video_storage import start_video_fetch_task, VideoStorage
+from src.service.video_storage import VideoStorage
+from src.service.video_scheduler import start_video_fetch_task, video_scheduler
+from src.service.attachment_ingest import ingest_urls
+from src.service.task_events import task_events, parse_since, updated_since
+from src.service.url_refresher import url_refresher
+from src.service.webhooks import validate_callback_url
 from src.model.response import CompletionResponse
-import httpx
+from src.api.conditional import conditional_response, task_etag
+from src.api.listing import TaskListQuery, task_list_response, TASK_FIELDS
+from src.model.request import ImageProcessOptions
 
 
 router = APIRouter()
 
+# 事件流心跳间隔（秒），防止代理断开空闲连接
+EVENT_HEARTBEAT_INTERVAL = 15
+# 批量查询状态时每次最多的任务数
+BATCH_STATUS_MAX = 1000
+
 
 class VideoGenerationRequest(BaseModel):
     """视频生成请求"""
     prompt: str  # 提示词
     image_attachment: dict | None = None  # 图片附件（图生视频时使用）
     image_url: str | None = None  # 图片链接（自动下载并上传）
+    image_urls: list[str] = []  # 多个图片链接（自动下载并上传）
+    image_process: ImageProcessOptions | None = None  # 图片链接上传前的缩放压缩参数（可选）
     guest: bool = False  # 是否使用游客账号
     conversation_id: str | None = None  # 会话ID（可选）
     section_id: str | None = None  # 段落ID（可选）
+    callback_url: str | None = None  # 任务完成或失败时的回调地址（可选）
+
+
+class VideoTaskKey(BaseModel):
+    """视频任务标识"""
+    conversation_id: str
+    message_id: str
+
+
+class BatchStatusRequest(BaseModel):
+    """批量查询状态请求"""
+    tasks: list[VideoTaskKey]  # 要查询的任务
+    fields: list[str] | None = None  # 只返回指定字段（可选）
 
 
 class VideoGenerationResponse(BaseModel):
@@ -53,8 +82,9 @@ async def generate_video(request: VideoGenerationRequest = Body()):
     
     **返回：**
     - 立即返回任务信息
-    - 后台自动开始获取视频（3分钟后开始，每3分钟重试一次）
+    - 后台自动开始获取视频（按历史完成耗时安排探测，期间每10秒做一次轻量状态检查）
     - 通过 `/api/video-gen/status` 查询视频生成状态
+    - 提供 `callback_url` 时，任务完成或失败后会向该地址 POST 任务数据（带签名，失败自动重试）
     
     **示例1 - 使用已上传的图片：**
     ```json
@@ -89,29 +119,21 @@ async def generate_video(request: VideoGenerationRequest = Body()):
     }
     ```
     """
+    if request.callback_url:
+        try:
+            await validate_callback_url(request.callback_url)
+        except (ValueError, OSError) as e:
+            raise HTTPException(status_code=400, detail=f"callback_url 不可用: {str(e)}")
     try:
         # 准备附件列表
         attachments = []
         
         # 如果提供了图片链接，先下载并上传
-        if request.image_url:
+        image_urls = ([request.image_url] if request.image_url else []) + request.image_urls
+        if image_urls:
             try:
-                # 下载图片（自动跟随重定向）
-                async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-                    response = await client.get(request.image_url)
-                    if response.status_code != 200:
-                        raise HTTPException(status_code=400, detail=f"下载图片失败: HTTP {response.status_code}")
-                    image_data = response.content
-                
-                # 从 URL 提取文件名
-                filename = request.image_url.split('/')[-1].split('?')[0]
-                if not '.' in filename:
-                    filename = "image.jpg"
-                
-                # 上传图片
-                attachment = await upload_file(2, filename, image_data)
-                attachments.append(attachment.dict() if hasattr(attachment, 'dict') else attachment)
-                
+                image_process = request.image_process.model_dump() if request.image_process else None
+                attachments += await ingest_urls(image_urls, file_type=2, image_process=image_process)
             except Exception as e:
                 raise HTTPException(status_code=400, detail=f"处理图片链接失败: {str(e)}")
         
@@ -119,7 +141,8 @@ async def generate_video(request: VideoGenerationRequest = Body()):
         elif request.image_attachment:
             attachments.append(request.image_attachment)
         
-        # 调用聊天接口，content_type=2020 表示视频生成
+        # 调用聊天接口，content_type=2020 表示视频生成，生成流中的任务字段写入 video_job
+        video_job = {}
         text, imgs, conv_id, msg_id, sec_id = await chat_completion(
             prompt=request.prompt,
             guest=request.guest,
@@ -128,11 +151,12 @@ async def generate_video(request: VideoGenerationRequest = Body()):
             attachments=attachments,
             use_auto_cot=False,
             use_deep_think=False,
-            content_type=2020  # 视频生成类型
+            content_type=2020,  # 视频生成类型
+            video_job=video_job
         )
         
         # 启动后台任务获取视频链接
-        start_video_fetch_task(conv_id, msg_id, timeout=25000)
+        await start_video_fetch_task(conv_id, msg_id, timeout=25000, prompt_kind="image" if attachments else "text", job=video_job, callback_url=request.callback_url)
         
         return VideoGenerationResponse(
             success=True,
@@ -150,8 +174,11 @@ async def generate_video(request: VideoGenerationRequest = Body()):
 
 @router.get("/status")
 async def get_video_status(
+    request: Request,
     conversation_id: str = Query(..., description="会话ID"),
-    message_id: str = Query(..., description="消息ID")
+    message_id: str = Query(..., description="消息ID"),
+    wait: int = Query(0, ge=0, description="长轮询等待秒数，0 表示立即返回"),
+    since: str = Query(None, description="上次获取到的 updated_at，任务在此之后有更新时立即返回")
 ):
     """
     查询视频生成状态
@@ -162,52 +189,209 @@ async def get_video_status(
     - `completed`: 已完成（视频已生成，可获取链接）
     - `failed`: 失败（达到最大重试次数）
     
+    已完成任务的视频链接已过期时会先重新获取链接再返回（`urls_expire_at` 为链接过期时间）
+    
+    **长轮询：**
+    - 提供 `wait` 时请求会挂起，直到任务在 `since` 之后有更新（未提供 `since` 时直到任务结束）或等待超时，再返回当前状态
+    - 最长等待 60 秒（`LONG_POLL_MAX_WAIT`），客户端将返回的 `updated_at` 作为下一次请求的 `since`
+    
+    **条件请求：**
+    - 响应带 `ETag`，请求时通过 `If-None-Match` 带上次的 ETag，任务未变化时返回 304（无响应体）
+    
     **示例：**
     ```
     GET /api/video-gen/status?conversation_id=xxx&message_id=xxx
+    GET /api/video-gen/status?conversation_id=xxx&message_id=xxx&wait=30&since=2025-01-01T12:00:00.123456
     ```
     """
     try:
-        task = VideoStorage.get_task(conversation_id, message_id)
+        since_ts = parse_since(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since 格式错误，应为 updated_at 时间或时间戳")
+    try:
+        if wait:
+            task = await task_events.wait_for_update(
+                conversation_id, message_id,
+                load=lambda: VideoStorage.get_task_async(conversation_id, message_id),
+                is_fresh=lambda t: t is None or updated_since(t, since_ts),
+                timeout=wait
+            )
+        else:
+            task = await VideoStorage.get_task_async(conversation_id, message_id)
         if not task:
             raise HTTPException(status_code=404, detail="未找到该视频任务")
+        # 视频链接已过期时先刷新
+        task = await url_refresher.ensure_fresh(task)
         
-        return {
+        return conditional_response(request, task_etag(task), lambda: {
             "success": True,
             "task": task.to_dict()
-        }
+        })
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询任务状态失败: {str(e)}")
 
 
+@router.post("/status/batch")
+async def get_video_status_batch(request: BatchStatusRequest = Body()):
+    """
+    批量查询视频生成状态，一次请求代替逐个调用 `/api/video-gen/status`
+    
+    - 每次最多 1000 个任务，重复的任务只返回一次
+    - 不存在的任务不返回 404，而是列在 `not_found` 中
+    - `fields` 可只返回指定字段（始终包含 conversation_id、message_id）
+    
+    **示例：**
+    ```json
+    {
+        "tasks": [
+            {"conversation_id": "xxx", "message_id": "xxx"},
+            {"conversation_id": "xxx", "message_id": "yyy"}
+        ],
+        "fields": ["status", "video_urls"]
+    }
+    ```
+    """
+    if len(request.tasks) > BATCH_STATUS_MAX:
+        raise HTTPException(status_code=400, detail=f"每次最多查询 {BATCH_STATUS_MAX} 个任务")
+    if request.fields and (unknown := [f for f in request.fields if f not in TASK_FIELDS]):
+        raise HTTPException(status_code=400, detail=f"未知的字段: {','.join(unknown)}")
+    try:
+        keys = list(dict.fromkeys((t.conversation_id, t.message_id) for t in request.tasks))
+        found = await VideoStorage.get_tasks_async(keys)
+        fields = ("conversation_id", "message_id", *request.fields) if request.fields else None
+        
+        def project(task) -> dict:
+            data = task.to_dict()
+            return {field: data[field] for field in fields} if fields else data
+        
+        return {
+            "success": True,
+            "total": len(found),
+            "tasks": [project(found[key]) for key in keys if key in found],
+            "not_found": [{"conversation_id": cid, "message_id": mid} for cid, mid in keys if (cid, mid) not in found]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量查询任务状态失败: {str(e)}")
+
+
 @router.get("/list")
-async def list_video_tasks(
-    conversation_id: str = Query(None, description="会话ID（可选，不提供则返回所有任务）")
-):
+async def list_video_tasks(request: Request, query: TaskListQuery = Depends()):
     """
-    获取视频任务列表
+    获取视频任务列表（按创建时间排序）
     
     **参数：**
     - `conversation_id`: 可选，指定会话ID则只返回该会话的任务
+    - `status`: 可选，按状态过滤，多个用逗号分隔
+    - `created_after` / `created_before`: 可选，按创建时间过滤（ISO 时间或时间戳）
+    - `limit` / `cursor`: 可选，分页；响应中的 `next_cursor` 不为空时用它请求下一页
+    - `fields`: 可选，只返回指定字段（始终包含 conversation_id、message_id）
+    - `format`: `json`（默认）或 `ndjson`（每行一个任务，流式输出，适合导出大量任务）
+    
+    响应带 `ETag`（任意任务变化后改变），请求时通过 `If-None-Match` 带上次的 ETag，没有任务变化时返回 304
     
     **示例：**
     ```
     GET /api/video-gen/list
     GET /api/video-gen/list?conversation_id=xxx
+    GET /api/video-gen/list?status=pending,processing&limit=100&fields=status,retry_count
+    GET /api/video-gen/list?format=ndjson&created_after=2025-11-17T00:00:00
     ```
     """
     try:
-        if conversation_id:
-            tasks = VideoStorage.get_tasks_by_conversation(conversation_id)
-        else:
-            tasks = VideoStorage.get_all_tasks()
-        
-        return {
-            "success": True,
-            "total": len(tasks),
-            "tasks": [task.to_dict() for task in tasks]
-        }
+        return await task_list_response(request, query, {"success": True})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取任务列表失败: {str(e)}")
+
+
+@router.post("/cancel")
+async def cancel_video_task(
+    conversation_id: str = Query(..., description="会话ID"),
+    message_id: str = Query(..., description="消息ID")
+):
+    """
+    取消视频获取任务
+    
+    - 任务停止探测并标记为 `failed`（error 为"任务已取消"）
+    - 任务不在调度中（已完成、已失败或不存在）时返回 404
+    """
+    if not await video_scheduler.cancel(conversation_id, message_id):
+        raise HTTPException(status_code=404, detail="该视频任务不在调度中")
+    return {
+        "success": True,
+        "message": "视频任务已取消"
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.get("/events")
+async def video_task_events(
+    request: Request,
+    conversation_id: str = Query(None, description="会话ID（可选，不提供则订阅所有任务）"),
+    message_id: str = Query(None, description="消息ID（可选，需同时提供 conversation_id）")
+):
+    """
+    订阅视频任务状态事件（SSE），代替轮询 `/api/video-gen/status`
+    
+    - 提供 `conversation_id` 和 `message_id`：订阅单个任务，任务完成或失败后事件流结束
+    - 只提供 `conversation_id`：订阅该会话的所有任务
+    - 都不提供：订阅所有任务
+    
+    订阅单个任务或会话时，先推送一次任务当前状态。每个事件格式为：
+    ```
+    event: task
+    data: {"event": "completed", "task": {...}}
+    ```
+    客户端消费过慢（积压超过 `TASK_EVENT_QUEUE_SIZE` 个事件）时推送 `event: error` 后断开，
+    客户端应重新订阅；空闲时每 15 秒发送一次 `: ping` 心跳
+    
+    **示例：**
+    ```
+    curl -N "http://localhost:8000/api/video-gen/events?conversation_id=xxx&message_id=xxx"
+    ```
+    """
+    if message_id and not conversation_id:
+        raise HTTPException(status_code=400, detail="订阅单个任务时需要同时提供 conversation_id")
+    
+    def finished(status: str) -> bool:
+        return bool(message_id) and status in ("completed", "failed")
+    
+    async def stream():
+        # 在生成器内订阅：响应未开始发送就断开时不会留下订阅
+        # 先订阅再读取当前状态，避免两者之间的状态变化丢失
+        subscription = task_events.subscribe(conversation_id, message_id)
+        try:
+            if message_id:
+                tasks = [task] if (task := await VideoStorage.get_task_async(conversation_id, message_id)) else []
+            elif conversation_id:
+                tasks = await VideoStorage.get_tasks_by_conversation_async(conversation_id)
+            else:
+                tasks = []
+            for task in tasks:
+                yield _sse("task", {"event": task.status, "task": task.to_dict()})
+                if finished(task.status):
+                    return
+            while not await request.is_disconnected():
+                try:
+                    event = await subscription.get(EVENT_HEARTBEAT_INTERVAL)
+                except ConnectionError as e:
+                    yield _sse("error", {"detail": str(e)})
+                    return
+                if event is None:
+                    yield ": ping\n\n"
+                    continue
+                yield _sse("task", event)
+                if finished(event["event"]):
+                    return
+        finally:
+            task_events.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
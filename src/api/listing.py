@@ -0,0 +1,107 @@
+"""
+任务列表查询
+/api/video/all_tasks 和 /api/video-gen/list 共用：游标分页、按状态/会话/创建时间过滤、字段投影、NDJSON 流式输出
+"""
+import json
+from typing import Literal
+from fastapi import HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from src.api.conditional import etag_matches, store_etag
+from src.service.task_events import parse_since
+from src.service.video_storage import VideoStorage, VideoTask, decode_cursor
+
+
+# 每页最多返回的任务数
+LIST_MAX_LIMIT = 1000
+# NDJSON 流式输出时每次从存储读取的任务数
+NDJSON_PAGE_SIZE = 500
+# 可投影的字段
+TASK_FIELDS = tuple(VideoTask("", "").to_dict())
+TASK_STATUSES = ("pending", "processing", "completed", "failed")
+
+
+class TaskListQuery:
+    """任务列表查询参数（作为 FastAPI 依赖使用）"""
+
+    def __init__(
+        self,
+        conversation_id: str = Query(None, description="会话ID（可选，不提供则返回所有任务）"),
+        status: str = Query(None, description="按状态过滤，多个用逗号分隔，如 pending,processing"),
+        created_after: str = Query(None, description="只返回该时间（含）之后创建的任务，ISO 时间或时间戳"),
+        created_before: str = Query(None, description="只返回该时间之前创建的任务，ISO 时间或时间戳"),
+        limit: int = Query(None, ge=1, le=LIST_MAX_LIMIT, description=f"每页任务数（最多 {LIST_MAX_LIMIT}），不提供则返回全部"),
+        cursor: str = Query(None, description="分页游标，取上一页响应中的 next_cursor"),
+        fields: str = Query(None, description="只返回指定字段，多个用逗号分隔，如 status,video_urls"),
+        format: Literal["json", "ndjson"] = Query("json", description="ndjson: 每行一个任务的流式输出")
+    ):
+        try:
+            self.created_after = parse_since(created_after)
+            self.created_before = parse_since(created_before)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="created_after / created_before 格式错误，应为 ISO 时间或时间戳")
+        self.statuses = tuple(s for s in (status or "").split(",") if s)
+        if unknown := [s for s in self.statuses if s not in TASK_STATUSES]:
+            raise HTTPException(status_code=400, detail=f"未知的任务状态: {','.join(unknown)}")
+        self.fields = None
+        if fields:
+            requested = [f for f in fields.split(",") if f]
+            if unknown := [f for f in requested if f not in TASK_FIELDS]:
+                raise HTTPException(status_code=400, detail=f"未知的字段: {','.join(unknown)}")
+            # 任务标识始终返回
+            self.fields = tuple(dict.fromkeys(["conversation_id", "message_id", *requested]))
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        self.conversation_id = conversation_id
+        self.limit = limit
+        self.cursor = cursor
+        self.format = format
+
+    def filters(self) -> dict:
+        return {
+            "statuses": self.statuses,
+            "conversation_id": self.conversation_id,
+            "created_after": self.created_after,
+            "created_before": self.created_before,
+        }
+
+    def project(self, task: VideoTask) -> dict:
+        data = task.to_dict()
+        if self.fields is None:
+            return data
+        return {field: data[field] for field in self.fields}
+
+
+def _ndjson_lines(query: TaskListQuery):
+    for task in VideoStorage.iter_tasks(NDJSON_PAGE_SIZE, limit=query.limit, cursor=query.cursor, **query.filters()):
+        yield json.dumps(query.project(task), ensure_ascii=False) + "\n"
+
+
+async def task_list_response(request: Request, query: TaskListQuery, extra: dict | None = None) -> Response:
+    """
+    构造任务列表响应
+    - json: {**extra, total, tasks, next_cursor}，total 为本页任务数
+    - ndjson: 每行一个任务，按页从存储读取，内存占用与任务总数无关
+    两种格式都带 ETag（存储版本），If-None-Match 匹配时返回 304
+    """
+    # 先取版本再读取，读取期间有写入时下次请求会重新获取
+    etag = store_etag(VideoStorage.version())
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if query.format == "ndjson":
+        # 同步生成器由 StreamingResponse 在线程池中迭代，不阻塞事件循环
+        return StreamingResponse(_ndjson_lines(query), media_type="application/x-ndjson", headers=headers)
+    tasks, next_cursor = await VideoStorage.query_tasks_async(**query.filters(), cursor=query.cursor, limit=query.limit)
+    return JSONResponse(jsonable_encoder({
+        **(extra or {}),
+        "total": len(tasks),
+        "tasks": [query.project(task) for task in tasks],
+        "next_cursor": next_cursor
+    }), headers=headers)
+
+
+__all__ = ["TaskListQuery", "task_list_response"]
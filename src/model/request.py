@@ -1,9 +1,15 @@
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, Field
+
+# 图片预处理支持的输出格式（与 image_process.SUPPORTED_FORMATS 一致）
+ImageFormat = Literal["jpeg", "jpg", "png", "webp"]
+
 
 class CompletionRequest(BaseModel):
     prompt: str
     guest: bool
     attachments: list[dict] = []
+    attachment_urls: list[str] = []  # 附件链接，自动下载并上传后追加到 attachments
     conversation_id: str | None = None
     section_id: str | None = None
     use_deep_think: bool = False
@@ -26,4 +32,15 @@ class AttachmentRequest(BaseModel):
 class UploadRequest(BaseModel):
     file_type: int
     file_name: str
-    file_bytes: bytes
\ No newline at end of file
+    file_bytes: bytes
+
+class DirectUploadFinalizeRequest(BaseModel):
+    upload_id: str
+    md5: str | None = None
+
+
+class ImageProcessOptions(BaseModel):
+    """上传前图片预处理参数，max_dimension 和 image_format 均为空时不处理"""
+    max_dimension: int | None = Field(None, gt=0)
+    quality: int = Field(85, ge=1, le=100)
+    image_format: ImageFormat | None = None
@@ -22,6 +22,15 @@ class UploadResponse(BaseModel):
     size: int | None = None
     
 
+class DirectUploadResponse(BaseModel):
+    upload_id: str
+    upload_url: str
+    method: str
+    headers: dict[str, str]
+    crc32_header: str
+    expires_at: int
+
+
 class ImageResponse(BaseModel):
     key: str
     name: str
@@ -1,12 +1,13 @@
 import os
 import json
 import random
-from pydantic import BaseModel
+from dataclasses import dataclass, fields
 from loguru import logger
 from .fetcher import DoubaoAutomator
 
-class DoubaoSession(BaseModel):
-    """豆包API会话配置"""
+@dataclass(slots=True)
+class DoubaoSession:
+    """豆包API会话配置（每次请求都会读取属性，使用 slots 数据类而不是 pydantic 模型）"""
     cookie: str
     device_id: str
     tea_uuid: str
@@ -27,7 +28,14 @@ class DoubaoSession(BaseModel):
     
     @classmethod
     def from_dict(cls, data: dict[str, str]) -> 'DoubaoSession':
-        return cls(**data)
+        """从字典创建，字段缺失或不是字符串时抛出 ValueError"""
+        values = {}
+        for f in fields(cls):
+            value = data.get(f.name)
+            if not isinstance(value, str):
+                raise ValueError(f"会话配置字段 {f.name} 缺失或不是字符串: {value!r}")
+            values[f.name] = value
+        return cls(**values)
 
 
 class SessionPool:
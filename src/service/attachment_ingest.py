@@ -0,0 +1,221 @@
+"""
+链接附件接入服务
+从 URL 流式下载文件并上传到豆包服务器，供聊天接口和视频生成接口共用
+- 共享连接池，限制下载大小和超时
+- 下载同时执行 prepare-upload 并增量计算 CRC32，下载完成即可上传
+- 按 URL 缓存附件信息，重复的 URL 跳过下载和上传（过期后使用 ETag 校验）
+- 只下载公网地址，手动跟随重定向并检查每一跳（INGEST_ALLOWED_HOSTS 中的主机除外）
+"""
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+from fastapi import HTTPException
+from loguru import logger
+from src.service.doubao_service import upload_file, request_upload_credentials
+from src.service.image_process import preprocess_image
+from src.service.url_guard import parse_allowed_hosts, build_pinned_request
+import asyncio
+import binascii
+import mimetypes
+import os
+import time
+import httpx
+
+
+# 单个文件最大下载字节数
+INGEST_MAX_BYTES = int(os.getenv("INGEST_MAX_BYTES", str(20 * 1024 * 1024)))
+# 下载超时（秒）
+INGEST_TIMEOUT = float(os.getenv("INGEST_TIMEOUT", "30"))
+# 单个请求内并发下载数
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+# 附件缓存有效期（秒），过期后使用 ETag 向源站校验
+INGEST_CACHE_TTL = int(os.getenv("INGEST_CACHE_TTL", "3600"))
+# 附件缓存最大条目数
+INGEST_CACHE_SIZE = int(os.getenv("INGEST_CACHE_SIZE", "1024"))
+# 最多跟随的重定向次数
+INGEST_MAX_REDIRECTS = int(os.getenv("INGEST_MAX_REDIRECTS", "5"))
+# 允许解析到非公网地址的附件主机（逗号分隔），用于从内网文件服务接入
+INGEST_ALLOWED_HOSTS = parse_allowed_hosts(os.getenv("INGEST_ALLOWED_HOSTS", ""))
+
+
+class _CacheEntry:
+    __slots__ = ("etag", "attachment", "cached_at")
+
+    def __init__(self, etag: str | None, attachment: dict, cached_at: float):
+        self.etag = etag
+        self.attachment = attachment
+        self.cached_at = cached_at
+
+
+# (url, file_type, 预处理参数) -> 附件缓存
+_cache: OrderedDict[tuple, _CacheEntry] = OrderedDict()
+_client: httpx.AsyncClient | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(INGEST_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+    return _client
+
+
+async def close_client():
+    """关闭共享下载连接池"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _guess_file_name(url: str, content_type: str | None) -> str:
+    """从 URL 或 Content-Type 推断文件名"""
+    file_name = os.path.basename(urlparse(url).path)
+    if '.' in file_name:
+        return file_name
+    ext = mimetypes.guess_extension((content_type or "").split(';')[0].strip()) or ".jpg"
+    return (file_name or "file") + ext
+
+
+def _guess_file_type(content_type: str | None) -> int:
+    """图片类型 2，其余按文档类型 1 处理"""
+    return 2 if (content_type or "").startswith("image/") else 1
+
+
+def _guess_file_type_from_url(url: str) -> int | None:
+    """按 URL 扩展名预判文件类型，无法判断时返回 None"""
+    content_type, _ = mimetypes.guess_type(urlparse(url).path)
+    return _guess_file_type(content_type) if content_type else None
+
+
+def _cache_get(key: tuple) -> _CacheEntry | None:
+    if entry := _cache.get(key):
+        _cache.move_to_end(key)
+    return entry
+
+
+def _cache_put(key: tuple, etag: str | None, attachment: dict):
+    _cache[key] = _CacheEntry(etag, attachment, time.time())
+    _cache.move_to_end(key)
+    while len(_cache) > INGEST_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+async def _open(url: str, headers: dict) -> httpx.Response:
+    """
+    发起流式 GET 请求并跟随重定向，返回未读取正文的响应
+    每一跳都检查地址并直接连接检查过的 IP
+    """
+    client = _get_client()
+    for _ in range(INGEST_MAX_REDIRECTS + 1):
+        try:
+            request = await build_pinned_request(client, "GET", url, INGEST_ALLOWED_HOSTS, headers=headers)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"不允许的文件地址: {str(e)}")
+        except OSError as e:
+            raise HTTPException(status_code=400, detail=f"无法解析文件地址: {str(e)}")
+        response = await client.send(request, stream=True)
+        location = response.headers.get("location")
+        if not (response.is_redirect and location):
+            return response
+        await response.aclose()
+        url = urljoin(url, location)
+    raise HTTPException(status_code=400, detail=f"下载文件失败: 重定向超过 {INGEST_MAX_REDIRECTS} 次")
+
+
+async def _download(url: str, etag: str | None) -> tuple[bytes, str, str | None, str | None] | None:
+    """
+    流式下载文件，返回 (数据, CRC32, ETag, Content-Type)
+    携带 ETag 且源站返回 304 时返回 None
+    """
+    headers = {"if-none-match": etag} if etag else {}
+    response = await _open(url, headers)
+    try:
+        if response.status_code == 304:
+            return None
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail=f"下载文件失败: HTTP {response.status_code}")
+        content_length = response.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > INGEST_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"文件过大: {content_length} 字节，上限 {INGEST_MAX_BYTES} 字节")
+
+        buffer = bytearray()
+        crc = 0
+        async for chunk in response.aiter_bytes():
+            buffer += chunk
+            if len(buffer) > INGEST_MAX_BYTES:
+                raise HTTPException(status_code=413, detail=f"文件过大，上限 {INGEST_MAX_BYTES} 字节")
+            crc = binascii.crc32(chunk, crc)
+        return bytes(buffer), format(crc & 0xFFFFFFFF, '08x'), response.headers.get("etag"), response.headers.get("content-type")
+    finally:
+        await response.aclose()
+
+
+async def ingest_url(url: str, file_type: int | None = None, image_process: dict | None = None) -> dict:
+    """
+    下载 URL 对应的文件并上传，返回附件信息
+    - file_type 为空时先按 URL 扩展名预判（以便与下载并行获取上传凭证），
+      无扩展名或与 Content-Type 不一致时按 Content-Type 判断图片(2)或文档(1)
+    - image_process 为图片预处理参数，见 ImageProcessOptions
+    """
+    image_process = image_process or {}
+    key = (url, file_type, tuple(sorted(image_process.items())))
+    entry = _cache_get(key)
+    if entry and time.time() - entry.cached_at < INGEST_CACHE_TTL:
+        logger.debug(f"附件缓存命中: {url}")
+        return entry.attachment
+
+    start = time.perf_counter()
+    # 预先获取上传凭证，与下载并行（仅类型已知或可由扩展名预判时）
+    expected_type = file_type or _guess_file_type_from_url(url)
+    prepare_task = asyncio.create_task(request_upload_credentials(expected_type)) if expected_type else None
+    try:
+        downloaded = await _download(url, entry.etag if entry else None)
+        if downloaded is None:
+            # 源站确认内容未变化，刷新缓存并复用附件
+            logger.debug(f"附件未变化(304)，复用缓存: {url}")
+            entry.cached_at = time.time()
+            return entry.attachment
+
+        data, crc32, etag, content_type = downloaded
+        download_ms = (time.perf_counter() - start) * 1000
+        if not file_type:
+            # 源站未给出具体类型时沿用扩展名的预判
+            mime = (content_type or "").split(';')[0].strip()
+            generic = mime in ("", "application/octet-stream", "binary/octet-stream")
+            file_type = expected_type if expected_type and generic else _guess_file_type(content_type)
+        file_name = _guess_file_name(url, content_type)
+
+        if file_type == 2 and image_process:
+            processed_name, processed = await preprocess_image(file_name, data, **image_process)
+            if processed is not data:
+                file_name, data, crc32 = processed_name, processed, None
+
+        # 实际类型与预判不一致时预取的凭证不可用，由 upload_file 重新获取
+        upload_info = await prepare_task if prepare_task and file_type == expected_type else None
+        attachment = await upload_file(file_type, file_name, data, crc32=crc32, upload_info=upload_info)
+        attachment = attachment.model_dump() if hasattr(attachment, 'model_dump') else attachment
+    finally:
+        if prepare_task and not prepare_task.done():
+            prepare_task.cancel()
+        elif prepare_task and not prepare_task.cancelled():
+            prepare_task.exception()
+
+    _cache_put(key, etag, attachment)
+    logger.info(f"链接附件上传完成: {url[:100]}, {len(data)} 字节, 下载 {download_ms:.0f}ms, 总耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
+    return attachment
+
+
+async def ingest_urls(urls: list[str], file_type: int | None = None, image_process: dict | None = None) -> list[dict]:
+    """并发接入多个 URL，返回顺序与输入一致的附件列表"""
+    semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+
+    async def _ingest(url: str) -> dict:
+        async with semaphore:
+            return await ingest_url(url, file_type, image_process)
+
+    return list(await asyncio.gather(*[_ingest(url) for url in urls]))
+
+
+__all__ = ["ingest_url", "ingest_urls", "close_client"]
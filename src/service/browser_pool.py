@@ -0,0 +1,320 @@
+"""
+浏览器池
+应用启动时启动一个常驻 Chromium，按 DoubaoSession 缓存已登录的浏览器上下文，
+通过并发限制分配页面，上下文使用次数或内存超限后自动回收
+"""
+import asyncio
+import glob
+import os
+import sys
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from loguru import logger
+from playwright.async_api import async_playwright
+
+
+# 同时打开的页面数上限
+BROWSER_MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", "4"))
+# 单个上下文最多使用次数，超过后回收重建
+BROWSER_CONTEXT_MAX_USES = int(os.getenv("BROWSER_CONTEXT_MAX_USES", "50"))
+# 单个页面内存（JS 堆）超过该值（MB）时回收其上下文
+BROWSER_PAGE_MEMORY_LIMIT_MB = int(os.getenv("BROWSER_PAGE_MEMORY_LIMIT_MB", "512"))
+# 指标保留的最近样本数
+METRICS_WINDOW = 200
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+def find_chromium() -> str | None:
+  """查找系统中已安装的 Playwright Chromium"""
+  # 检查多个可能的安装位置
+  search_paths = [
+    # venv 环境
+    os.path.join(os.getcwd(), 'venv', 'Lib', 'site-packages', 'playwright', 'driver', 'package', '.local-browsers', 'chromium-*', 'chrome-win', 'chrome.exe'),
+    # .venv 环境
+    os.path.join(os.getcwd(), '.venv', 'Lib', 'site-packages', 'playwright', 'driver', 'package', '.local-browsers', 'chromium-*', 'chrome-win', 'chrome.exe'),
+    # 用户目录
+    os.path.expanduser('~\\AppData\\Local\\ms-playwright\\chromium-*\\chrome-win\\chrome.exe'),
+    # Python site-packages
+    os.path.join(sys.prefix, 'Lib', 'site-packages', 'playwright', 'driver', 'package', '.local-browsers', 'chromium-*', 'chrome-win', 'chrome.exe'),
+  ]
+  for pattern in search_paths:
+    matches = glob.glob(pattern)
+    if matches and os.path.exists(matches[0]):
+      logger.info(f"找到 Chromium 浏览器: {matches[0]}")
+      return matches[0]
+  logger.warning("未找到 Chromium，使用默认路径")
+  return None
+
+
+def session_cookies(session) -> list[dict]:
+  """将 session 的 cookie 字符串转换为 Playwright cookie 列表"""
+  cookies = []
+  for cookie_str in session.cookie.split('; '):
+    if '=' in cookie_str:
+      name, value = cookie_str.split('=', 1)
+      cookies.append({
+        'name': name,
+        'value': value,
+        'domain': '.doubao.com',
+        'path': '/'
+      })
+  return cookies
+
+
+def _session_key(session) -> str:
+  return f"{session.device_id}:{session.web_id}"
+
+
+def _children_map() -> dict[int, list[int]]:
+  """读取 /proc，返回 父进程 -> 子进程列表"""
+  children: dict[int, list[int]] = {}
+  for entry in os.listdir('/proc'):
+    if not entry.isdigit():
+      continue
+    try:
+      with open(f'/proc/{entry}/stat') as f:
+        ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+      children.setdefault(ppid, []).append(int(entry))
+    except (OSError, ValueError, IndexError):
+      continue
+  return children
+
+
+def _find_browser_pid(parent: int) -> int | None:
+  """在 parent 的子孙进程中查找 Playwright 启动的 Chromium 主进程（命令行含 --remote-debugging-pipe），仅支持 Linux"""
+  try:
+    children = _children_map()
+    stack = list(children.get(parent, []))
+    while stack:
+      pid = stack.pop()
+      try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+          if b'--remote-debugging-pipe' in f.read():
+            return pid
+      except OSError:
+        pass
+      stack.extend(children.get(pid, []))
+  except Exception:
+    pass
+  return None
+
+
+def _process_tree_rss(pid: int) -> int:
+  """统计进程及其所有子进程的 RSS（字节），仅支持 Linux"""
+  try:
+    children = _children_map()
+    total, stack = 0, [pid]
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    while stack:
+      child = stack.pop()
+      stack.extend(children.get(child, []))
+      try:
+        with open(f'/proc/{child}/statm') as f:
+          total += int(f.read().split()[1]) * page_size
+      except (OSError, ValueError, IndexError):
+        continue
+    return total
+  except Exception:
+    return 0
+
+
+class _PooledContext:
+  """池中的浏览器上下文"""
+  __slots__ = ("context", "uses", "active", "retired")
+
+  def __init__(self, context):
+    self.context = context
+    self.uses = 0
+    self.active = 0
+    self.retired = False
+
+
+class BrowserPool:
+  """常驻浏览器池"""
+
+  def __init__(
+    self,
+    max_pages: int = BROWSER_MAX_PAGES,
+    max_context_uses: int = BROWSER_CONTEXT_MAX_USES,
+    page_memory_limit_mb: int = BROWSER_PAGE_MEMORY_LIMIT_MB
+  ):
+    self.max_pages = max_pages
+    self.max_context_uses = max_context_uses
+    self.page_memory_limit = page_memory_limit_mb * 1024 * 1024
+    self._playwright = None
+    self._browser = None
+    # Chromium 主进程 PID，用于统计浏览器内存（仅 Linux）
+    self._browser_pid: int | None = None
+    self._launch_options: dict | None = None
+    self._contexts: dict[str, _PooledContext] = {}
+    self._semaphore = asyncio.Semaphore(max_pages)
+    self._lock = asyncio.Lock()
+    self._waiting = 0
+    self._active_pages = 0
+    self._wait_times: deque[float] = deque(maxlen=METRICS_WINDOW)
+    self._page_memory: deque[int] = deque(maxlen=METRICS_WINDOW)
+    self._counters = {
+      "browser_launches": 0,
+      "contexts_created": 0,
+      "contexts_recycled": 0,
+      "pages_served": 0,
+    }
+
+  async def start(self):
+    """启动 Playwright 和浏览器（已启动时直接返回）"""
+    async with self._lock:
+      await self._ensure_browser()
+
+  async def stop(self):
+    """关闭所有上下文和浏览器"""
+    async with self._lock:
+      for pooled in self._contexts.values():
+        await self._close_context(pooled)
+      self._contexts.clear()
+      if self._browser:
+        await self._browser.close()
+        self._browser = None
+        self._browser_pid = None
+      if self._playwright:
+        await self._playwright.stop()
+        self._playwright = None
+
+  async def _ensure_browser(self):
+    if self._browser and self._browser.is_connected():
+      return
+    if self._playwright is None:
+      self._playwright = await async_playwright().start()
+    if self._launch_options is None:
+      self._launch_options = {
+        'headless': True,  # 无头模式
+        'args': [
+          '--disable-blink-features=AutomationControlled',
+          '--disable-dev-shm-usage',
+          '--no-sandbox',
+          '--disable-setuid-sandbox'
+        ]
+      }
+      if chromium_path := find_chromium():
+        self._launch_options['executable_path'] = chromium_path
+    # 浏览器崩溃后旧上下文全部失效
+    self._contexts.clear()
+    self._browser = await self._playwright.chromium.launch(**self._launch_options)
+    self._counters["browser_launches"] += 1
+    if sys.platform.startswith("linux"):
+      self._browser_pid = await asyncio.to_thread(_find_browser_pid, os.getpid())
+    logger.info("浏览器池: Chromium 已启动")
+
+  async def _get_context(self, session) -> _PooledContext:
+    async with self._lock:
+      await self._ensure_browser()
+      key = _session_key(session)
+      pooled = self._contexts.get(key)
+      if pooled is None or pooled.retired:
+        context = await self._browser.new_context(
+          viewport={'width': 1280, 'height': 720},
+          user_agent=USER_AGENT
+        )
+        await context.add_cookies(session_cookies(session))
+        pooled = _PooledContext(context)
+        self._contexts[key] = pooled
+        self._counters["contexts_created"] += 1
+      pooled.uses += 1
+      pooled.active += 1
+      return pooled
+
+  async def _close_context(self, pooled: _PooledContext):
+    try:
+      await pooled.context.close()
+    except Exception as e:
+      logger.warning(f"浏览器池: 关闭上下文失败: {str(e)}")
+
+  async def _release_context(self, session, pooled: _PooledContext, page_memory: int):
+    async with self._lock:
+      pooled.active -= 1
+      if not pooled.retired and (pooled.uses >= self.max_context_uses or page_memory > self.page_memory_limit):
+        pooled.retired = True
+        self._counters["contexts_recycled"] += 1
+        logger.info(f"浏览器池: 回收上下文 (使用 {pooled.uses} 次, 页面内存 {page_memory // 1024 // 1024}MB)")
+        key = _session_key(session)
+        if self._contexts.get(key) is pooled:
+          del self._contexts[key]
+      if pooled.retired and pooled.active == 0:
+        await self._close_context(pooled)
+
+  @staticmethod
+  async def _page_memory(page) -> int:
+    """通过 CDP 读取页面 JS 堆内存（字节），作为页面内存占用的近似值"""
+    try:
+      cdp = await page.context.new_cdp_session(page)
+      await cdp.send("Performance.enable")
+      metrics = await cdp.send("Performance.getMetrics")
+      await cdp.detach()
+      return int(next((m["value"] for m in metrics["metrics"] if m["name"] == "JSHeapTotalSize"), 0))
+    except Exception:
+      return 0
+
+  @asynccontextmanager
+  async def page(self, session):
+    """
+    获取一个已登录 session 的页面，使用结束后自动关闭
+    超过并发上限时排队等待
+    """
+    start = time.perf_counter()
+    self._waiting += 1
+    try:
+      await self._semaphore.acquire()
+    finally:
+      self._waiting -= 1
+    self._wait_times.append(time.perf_counter() - start)
+    pooled = None
+    page = None
+    page_memory = 0
+    try:
+      pooled = await self._get_context(session)
+      page = await pooled.context.new_page()
+      self._active_pages += 1
+      self._counters["pages_served"] += 1
+      yield page
+    finally:
+      if page is not None:
+        self._active_pages -= 1
+        page_memory = await self._page_memory(page)
+        self._page_memory.append(page_memory)
+        try:
+          await page.close()
+        except Exception:
+          pass
+      if pooled is not None:
+        await self._release_context(session, pooled, page_memory)
+      self._semaphore.release()
+
+  async def metrics(self) -> dict:
+    """
+    导出池状态和指标
+    - page_js_heap_mb: 页面关闭前的 JS 堆大小（CDP JSHeapTotalSize），不含 DOM、图片等内存
+    - browser_rss_mb: Chromium 主进程及其子进程的 RSS 合计（读取 /proc 在线程中执行）
+    """
+    wait_ms = sorted(t * 1000 for t in self._wait_times)
+    memory_mb = sorted(m / 1024 / 1024 for m in self._page_memory)
+
+    def _quantile(values: list[float], q: float) -> float:
+      return round(values[min(len(values) - 1, int(len(values) * q))], 1) if values else 0.0
+
+    return {
+      "running": bool(self._browser and self._browser.is_connected()),
+      "max_pages": self.max_pages,
+      "active_pages": self._active_pages,
+      "waiting": self._waiting,
+      "contexts": len(self._contexts),
+      **self._counters,
+      "wait_ms": {"p50": _quantile(wait_ms, 0.5), "p99": _quantile(wait_ms, 0.99), "max": round(wait_ms[-1], 1) if wait_ms else 0.0},
+      "page_js_heap_mb": {"p50": _quantile(memory_mb, 0.5), "p99": _quantile(memory_mb, 0.99), "max": round(memory_mb[-1], 1) if memory_mb else 0.0},
+      "browser_rss_mb": round(await asyncio.to_thread(_process_tree_rss, self._browser_pid) / 1024 / 1024, 1) if self._browser_pid else None,
+    }
+
+
+browser_pool = BrowserPool()
+
+__all__ = ["BrowserPool", "browser_pool", "session_cookies"]
@@ -0,0 +1,156 @@
+"""
+视频任务变更流
+按顺序追加记录任务状态变化（created / processing / retry / completed / failed），
+下游按序号游标增量同步，不需要反复读取全部任务：
+- 每条变更带递增序号 seq 和变更后的任务数据
+- 压缩：超过 TASK_CHANGES_COMPACT_AFTER 秒的变更，同一任务只保留最新一条，
+  游标仍然有效，只是跳过中间状态
+- 保留期：超过 TASK_CHANGES_RETENTION 秒的变更直接删除，游标落在已删除范围内时需要全量重新同步
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from loguru import logger
+
+
+# 变更流数据库路径
+TASK_CHANGES_DB = Path(os.getenv("TASK_CHANGES_DB", "task_changes.db"))
+# 变更保留时间（秒），默认 30 天
+TASK_CHANGES_RETENTION = int(os.getenv("TASK_CHANGES_RETENTION", str(30 * 86400)))
+# 超过该时间（秒）的变更按任务压缩为最新一条，默认 1 天，0 表示不压缩
+TASK_CHANGES_COMPACT_AFTER = int(os.getenv("TASK_CHANGES_COMPACT_AFTER", "86400"))
+# 压缩和清理的执行间隔（秒）
+TASK_CHANGES_COMPACT_INTERVAL = int(os.getenv("TASK_CHANGES_COMPACT_INTERVAL", "3600"))
+
+CHANGE_EVENTS = ("created", "processing", "retry", "completed", "failed")
+
+
+class CursorExpired(Exception):
+  """游标之后的部分变更已超过保留期被删除"""
+
+
+class ChangeFeed:
+  """任务变更流，SQLite 单连接 + 锁"""
+
+  def __init__(self, path: Path = TASK_CHANGES_DB):
+    self.path = path
+    self._lock = threading.Lock()
+    self._conn: sqlite3.Connection | None = None
+    self._runner: asyncio.Task | None = None
+
+  def _connect(self) -> sqlite3.Connection:
+    if self._conn is None:
+      conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("PRAGMA synchronous=NORMAL")
+      conn.executescript("""
+        CREATE TABLE IF NOT EXISTS task_changes (
+          seq INTEGER PRIMARY KEY AUTOINCREMENT,
+          conversation_id TEXT NOT NULL,
+          message_id TEXT NOT NULL,
+          event TEXT NOT NULL,
+          time REAL NOT NULL,
+          task TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_task_changes_task ON task_changes (conversation_id, message_id, seq);
+        CREATE INDEX IF NOT EXISTS idx_task_changes_time ON task_changes (time);
+        CREATE TABLE IF NOT EXISTS task_changes_meta (
+          key TEXT PRIMARY KEY,
+          value INTEGER NOT NULL
+        );
+      """)
+      self._conn = conn
+    return self._conn
+
+  def append(self, task, event: str) -> int:
+    """追加一条变更，返回序号"""
+    with self._lock:
+      cursor = self._connect().execute(
+        "INSERT INTO task_changes (conversation_id, message_id, event, time, task) VALUES (?, ?, ?, ?, ?)",
+        (task.conversation_id, task.message_id, event, time.time(), json.dumps(task.to_dict(), ensure_ascii=False))
+      )
+      return cursor.lastrowid
+
+  def read(self, after: int | None = None, limit: int = 100) -> list[dict]:
+    """
+    读取序号大于 after 的变更，按序号排序，after 为空时从保留的最早变更开始
+    after 之后有变更已超过保留期被删除时抛出 CursorExpired
+    """
+    with self._lock:
+      conn = self._connect()
+      expired = conn.execute("SELECT value FROM task_changes_meta WHERE key = 'expired_through'").fetchone()
+      if after is None:
+        after = 0
+      elif expired and after < expired[0]:
+        raise CursorExpired(f"游标 {after} 之后的部分变更已过期（已删除至 {expired[0]}），请全量重新同步")
+      rows = conn.execute(
+        "SELECT seq, event, time, task FROM task_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+        (after, limit)
+      ).fetchall()
+    return [{"seq": seq, "event": event, "time": at, "task": json.loads(task)} for seq, event, at, task in rows]
+
+  def compact(self, now: float | None = None) -> dict:
+    """按保留期删除过期变更，并压缩超过 TASK_CHANGES_COMPACT_AFTER 的变更，返回删除的条数"""
+    now = time.time() if now is None else now
+    result = {"expired": 0, "compacted": 0}
+    with self._lock:
+      conn = self._connect()
+      cutoff = now - TASK_CHANGES_RETENTION
+      if (last := conn.execute("SELECT MAX(seq) FROM task_changes WHERE time < ?", (cutoff,)).fetchone()[0]) is not None:
+        conn.execute("BEGIN")
+        result["expired"] = conn.execute("DELETE FROM task_changes WHERE seq <= ?", (last,)).rowcount
+        conn.execute(
+          "INSERT INTO task_changes_meta (key, value) VALUES ('expired_through', ?) "
+          "ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)",
+          (last,)
+        )
+        conn.execute("COMMIT")
+      if TASK_CHANGES_COMPACT_AFTER > 0:
+        result["compacted"] = conn.execute("""
+          DELETE FROM task_changes AS c
+          WHERE c.time < ? AND EXISTS (
+            SELECT 1 FROM task_changes AS n
+            WHERE n.conversation_id = c.conversation_id AND n.message_id = c.message_id AND n.seq > c.seq
+          )
+        """, (now - TASK_CHANGES_COMPACT_AFTER,)).rowcount
+    if result["expired"] or result["compacted"]:
+      logger.info(f"任务变更流已清理: 过期 {result['expired']} 条, 压缩 {result['compacted']} 条")
+    return result
+
+  def start(self):
+    """启动定期压缩（已启动时直接返回）"""
+    if self._runner is None or self._runner.done():
+      self._runner = asyncio.create_task(self._run())
+
+  async def _run(self):
+    while True:
+      try:
+        await asyncio.to_thread(self.compact)
+      except Exception as e:
+        logger.warning(f"任务变更流清理失败: {str(e)}")
+      await asyncio.sleep(TASK_CHANGES_COMPACT_INTERVAL)
+
+  async def stop(self):
+    if self._runner:
+      self._runner.cancel()
+      self._runner = None
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
+
+  def stats(self) -> dict:
+    with self._lock:
+      if self._conn is None and not self.path.exists():
+        return {"changes": 0, "first_seq": None, "last_seq": None}
+      count, first, last = self._connect().execute("SELECT COUNT(*), MIN(seq), MAX(seq) FROM task_changes").fetchone()
+    return {"changes": count, "first_seq": first, "last_seq": last}
+
+
+change_feed = ChangeFeed()
+
+__all__ = ["ChangeFeed", "CursorExpired", "change_feed", "CHANGE_EVENTS"]
@@ -2,12 +2,15 @@ from src.pool.session_pool import session_pool
 from requests_aws4auth import AWS4Auth
 from fastapi import HTTPException
 from loguru import logger
+from src.service.video_urls import extract_video_job
 import aiohttp
 import httpx
 import json
 import uuid
+import asyncio
 import hashlib
-import binascii
+import time
+import zlib
 import os
 
 async def chat_completion(
@@ -18,8 +21,13 @@ async def chat_completion(
     attachments: list[dict] = [], 
     use_auto_cot: bool = False, 
     use_deep_think: bool = False,
-    content_type: int = 2001
+    content_type: int = 2001,
+    video_job: dict | None = None
 ):
+    """
+    对话补全
+    video_job 不为空时（视频生成请求），流中解析到的视频任务标识和状态字段会写入该字典
+    """
     # 获取会话配置
     session = session_pool.get_session(conversation_id, guest)
     if not session:
@@ -94,7 +102,7 @@ async def chat_completion(
                     raise Exception(f"豆包API对话补全失败: {response.status}, 详情: {error_text}")
                 try:
                     # 下一次会话需要同一个session
-                    text, image_urls, conversation_id, message_id, section_id = await handle_sse(response)
+                    text, image_urls, conversation_id, message_id, section_id = await handle_sse(response, video_job)
                     session_pool.set_session(conversation_id, session)
                     return text, image_urls, conversation_id, message_id, section_id
                 except RateLimitException:
@@ -107,8 +115,8 @@ async def chat_completion(
         raise Exception(f"豆包API请求失败: {str(e)}")
 
 
-async def handle_sse(response: aiohttp.ClientResponse):
-    """处理SSE流响应"""
+async def handle_sse(response: aiohttp.ClientResponse, video_job: dict | None = None):
+    """处理SSE流响应，video_job 不为空时收集视频生成消息中的任务字段"""
     buffer = ""
     conversation_id = ""
     message_id = ""
@@ -169,6 +177,10 @@ async def handle_sse(response: aiohttp.ClientResponse):
                                 
                                 if url and url not in image_urls:
                                     image_urls.append(url)
+                    elif video_job is not None:
+                        # 视频生成消息，保留任务标识和状态（后出现的字段覆盖先出现的）
+                        video_job.update(extract_video_job(msg.get('content', '{}')))
+                        logger.debug(f"视频生成消息 {content_type}: {video_job}")
                     else:
                         logger.warning(f"未知的消息类型 {content_type}")
                 elif event_type == 2002:
@@ -192,31 +204,17 @@ async def handle_sse(response: aiohttp.ClientResponse):
                 raise Exception(f"解析SSE失败: {str(e)}")
 
 
-async def upload_file(file_type: int, file_name: str, file_data: bytes):
-    """
-    上传文件到豆包服务器，返回附件信息
-    总体流程为：
-    1. 通过 prepare-upload 拿到 AWS 凭证
-    2. 通过 apply-upload 提交文件元信息
-    3. 通过 upload 上传文件数据
-    4. 通过 commit-upload 确认上传
-    """
-    # 上传文件需要登录账号，不能使用游客session
-    session = session_pool.get_session(guest=False)
-    if not session:
-        raise HTTPException(status_code=500, detail="没有可用的登录账号，上传文件需要登录")
-    is_guest = 'sessionid=' not in session.cookie
-    logger.debug(f"开始上传文件: {file_name}, 类型: {file_type}, 大小: {len(file_data)} 字节，使用session: {'游客' if is_guest else '登录账号'}")
-    # ------ HEADERS -------
-    DEFAULT_HEADERS = {
-        'content-type': 'application/json',
-        'cookie': session.cookie,
-        'origin': "www.doubao.com",
-        'referer': "https://www.doubao.com/chat/",
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36'
-    }
-    # ------ PARAMS -------
-    params = "&".join([
+UPLOAD_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36'
+TOS_UPLOAD_HOST = "tos-d-x-hl.snssdk.com"
+# 两阶段直传的待确认上传，超过该时间未 finalize 则丢弃（秒）
+DIRECT_UPLOAD_TTL = 15 * 60
+
+# upload_id -> 待确认的直传上传信息
+_pending_uploads: dict[str, dict] = {}
+
+
+def _upload_params(session) -> str:
+    return "&".join([
         "aid=497858",
         f"device_id={session.device_id}",
         "device_platform=web",
@@ -231,112 +229,272 @@ async def upload_file(file_type: int, file_name: str, file_data: bytes):
         "use-olympus-account=1",
         "version_code=20800",
     ])
-    # 由于 AWS4Auth 不支持 Aiohttp, 所以采用异步库 HTTPX
-    async with httpx.AsyncClient() as client:
-        # PREPARE UPLOAD
-        prepare_url = "https://www.doubao.com/alice/resource/prepare_upload?" + params
-        prepare_payload = {
-            "resource_type": file_type,  # 文档类型 1;图片类型 2; 
-            "scene_id": "5",
-            "tenant_id": "5"
-        }
-        resp = await client.post(url=prepare_url, headers=DEFAULT_HEADERS, json=prepare_payload)
-        prepare_data = resp.json()
-        logger.debug(f"prepare_upload 响应: {prepare_data}")
-        upload_info = prepare_data.get("data", {})
-        
-        # APPLY UPLOAD
-        service_id = upload_info.get("service_id")
-        session_token = upload_info.get("upload_auth_token", {}).get("session_token")
-        access_key = upload_info.get("upload_auth_token", {}).get("access_key")
-        secret_key = upload_info.get("upload_auth_token", {}).get("secret_key")
-        logger.debug(f"AWS凭证 - access_key: {access_key}, secret_key: {'***' if secret_key else None}, session_token: {'***' if session_token else None}")
-        file_size = len(file_data)
-        if not '.' in file_name:
-            raise HTTPException(status_code=500, detail="文件名格式错误，注意附带后缀名")
-        file_ext = os.path.splitext(file_name)[1]
-        apply_url = f"https://imagex.bytedanceapi.com/?Action=ApplyImageUpload&Version=2018-08-01&ServiceId={service_id}&NeedFallback=true&FileSize={file_size}&FileExtension={file_ext}"
-        
-        # 构建 AWS4Auth
-        auth = AWS4Auth(access_key, secret_key, 'cn-north-1', "imagex", session_token=session_token)
-        applu_request = client.build_request(
-            method="GET",
-            url=apply_url,
-            headers={
-                "origin": "https://www.doubao.com",
-                "reference": "https://www.doubao.com",
-                "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36",
-                }
-            )
-        auth.__call__(applu_request) 
-        resp = await client.send(applu_request)
-        data = resp.json()
-        upload_address = data.get("Result", {}).get("UploadAddress", {})
-        if not (infos := upload_address.get("StoreInfos", [])):
-            raise HTTPException(status_code=500, detail="Apply Upload 返回 StoreInfos列表为空")
-        store_info = infos[0]
-        store_url = store_info.get("StoreUri")
-        store_auth = store_info.get("Auth")
-        session_key = upload_address.get("SessionKey")
-        
-        # UPLOAD
-        upload_url = f"https://tos-d-x-hl.snssdk.com/upload/v1/{store_url}"
-        crc32 = format(binascii.crc32(file_data) & 0xFFFFFFFF, '08x')
-        upload_headers = {
-            "authorization": store_auth,
+
+
+def _get_upload_session():
+    # 上传文件需要登录账号，不能使用游客session
+    session = session_pool.get_session(guest=False)
+    if not session:
+        raise HTTPException(status_code=500, detail="没有可用的登录账号，上传文件需要登录")
+    return session
+
+
+async def _prepare_upload(client: httpx.AsyncClient, session, file_type: int) -> dict:
+    """通过 prepare-upload 拿到 AWS 凭证"""
+    headers = {
+        'content-type': 'application/json',
+        'cookie': session.cookie,
+        'origin': "www.doubao.com",
+        'referer': "https://www.doubao.com/chat/",
+        'user-agent': UPLOAD_USER_AGENT
+    }
+    prepare_url = "https://www.doubao.com/alice/resource/prepare_upload?" + _upload_params(session)
+    prepare_payload = {
+        "resource_type": file_type,  # 文档类型 1;图片类型 2; 
+        "scene_id": "5",
+        "tenant_id": "5"
+    }
+    resp = await client.post(url=prepare_url, headers=headers, json=prepare_payload)
+    prepare_data = resp.json()
+    logger.debug(f"prepare_upload 响应: {prepare_data}")
+    return prepare_data.get("data", {})
+
+
+def _build_upload_auth(upload_info: dict) -> AWS4Auth:
+    """根据 prepare-upload 返回的凭证构建 AWS4Auth"""
+    session_token = upload_info.get("upload_auth_token", {}).get("session_token")
+    access_key = upload_info.get("upload_auth_token", {}).get("access_key")
+    secret_key = upload_info.get("upload_auth_token", {}).get("secret_key")
+    logger.debug(f"AWS凭证 - access_key: {access_key}, secret_key: {'***' if secret_key else None}, session_token: {'***' if session_token else None}")
+    return AWS4Auth(access_key, secret_key, 'cn-north-1', "imagex", session_token=session_token)
+
+
+async def _apply_upload(client: httpx.AsyncClient, auth: AWS4Auth, service_id: str, file_name: str, file_size: int) -> tuple[str, str, str]:
+    """通过 apply-upload 提交文件元信息，返回 (store_uri, store_auth, session_key)"""
+    if not '.' in file_name:
+        raise HTTPException(status_code=500, detail="文件名格式错误，注意附带后缀名")
+    file_ext = os.path.splitext(file_name)[1]
+    apply_url = f"https://imagex.bytedanceapi.com/?Action=ApplyImageUpload&Version=2018-08-01&ServiceId={service_id}&NeedFallback=true&FileSize={file_size}&FileExtension={file_ext}"
+    apply_request = client.build_request(
+        method="GET",
+        url=apply_url,
+        headers={
             "origin": "https://www.doubao.com",
             "reference": "https://www.doubao.com",
-            "host": "tos-d-x-hl.snssdk.com",
-            "content-type": "application/octet-stream",
-            "content-disposition": 'attachment; filename="undefined"',
-            "content-crc32": crc32
-        }
-        resp = await client.post(upload_url, content=file_data, headers=upload_headers)
-        data = resp.json()
-        if not (msg := data.get("message")) == "Success":
-            raise HTTPException(status_code=500, detail=f"上传消息失败 {msg}")
-        
-        # COMMIT UPLOAD
-        commit_url = f"https://imagex.bytedanceapi.com/?Action=CommitImageUpload&Version=2018-08-01&ServiceId={service_id}"
-        commit_payload = {"SessionKey": session_key}
-        commit_headers = {
-            "origin": "https://www.doubao.com",
-            "referer": "https://www.doubao.com/",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36",
-        }
-        
-        # AWS4AUTH
-        commit_request = client.build_request(
-            method="POST",
-            url=commit_url,
-            headers=commit_headers,
-            json=commit_payload
+            "user-agent": UPLOAD_USER_AGENT,
+            }
         )
-        auth.__call__(commit_request)
-        resp = await client.send(commit_request)
-        data = resp.json()
-        if not (results := data.get("Result", {}).get("PluginResult", [])):
-            raise HTTPException(status_code=500, detail="Commit Upload 返回 PluginResult 为空")
-        result = results[0]
-        
-        # 返回结果
-        from src.model.response import FileResponse, ImageResponse
-        if file_type == 1:
-            return FileResponse(
-                key=result.get("ImageUri"),
-                name=file_name,
-                md5=result.get("ImageMd5") or hashlib.md5(file_data).hexdigest(),
-                size=result.get("ImageSize")
-            )
-        elif file_type == 2:
-            return ImageResponse(
-                key=result.get("ImageUri"),
-                name=file_name,
-                option={
-                    "height": result.get("ImageHeight"),
-                    "width": result.get("ImageWidth")
-                }
-            )
+    auth.__call__(apply_request) 
+    resp = await client.send(apply_request)
+    data = resp.json()
+    upload_address = data.get("Result", {}).get("UploadAddress", {})
+    if not (infos := upload_address.get("StoreInfos", [])):
+        raise HTTPException(status_code=500, detail="Apply Upload 返回 StoreInfos列表为空")
+    store_info = infos[0]
+    return store_info.get("StoreUri"), store_info.get("Auth"), upload_address.get("SessionKey")
+
+
+def _crc32_hex(data: bytes) -> str:
+    """计算 CRC32（zlib 对大块数据会释放 GIL，适合在线程中执行）"""
+    return format(zlib.crc32(data) & 0xFFFFFFFF, '08x')
+
+
+def _md5_hex(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def _tos_upload_headers(store_auth: str, crc32: str | None = None) -> dict:
+    """TOS 上传请求头，content-crc32 需要由上传方根据文件内容计算"""
+    headers = {
+        "authorization": store_auth,
+        "origin": "https://www.doubao.com",
+        "reference": "https://www.doubao.com",
+        "host": TOS_UPLOAD_HOST,
+        "content-type": "application/octet-stream",
+        "content-disposition": 'attachment; filename="undefined"',
+    }
+    if crc32 is not None:
+        headers["content-crc32"] = crc32
+    return headers
+
+
+async def _commit_upload(client: httpx.AsyncClient, auth: AWS4Auth, service_id: str, session_key: str) -> dict:
+    """通过 commit-upload 确认上传，返回 PluginResult"""
+    commit_url = f"https://imagex.bytedanceapi.com/?Action=CommitImageUpload&Version=2018-08-01&ServiceId={service_id}"
+    commit_payload = {"SessionKey": session_key}
+    commit_headers = {
+        "origin": "https://www.doubao.com",
+        "referer": "https://www.doubao.com/",
+        "user-agent": UPLOAD_USER_AGENT,
+    }
+    
+    # AWS4AUTH
+    commit_request = client.build_request(
+        method="POST",
+        url=commit_url,
+        headers=commit_headers,
+        json=commit_payload
+    )
+    auth.__call__(commit_request)
+    resp = await client.send(commit_request)
+    data = resp.json()
+    if not (results := data.get("Result", {}).get("PluginResult", [])):
+        raise HTTPException(status_code=500, detail="Commit Upload 返回 PluginResult 为空")
+    return results[0]
+
+
+def _build_attachment(file_type: int, file_name: str, result: dict, md5: str | None = None):
+    """根据 commit-upload 结果构建附件信息"""
+    from src.model.response import FileResponse, ImageResponse
+    if file_type == 1:
+        return FileResponse(
+            key=result.get("ImageUri"),
+            name=file_name,
+            md5=result.get("ImageMd5") or md5 or "",
+            size=result.get("ImageSize")
+        )
+    elif file_type == 2:
+        return ImageResponse(
+            key=result.get("ImageUri"),
+            name=file_name,
+            option={
+                "height": result.get("ImageHeight"),
+                "width": result.get("ImageWidth")
+            }
+        )
+
+
+async def request_upload_credentials(file_type: int) -> dict:
+    """单独执行 prepare-upload，便于与文件下载等步骤并行"""
+    session = _get_upload_session()
+    async with httpx.AsyncClient() as client:
+        return await _prepare_upload(client, session, file_type)
+
+
+async def upload_file(
+    file_type: int,
+    file_name: str,
+    file_data: bytes,
+    crc32: str | None = None,
+    upload_info: dict | None = None
+):
+    """
+    上传文件到豆包服务器，返回附件信息
+    总体流程为：
+    1. 通过 prepare-upload 拿到 AWS 凭证（可由调用方通过 upload_info 提前获取）
+    2. 通过 apply-upload 提交文件元信息
+    3. 通过 upload 上传文件数据（crc32 可由调用方在接收数据时增量计算）
+    4. 通过 commit-upload 确认上传
+    """
+    session = _get_upload_session()
+    is_guest = 'sessionid=' not in session.cookie
+    logger.debug(f"开始上传文件: {file_name}, 类型: {file_type}, 大小: {len(file_data)} 字节，使用session: {'游客' if is_guest else '登录账号'}")
+    # CRC32 在线程中计算，与 prepare-upload/apply-upload 网络请求并行，避免阻塞事件循环
+    crc32_task = asyncio.create_task(asyncio.to_thread(_crc32_hex, file_data)) if crc32 is None else None
+    try:
+        # 由于 AWS4Auth 不支持 Aiohttp, 所以采用异步库 HTTPX
+        async with httpx.AsyncClient() as client:
+            # PREPARE UPLOAD
+            if upload_info is None:
+                upload_info = await _prepare_upload(client, session, file_type)
+
+            # APPLY UPLOAD
+            service_id = upload_info.get("service_id")
+            auth = _build_upload_auth(upload_info)
+            store_url, store_auth, session_key = await _apply_upload(client, auth, service_id, file_name, len(file_data))
+
+            # UPLOAD
+            upload_url = f"https://{TOS_UPLOAD_HOST}/upload/v1/{store_url}"
+            if crc32_task is not None:
+                crc32 = await crc32_task
+            resp = await client.post(upload_url, content=file_data, headers=_tos_upload_headers(store_auth, crc32))
+            data = resp.json()
+            if not (msg := data.get("message")) == "Success":
+                raise HTTPException(status_code=500, detail=f"上传消息失败 {msg}")
+
+            # COMMIT UPLOAD
+            result = await _commit_upload(client, auth, service_id, session_key)
+
+            # 返回结果，文档的 MD5 仅在服务端未返回 ImageMd5 时计算
+            md5 = await asyncio.to_thread(_md5_hex, file_data) if file_type == 1 and not result.get("ImageMd5") else None
+            return _build_attachment(file_type, file_name, result, md5)
+    finally:
+        # 未用到的计算任务取消后等待结束，并取回其中的异常，避免 "exception never retrieved" 警告
+        if crc32_task is not None:
+            crc32_task.cancel()
+            await asyncio.gather(crc32_task, return_exceptions=True)
+
+
+def _purge_pending_uploads():
+    now = time.time()
+    for upload_id in [k for k, v in _pending_uploads.items() if v["expires_at"] <= now]:
+        _pending_uploads.pop(upload_id, None)
+
+
+async def prepare_direct_upload(file_type: int, file_name: str, file_size: int) -> dict:
+    """
+    两阶段直传第一步：执行 prepare-upload 和 apply-upload，返回客户端直传 TOS 所需信息
+    客户端需自行计算文件 CRC32 并放入 content-crc32 请求头，POST 文件内容到 upload_url，
+    之后调用 finalize_direct_upload 完成 commit-upload
+    """
+    session = _get_upload_session()
+    logger.debug(f"准备直传文件: {file_name}, 类型: {file_type}, 大小: {file_size} 字节")
+    async with httpx.AsyncClient() as client:
+        upload_info = await _prepare_upload(client, session, file_type)
+        service_id = upload_info.get("service_id")
+        auth = _build_upload_auth(upload_info)
+        store_url, store_auth, session_key = await _apply_upload(client, auth, service_id, file_name, file_size)
+    
+    _purge_pending_uploads()
+    upload_id = str(uuid.uuid4())
+    expires_at = time.time() + DIRECT_UPLOAD_TTL
+    _pending_uploads[upload_id] = {
+        "upload_info": upload_info,
+        "service_id": service_id,
+        "session_key": session_key,
+        "file_type": file_type,
+        "file_name": file_name,
+        "expires_at": expires_at,
+    }
+    return {
+        "upload_id": upload_id,
+        "upload_url": f"https://{TOS_UPLOAD_HOST}/upload/v1/{store_url}",
+        "method": "POST",
+        # host、origin 由客户端（浏览器）自动设置，不能也不需要指定
+        "headers": {k: v for k, v in _tos_upload_headers(store_auth).items() if k not in ("host", "origin")},
+        "crc32_header": "content-crc32",
+        "expires_at": int(expires_at),
+    }
+
+
+async def _commit_direct_upload(pending: dict) -> dict:
+    auth = _build_upload_auth(pending["upload_info"])
+    async with httpx.AsyncClient() as client:
+        return await _commit_upload(client, auth, pending["service_id"], pending["session_key"])
+
+
+def _commit_done(pending: dict, commit: asyncio.Task):
+    # 失败时（客户端尚未上传完成或临时错误）清除，可用同一 upload_id 重试
+    if commit.cancelled() or commit.exception() is not None:
+        if pending.get("commit") is commit:
+            pending["commit"] = None
+
+
+async def finalize_direct_upload(upload_id: str, md5: str | None = None):
+    """
+    两阶段直传第二步：客户端上传完成后执行 commit-upload，返回附件信息
+    同一 upload_id 只 commit 一次：并发的 finalize 等待同一个 commit，
+    成功后在过期前重复调用直接返回同一结果
+    """
+    _purge_pending_uploads()
+    if not (pending := _pending_uploads.get(upload_id)):
+        raise HTTPException(status_code=404, detail="上传任务不存在或已过期")
+    if (commit := pending.get("commit")) is None:
+        commit = pending["commit"] = asyncio.create_task(_commit_direct_upload(pending))
+        commit.add_done_callback(lambda task: _commit_done(pending, task))
+    # 调用方断开时不取消 commit，其他等待方和重试仍可使用结果
+    result = await asyncio.shield(commit)
+    return _build_attachment(pending["file_type"], pending["file_name"], result, md5)
 
 
 async def delete_conversation(conversation_id: str) -> tuple[bool, str]:
@@ -397,5 +555,8 @@ class RateLimitException(Exception):
 __all__ = [
     "chat_completion",
     "upload_file",
+    "request_upload_credentials",
+    "prepare_direct_upload",
+    "finalize_direct_upload",
     "delete_conversation"
 ] 
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""
+图片预处理模块
+上传前按需缩放、压缩图片并转换格式，在进程池中执行以避免阻塞事件循环
+"""
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+import asyncio
+import io
+import os
+import time
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 为可选依赖，未安装时跳过预处理
+    Image = None
+
+
+# 进程池大小，默认与 CPU 核数一致
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "0")) or None
+
+# 支持的输出格式 -> (Pillow 格式名, 文件后缀)
+SUPPORTED_FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "jpg": ("JPEG", ".jpg"),
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+}
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    return _executor
+
+
+def shutdown_executor():
+    """关闭图片处理进程池"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def _process_image(data: bytes, max_dimension: int | None, quality: int, image_format: str | None) -> tuple[bytes, str]:
+    """在子进程中执行：缩放、压缩并转换格式，返回 (图片数据, Pillow 格式名)"""
+    with Image.open(io.BytesIO(data)) as img:
+        source_format = img.format or "JPEG"
+        # 按 EXIF 方向旋转，避免缩放后手机照片方向错误
+        img = ImageOps.exif_transpose(img)
+        if max_dimension and max(img.size) > max_dimension:
+            img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        target_format = SUPPORTED_FORMATS[image_format][0] if image_format else source_format
+        if target_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        output = io.BytesIO()
+        save_options = {"optimize": True}
+        if target_format in ("JPEG", "WEBP"):
+            save_options["quality"] = quality
+        img.save(output, format=target_format, **save_options)
+        return output.getvalue(), target_format
+
+
+async def preprocess_image(
+    file_name: str,
+    data: bytes,
+    max_dimension: int | None = None,
+    quality: int = 85,
+    image_format: str | None = None
+) -> tuple[str, bytes]:
+    """
+    上传前预处理图片，返回 (文件名, 图片数据)
+    - 未指定 max_dimension 和 image_format 时不做处理
+    - 处理结果比原图更大时保留原图
+    """
+    if not max_dimension and not image_format:
+        return file_name, data
+    if Image is None:
+        logger.warning("未安装 Pillow，跳过图片预处理")
+        return file_name, data
+    if image_format:
+        image_format = image_format.lower()
+        if image_format not in SUPPORTED_FORMATS:
+            raise ValueError(f"不支持的图片格式: {image_format}")
+
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        processed, target_format = await loop.run_in_executor(
+            _get_executor(), _process_image, data, max_dimension, quality, image_format
+        )
+    except Exception as e:
+        logger.warning(f"图片预处理失败，使用原图上传: {str(e)}")
+        return file_name, data
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    # 格式转换时即使体积变大也要使用转换结果
+    if len(processed) >= len(data) and not image_format:
+        logger.info(f"图片预处理未减小体积，使用原图: {file_name} ({len(data)} 字节, 耗时 {elapsed_ms:.0f}ms)")
+        return file_name, data
+
+    if image_format:
+        file_name = os.path.splitext(file_name)[0] + SUPPORTED_FORMATS[image_format][1]
+    logger.info(
+        f"图片预处理完成: {file_name}, {len(data)} -> {len(processed)} 字节, "
+        f"节省 {len(data) - len(processed)} 字节, 格式 {target_format}, 耗时 {elapsed_ms:.0f}ms"
+    )
+    return file_name, processed
+
+
+__all__ = ["preprocess_image", "shutdown_executor"]
@@ -0,0 +1,180 @@
+"""
+自适应探测策略
+根据历史视频任务的完成耗时分布（按 content_type 和提示词类型分组）安排探测时间：
+在可能完成的时间窗口内密集探测，其余时间稀疏探测
+分布在后台定期重新拟合（只读取最近完成的任务的时间字段，读取在存储线程中执行），不阻塞事件循环
+"""
+import asyncio
+import os
+import time
+from datetime import datetime
+from loguru import logger
+
+
+# 是否启用自适应探测，关闭时使用固定间隔
+VIDEO_ADAPTIVE_PROBING = os.getenv("VIDEO_ADAPTIVE_PROBING", "1") != "0"
+# 每个分组至少需要的样本数，不足时使用全部样本，仍不足时使用固定间隔
+MIN_SAMPLES = int(os.getenv("VIDEO_POLICY_MIN_SAMPLES", "5"))
+# 两次探测之间的最小间隔（秒）
+MIN_PROBE_GAP = int(os.getenv("VIDEO_POLICY_MIN_GAP", "20"))
+# 历史分布重新计算间隔（秒）
+POLICY_REFRESH_INTERVAL = 600
+# 拟合使用的最近完成任务数上限
+POLICY_SAMPLE_LIMIT = int(os.getenv("VIDEO_POLICY_SAMPLE_LIMIT", "5000"))
+# 完成窗口内的探测分位点，分位点越多等待越短、探测次数越多
+DENSE_QUANTILES = tuple(float(q) for q in os.getenv("VIDEO_POLICY_QUANTILES", "0.4,0.75,0.95").split(","))
+
+
+def _parse_time(value) -> float | None:
+  if value is None:
+    return None
+  if isinstance(value, (int, float)):
+    return float(value)
+  try:
+    return datetime.fromisoformat(value).timestamp()
+  except ValueError:
+    return None
+
+
+def estimate_duration(created_at, completed_at, last_miss_at=None) -> float | None:
+  """
+  估计任务从创建到视频完成的耗时（秒）
+  完成时间介于最后一次未命中探测和成功探测之间，有未命中记录时取中点，否则取成功探测时间（上界）
+  成功探测时间取 completed_at（完成后刷新链接等保存会更新 updated_at，不能代表完成时间）
+  """
+  created = _parse_time(created_at)
+  completed = _parse_time(completed_at)
+  if created is None or completed is None or completed <= created:
+    return None
+  missed = _parse_time(last_miss_at)
+  if missed is not None and created < missed < completed:
+    return (missed + completed) / 2 - created
+  return completed - created
+
+
+def completion_estimate(task) -> float | None:
+  """已完成任务的完成耗时估计，见 estimate_duration"""
+  if task.status != "completed":
+    return None
+  return estimate_duration(task.created_at, task.completed_at, task.last_miss_at)
+
+
+def quantile(values: list[float], q: float) -> float:
+  """线性插值分位数，values 需已排序"""
+  if len(values) == 1:
+    return values[0]
+  pos = (len(values) - 1) * q
+  low = int(pos)
+  high = min(low + 1, len(values) - 1)
+  return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def build_schedule(durations: list[float], budget: int, fallback_interval: float) -> list[float]:
+  """
+  根据完成耗时样本生成探测时间点（相对任务创建的秒数）
+  - 完成窗口内按分位点密集探测
+  - 最后一个分位点之后按间隔逐步加倍稀疏探测
+  """
+  durations = sorted(durations)
+  offsets: list[float] = []
+
+  def add(offset: float):
+    if not offsets or offset - offsets[-1] >= MIN_PROBE_GAP:
+      offsets.append(offset)
+
+  for q in DENSE_QUANTILES:
+    add(max(MIN_PROBE_GAP, quantile(durations, q)))
+  gap = max(MIN_PROBE_GAP, (offsets[-1] - offsets[0]) / max(1, len(offsets) - 1))
+  while len(offsets) < budget:
+    gap = min(gap * 2, fallback_interval * 2)
+    offsets.append(offsets[-1] + gap)
+  return offsets[:budget]
+
+
+class ProbePolicy:
+  """探测时间策略"""
+
+  def __init__(self, first_delay: float, interval: float, enabled: bool = VIDEO_ADAPTIVE_PROBING):
+    self.first_delay = first_delay
+    self.interval = interval
+    self.enabled = enabled
+    self._durations: dict[tuple, list[float]] = {}
+    self._all: list[float] = []
+    self._loaded_at = 0.0
+    self._refreshing: asyncio.Task | None = None
+
+  def fit(self, tasks) -> "ProbePolicy":
+    """使用历史任务拟合完成耗时分布"""
+    return self.fit_samples(
+      (task.content_type, task.prompt_kind, task.created_at, task.completed_at, task.last_miss_at)
+      for task in tasks if task.status == "completed"
+    )
+
+  def fit_samples(self, samples) -> "ProbePolicy":
+    """使用 (content_type, prompt_kind, created_at, completed_at, last_miss_at) 样本拟合完成耗时分布"""
+    durations: dict[tuple, list[float]] = {}
+    for content_type, prompt_kind, created_at, completed_at, last_miss_at in samples:
+      if (estimate := estimate_duration(created_at, completed_at, last_miss_at)) is not None:
+        durations.setdefault((content_type, prompt_kind), []).append(estimate)
+    self._durations = {key: sorted(values) for key, values in durations.items()}
+    self._all = sorted(v for values in durations.values() for v in values)
+    self._loaded_at = time.monotonic()
+    logger.debug(f"探测策略已更新: 样本 {len(self._all)} 个, 分组 {list(self._durations)}")
+    return self
+
+  async def refresh(self):
+    """读取最近 POLICY_SAMPLE_LIMIT 个已完成任务的时间字段重新拟合"""
+    from src.service.video_storage import VideoStorage
+    try:
+      self.fit_samples(await VideoStorage.get_completion_samples_async(POLICY_SAMPLE_LIMIT))
+    except Exception as e:
+      self._loaded_at = time.monotonic()
+      logger.warning(f"探测策略更新失败: {str(e)}")
+
+  def _maybe_refresh(self):
+    """分布过期时在后台重新拟合，完成前继续使用当前分布"""
+    if not self.enabled or time.monotonic() - self._loaded_at <= POLICY_REFRESH_INTERVAL:
+      return
+    if self._refreshing is not None and not self._refreshing.done():
+      return
+    try:
+      self._refreshing = asyncio.get_running_loop().create_task(self.refresh())
+    except RuntimeError:
+      # 不在事件循环中（离线模拟），不刷新
+      pass
+
+  def _samples(self, task) -> list[float] | None:
+    samples = self._durations.get((task.content_type, task.prompt_kind), [])
+    if len(samples) >= MIN_SAMPLES:
+      return samples
+    if len(self._all) >= MIN_SAMPLES:
+      return self._all
+    return None
+
+  def schedule(self, task) -> list[float] | None:
+    """任务的探测时间点（相对创建时间的秒数），样本不足或未启用时返回 None"""
+    self._maybe_refresh()
+    if not self.enabled or not (samples := self._samples(task)):
+      return None
+    return build_schedule(samples, task.max_retries, self.interval)
+
+  def next_delay(self, task, now: float | None = None) -> float:
+    """
+    距离下一次探测的秒数
+    按任务创建时间和最后更新时间计算，服务重启后恢复的任务已过期的探测会立即进行
+    """
+    now = time.time() if now is None else now
+    elapsed = now - (_parse_time(task.created_at) or now)
+    since_update = now - (_parse_time(task.updated_at) or now)
+    offsets = self.schedule(task)
+    if offsets is None:
+      if task.retry_count == 0:
+        return max(0.0, self.first_delay - elapsed)
+      return max(0.0, self.interval - since_update)
+    for offset in offsets:
+      if offset > elapsed:
+        return offset - elapsed
+    return max(0.0, self.interval - since_update)
+
+
+__all__ = ["ProbePolicy", "build_schedule", "completion_estimate", "estimate_duration"]
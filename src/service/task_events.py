@@ -0,0 +1,184 @@
+"""
+视频任务事件总线
+VideoStorage 保存任务时发布事件，订阅方（SSE 接口、长轮询）按任务、会话或全部任务过滤接收：
+- 每个订阅者一个有界队列，发布时不阻塞
+- 队列满（消费过慢）时断开该订阅者，由客户端重新订阅并重新获取当前状态
+- 订阅者按任务、会话索引，发布时只遍历相关订阅者（长轮询会产生大量单任务订阅）
+"""
+import asyncio
+import os
+from datetime import datetime
+from typing import Callable
+from loguru import logger
+
+
+# 每个订阅者最多缓存的事件数，超过后断开
+TASK_EVENT_QUEUE_SIZE = int(os.getenv("TASK_EVENT_QUEUE_SIZE", "100"))
+# 长轮询最长等待时间（秒）
+LONG_POLL_MAX_WAIT = int(os.getenv("LONG_POLL_MAX_WAIT", "60"))
+
+
+def parse_since(value: str | None) -> float | None:
+  """解析长轮询的 since 参数（接口返回的 updated_at ISO 时间或时间戳），格式错误时抛出 ValueError"""
+  if value is None or value == "":
+    return None
+  try:
+    return float(value)
+  except ValueError:
+    return datetime.fromisoformat(value).timestamp()
+
+
+def updated_since(task, since: float | None) -> bool:
+  """
+  任务在 since 之后是否有更新；since 为空时以任务是否已结束判断
+  ISO 时间只精确到微秒，相差不足 1 微秒视为同一时间
+  """
+  if since is None:
+    return task.status in ("completed", "failed")
+  return task.updated_at - since > 1e-6
+
+
+class Subscription:
+  """事件订阅，conversation_id / message_id 为空表示不过滤"""
+  __slots__ = ("conversation_id", "message_id", "queue", "closed")
+
+  def __init__(self, conversation_id: str | None, message_id: str | None, queue_size: int):
+    self.conversation_id = conversation_id
+    self.message_id = message_id
+    self.queue: asyncio.Queue[dict] = asyncio.Queue(queue_size)
+    # 因消费过慢被断开
+    self.closed = False
+
+  def matches(self, conversation_id: str, message_id: str) -> bool:
+    if self.conversation_id is not None and self.conversation_id != conversation_id:
+      return False
+    return self.message_id is None or self.message_id == message_id
+
+  async def get(self, timeout: float | None = None) -> dict | None:
+    """
+    获取下一个事件，超时返回 None
+    订阅已被断开时抛出 ConnectionError
+    """
+    if self.closed:
+      raise ConnectionError("事件消费过慢，订阅已断开")
+    try:
+      event = await asyncio.wait_for(self.queue.get(), timeout)
+    except asyncio.TimeoutError:
+      return None
+    if self.closed:
+      raise ConnectionError("事件消费过慢，订阅已断开")
+    return event
+
+
+class TaskEventBus:
+  """任务事件总线"""
+
+  def __init__(self, queue_size: int = TASK_EVENT_QUEUE_SIZE):
+    self.queue_size = queue_size
+    # 按过滤条件索引订阅者: (conversation_id, message_id) / conversation_id / 全部
+    self._by_task: dict[tuple[str, str], set[Subscription]] = {}
+    self._by_conversation: dict[str, set[Subscription]] = {}
+    self._all: set[Subscription] = set()
+    self._count = 0
+    self._loop: asyncio.AbstractEventLoop | None = None
+    self._counters = {
+      "published": 0,
+      "delivered": 0,
+      "disconnected": 0,
+    }
+
+  def subscribe(self, conversation_id: str | None = None, message_id: str | None = None) -> Subscription:
+    """订阅事件，需在事件循环中调用"""
+    self._loop = asyncio.get_running_loop()
+    subscription = Subscription(conversation_id, message_id, self.queue_size)
+    self._bucket(subscription, create=True).add(subscription)
+    self._count += 1
+    return subscription
+
+  def _bucket(self, subscription: Subscription, create: bool = False) -> set[Subscription]:
+    if subscription.conversation_id is None:
+      return self._all
+    if subscription.message_id is None:
+      index, key = self._by_conversation, subscription.conversation_id
+    else:
+      index, key = self._by_task, (subscription.conversation_id, subscription.message_id)
+    if create:
+      return index.setdefault(key, set())
+    return index.get(key, set())
+
+  def unsubscribe(self, subscription: Subscription):
+    bucket = self._bucket(subscription)
+    if subscription in bucket:
+      bucket.discard(subscription)
+      self._count -= 1
+      # 清理空的索引项
+      if not bucket and bucket is not self._all:
+        if subscription.message_id is None:
+          self._by_conversation.pop(subscription.conversation_id, None)
+        else:
+          self._by_task.pop((subscription.conversation_id, subscription.message_id), None)
+
+  async def wait_for_update(self, conversation_id: str | None, message_id: str | None, load: Callable, is_fresh: Callable, timeout: float):
+    """
+    长轮询：load() 的结果满足 is_fresh 或超时后返回最新结果
+    load 返回 awaitable（存储读取在存储线程中执行）
+    先订阅再读取，避免读取和订阅之间发生的变化丢失
+    """
+    subscription = self.subscribe(conversation_id, message_id)
+    try:
+      loop = asyncio.get_running_loop()
+      deadline = loop.time() + min(timeout, LONG_POLL_MAX_WAIT)
+      result = await load()
+      while not is_fresh(result) and (remaining := deadline - loop.time()) > 0:
+        try:
+          if await subscription.get(remaining) is None:
+            break
+        except ConnectionError:
+          pass
+        result = await load()
+        if subscription.closed:
+          break
+      return result
+    finally:
+      self.unsubscribe(subscription)
+
+  def publish_task(self, task):
+    """发布任务状态变化，可在任意线程调用"""
+    if not self._count:
+      return
+    try:
+      running = asyncio.get_running_loop()
+    except RuntimeError:
+      running = None
+    if running is self._loop:
+      self._dispatch(task)
+    elif self._loop is not None and not self._loop.is_closed():
+      self._loop.call_soon_threadsafe(self._dispatch, task.copy())
+
+  def _dispatch(self, task):
+    targets = [
+      *self._all,
+      *self._by_conversation.get(task.conversation_id, ()),
+      *self._by_task.get((task.conversation_id, task.message_id), ()),
+    ]
+    if not targets:
+      return
+    self._counters["published"] += 1
+    event = {"event": task.status, "task": task.to_dict()}
+    for subscription in targets:
+      try:
+        subscription.queue.put_nowait(event)
+        self._counters["delivered"] += 1
+      except asyncio.QueueFull:
+        subscription.closed = True
+        self.unsubscribe(subscription)
+        self._counters["disconnected"] += 1
+        logger.warning(f"任务事件订阅者消费过慢，已断开: conversation_id={subscription.conversation_id}, message_id={subscription.message_id}")
+
+  def stats(self) -> dict:
+    return {"subscribers": self._count, **self._counters}
+
+
+task_events = TaskEventBus()
+
+__all__ = ["TaskEventBus", "Subscription", "task_events", "parse_since", "updated_since"]
@@ -0,0 +1,72 @@
+"""
+出站地址检查
+服务端代替客户端请求的地址（回调地址、附件链接）只允许公网地址，防止借服务端访问内网服务：
+- 主机解析到的任一地址是内网、回环、链路本地、保留或组播地址时拒绝
+- 请求直接连接检查过的 IP（Host 请求头和 HTTPS SNI 仍使用原主机名），
+  避免检查和连接时两次解析结果不同（DNS rebinding）
+- allowed_hosts 中的主机不检查，按原地址请求
+"""
+import asyncio
+import ipaddress
+import socket
+from urllib.parse import urlsplit, urlunsplit
+import httpx
+
+
+def parse_allowed_hosts(value: str) -> frozenset:
+  """解析逗号分隔的主机白名单"""
+  return frozenset(h.strip().lower() for h in value.split(",") if h.strip())
+
+
+def is_public_address(address: str) -> bool:
+  ip = ipaddress.ip_address(address.split("%", 1)[0])
+  if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+    ip = ip.ipv4_mapped
+  return ip.is_global and not ip.is_multicast
+
+
+async def resolve_public_url(url: str, allowed_hosts: frozenset = frozenset()) -> str | None:
+  """
+  检查地址并返回用于连接的公网 IP，白名单主机返回 None
+  地址不可用时抛出 ValueError，域名解析失败时抛出 OSError
+  """
+  parts = urlsplit(url)
+  if parts.scheme not in ("http", "https") or not parts.hostname:
+    raise ValueError("必须是 http 或 https 地址")
+  host = parts.hostname.lower()
+  if host in allowed_hosts:
+    return None
+  port = parts.port or (443 if parts.scheme == "https" else 80)
+  infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+  if not infos:
+    raise OSError(f"{host} 没有可用地址")
+  for *_, sockaddr in infos:
+    if not is_public_address(sockaddr[0]):
+      raise ValueError(f"{host} 解析到非公网地址 {sockaddr[0]}")
+  return infos[0][4][0]
+
+
+async def build_pinned_request(
+  client: httpx.AsyncClient,
+  method: str,
+  url: str,
+  allowed_hosts: frozenset = frozenset(),
+  headers: dict | None = None,
+  **kwargs
+) -> httpx.Request:
+  """检查地址并构造直接连接检查过的 IP 的请求，异常同 resolve_public_url"""
+  address = await resolve_public_url(url, allowed_hosts)
+  if address is None:
+    return client.build_request(method, url, headers=headers, **kwargs)
+  parts = urlsplit(url)
+  netloc = f"[{address}]" if ":" in address else address
+  if parts.port:
+    netloc += f":{parts.port}"
+  headers = {**(headers or {}), "Host": parts.netloc.rsplit("@", 1)[-1]}
+  extensions = {"sni_hostname": parts.hostname} if parts.scheme == "https" else None
+  return client.build_request(
+    method, urlunsplit(parts._replace(netloc=netloc)), headers=headers, extensions=extensions, **kwargs
+  )
+
+
+__all__ = ["parse_allowed_hosts", "is_public_address", "resolve_public_url", "build_pinned_request"]
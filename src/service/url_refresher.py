@@ -0,0 +1,203 @@
+"""
+视频链接过期刷新
+douyinvod 链接带过期时间（见 video_urls.url_expires_at），过期后无法播放：
+- 后台定期查找即将过期（VIDEO_URL_REFRESH_AHEAD 秒内）的已完成任务，按会话分组刷新，
+  一次拉取会话消息即可刷新该会话中的多个任务
+- 后台刷新为低优先级：逐个会话进行，请求之间按 VIDEO_URL_REFRESH_RATE 限速，调度器探测已满时等待
+- 后台刷新只能找到会话最近 MESSAGE_BATCH_SIZE 条消息中的任务（见 video_resolver），
+  更早的任务按失败退避，只在查询时按需刷新
+- 查询到链接已过期的任务时按需刷新，同一会话的并发刷新合并为一次
+"""
+import asyncio
+import os
+import time
+from loguru import logger
+from src.service.video_storage import VideoStorage, VideoTask
+from src.service.video_resolver import fetch_conversation_video_urls, resolve_video_url
+from src.service.video_scheduler import video_scheduler
+from src.service.video_urls import video_urls_expire_at
+
+
+# 链接在该时间（秒）内过期时提前刷新
+VIDEO_URL_REFRESH_AHEAD = int(os.getenv("VIDEO_URL_REFRESH_AHEAD", "600"))
+# 后台刷新的检查间隔（秒），0 表示关闭后台刷新
+VIDEO_URL_REFRESH_INTERVAL = int(os.getenv("VIDEO_URL_REFRESH_INTERVAL", "60"))
+# 每轮最多检查的任务数
+VIDEO_URL_REFRESH_BATCH = int(os.getenv("VIDEO_URL_REFRESH_BATCH", "100"))
+# 后台刷新每秒最多请求的会话数
+VIDEO_URL_REFRESH_RATE = float(os.getenv("VIDEO_URL_REFRESH_RATE", "1"))
+# 过期超过该时间（秒）的链接不再后台刷新，只在查询时按需刷新
+VIDEO_URL_REFRESH_MAX_EXPIRED = int(os.getenv("VIDEO_URL_REFRESH_MAX_EXPIRED", "86400"))
+# 刷新失败后的等待时间（秒），连续失败时加倍，上限 VIDEO_URL_REFRESH_MAX_EXPIRED
+VIDEO_URL_REFRESH_BACKOFF = 300
+# 同一任务两次按需刷新的最小间隔（秒），避免客户端轮询已无法刷新的任务时反复请求
+ON_DEMAND_COOLDOWN = 60
+# 距离过期不足该时间（秒）的链接视为已过期
+EXPIRY_MARGIN = 30
+
+
+def is_expired(task: VideoTask, now: float | None = None) -> bool:
+  """已完成任务的视频链接是否已过期（或即将过期）"""
+  if task.status != "completed" or (expires := task.urls_expire_at) is None:
+    return False
+  return expires - EXPIRY_MARGIN <= (time.time() if now is None else now)
+
+
+class UrlRefresher:
+  """视频链接刷新"""
+
+  def __init__(self):
+    self._runner: asyncio.Task | None = None
+    # 进行中的会话刷新，按需刷新和后台刷新共用
+    self._inflight: dict[str, asyncio.Future] = {}
+    # 任务 -> (下次可刷新时间, 当前等待时间)
+    self._backoff: dict[tuple[str, str], tuple[float, float]] = {}
+    self._on_demand_at: dict[tuple[str, str], float] = {}
+    self._counters = {
+      "rounds": 0,
+      "requests": 0,
+      "refreshed": 0,
+      "failed": 0,
+      "on_demand": 0,
+    }
+
+  def start(self):
+    """启动后台刷新（已启动或已关闭时直接返回）"""
+    if VIDEO_URL_REFRESH_INTERVAL > 0 and (self._runner is None or self._runner.done()):
+      self._runner = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self._runner:
+      self._runner.cancel()
+      self._runner = None
+    pending = list(self._inflight.values())
+    for future in pending:
+      future.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+  def _failed(self, key: tuple[str, str], now: float):
+    _, delay = self._backoff.get(key, (0.0, VIDEO_URL_REFRESH_BACKOFF / 2))
+    delay = min(delay * 2, VIDEO_URL_REFRESH_MAX_EXPIRED)
+    self._backoff[key] = (now + delay, delay)
+    self._counters["failed"] += 1
+
+  async def _refresh_conversation(self, conversation_id: str) -> dict[str, VideoTask]:
+    """刷新会话中所有即将过期的任务，返回 {message_id: 刷新后的任务}"""
+    now = time.time()
+    tasks = [
+      task for task in await VideoStorage.get_tasks_by_conversation_async(conversation_id)
+      if task.status == "completed" and (expires := task.urls_expire_at) is not None and expires < now + VIDEO_URL_REFRESH_AHEAD
+    ]
+    if not tasks:
+      return {}
+    self._counters["requests"] += 1
+    try:
+      found = await fetch_conversation_video_urls(conversation_id, [task.message_id for task in tasks])
+    except Exception as e:
+      logger.warning(f"视频链接刷新失败: {conversation_id} - {str(e)}")
+      found = {}
+    refreshed = {}
+    for task in tasks:
+      key = (task.conversation_id, task.message_id)
+      urls = found.get(task.message_id)
+      # 新链接的过期时间需要晚于旧链接，否则视为刷新失败
+      if urls and (video_urls_expire_at(urls) or float("inf")) > task.urls_expire_at:
+        task.video_urls = tuple(urls)
+        await VideoStorage.save_task_async(task)
+        refreshed[task.message_id] = task
+        self._backoff.pop(key, None)
+        self._counters["refreshed"] += 1
+      else:
+        self._failed(key, now)
+    if refreshed:
+      logger.info(f"视频链接已刷新: {conversation_id} - {len(refreshed)}/{len(tasks)} 个任务")
+    return refreshed
+
+  async def refresh_conversation(self, conversation_id: str) -> dict[str, VideoTask]:
+    """刷新会话中即将过期的任务，同一会话进行中的刷新直接复用"""
+    future = self._inflight.get(conversation_id)
+    if future is None:
+      future = asyncio.ensure_future(self._refresh_conversation(conversation_id))
+      self._inflight[conversation_id] = future
+      future.add_done_callback(lambda _: self._inflight.pop(conversation_id, None))
+    return await asyncio.shield(future)
+
+  async def ensure_fresh(self, task: VideoTask, timeout: int = 15000) -> VideoTask:
+    """
+    链接已过期时按需刷新，返回刷新后的任务（无法刷新时返回原任务）
+    会话最近的消息中找不到该任务时，回退到完整解析（可能使用浏览器），
+    解析只限定在该任务的消息内，找不到该消息时保留原链接
+    """
+    if not is_expired(task) or not task.message_id:
+      return task
+    key = (task.conversation_id, task.message_id)
+    now = time.time()
+    if now - self._on_demand_at.get(key, 0.0) < ON_DEMAND_COOLDOWN:
+      return task
+    self._on_demand_at[key] = now
+    self._counters["on_demand"] += 1
+    refreshed = await self.refresh_conversation(task.conversation_id)
+    if task.message_id in refreshed:
+      self._on_demand_at.pop(key, None)
+      return refreshed[task.message_id]
+    try:
+      result = await resolve_video_url(task.conversation_id, message_id=task.message_id, timeout=timeout)
+    except Exception as e:
+      logger.warning(f"视频链接按需刷新失败: {task.conversation_id} - {str(e)}")
+      return task
+    urls = result.get("video_urls") if result.get("success") else None
+    # 与后台刷新相同，新链接的过期时间需要晚于旧链接
+    if urls and (video_urls_expire_at(urls) or float("inf")) > task.urls_expire_at:
+      task.video_urls = tuple(urls)
+      await VideoStorage.save_task_async(task)
+      self._backoff.pop(key, None)
+      self._on_demand_at.pop(key, None)
+      self._counters["refreshed"] += 1
+    return task
+
+  async def _round(self):
+    """一轮后台刷新：按会话分组，过期越早的会话越先刷新"""
+    now = time.time()
+    # 无法刷新的任务过期时间最早、总是排在最前面，先跳过退避中的任务再取满一批，否则其他任务永远轮不到
+    tasks, after_key = [], None
+    while len(tasks) < VIDEO_URL_REFRESH_BATCH:
+      page = await VideoStorage.get_expiring_tasks_async(
+        now - VIDEO_URL_REFRESH_MAX_EXPIRED, now + VIDEO_URL_REFRESH_AHEAD, VIDEO_URL_REFRESH_BATCH, after_key
+      )
+      tasks += [task for task in page if self._backoff.get((task.conversation_id, task.message_id), (0.0,))[0] <= now]
+      if len(page) < VIDEO_URL_REFRESH_BATCH:
+        break
+      last = page[-1]
+      after_key = (last.urls_expire_at, last.conversation_id, last.message_id)
+    conversations = dict.fromkeys(task.conversation_id for task in tasks[:VIDEO_URL_REFRESH_BATCH])
+    self._counters["rounds"] += 1
+    for conversation_id in conversations:
+      # 调度器的探测已满时让出，优先完成正在生成的视频
+      while video_scheduler.busy:
+        await asyncio.sleep(1)
+      await self.refresh_conversation(conversation_id)
+      await asyncio.sleep(1 / VIDEO_URL_REFRESH_RATE)
+    # 清理过期的退避和按需刷新记录（退避记录多保留一个等待周期，连续失败时才能继续加倍）
+    self._backoff = {key: value for key, value in self._backoff.items() if value[0] + value[1] > now}
+    self._on_demand_at = {key: at for key, at in self._on_demand_at.items() if now - at < ON_DEMAND_COOLDOWN}
+
+  async def _run(self):
+    while True:
+      try:
+        await self._round()
+      except Exception as e:
+        logger.warning(f"视频链接后台刷新出错: {str(e)}")
+      await asyncio.sleep(VIDEO_URL_REFRESH_INTERVAL)
+
+  def stats(self) -> dict:
+    return {
+      "running": bool(self._runner and not self._runner.done()),
+      "in_flight": len(self._inflight),
+      "backoff": len(self._backoff),
+      **self._counters,
+    }
+
+
+url_refresher = UrlRefresher()
+
+__all__ = ["UrlRefresher", "url_refresher", "is_expired"]
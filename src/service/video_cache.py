@@ -0,0 +1,307 @@
+"""
+视频本地缓存
+开启后（VIDEO_CACHE_ENABLED=1）把已完成任务的视频下载到本地目录，由 /api/video/file 提供稳定的播放链接：
+- 任务完成时预先下载，访问时未缓存的视频按需下载，同一视频的并发请求合并为一次下载
+- 同时进行的下载数量由 VIDEO_CACHE_CONCURRENCY 限制
+- 下载中断后保留 .part 文件，下次通过 Range 请求从断点继续；.meta 文件记录源文件的 ETag / Last-Modified
+  和视频版本，续传时用 If-Range 校验，源文件或视频版本变化时从头下载，避免拼接出不同版本的文件
+- 缓存总大小超过 VIDEO_CACHE_MAX_BYTES 时按最近访问时间淘汰（访问时更新文件修改时间，重启后顺序不丢失）
+- 文件由 FileResponse 发送，支持 Range 请求，服务器支持 pathsend 扩展时零拷贝发送
+"""
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+import httpx
+from loguru import logger
+from src.service.task_events import task_events
+from src.service.url_refresher import url_refresher
+from src.service.video_storage import VideoStorage, VideoTask
+from src.service.video_urls import video_asset_key, variant_rank
+
+
+# 是否开启本地缓存
+VIDEO_CACHE_ENABLED = os.getenv("VIDEO_CACHE_ENABLED", "0") != "0"
+# 缓存目录
+VIDEO_CACHE_DIR = Path(os.getenv("VIDEO_CACHE_DIR", "video_cache"))
+# 缓存总大小上限（字节），默认 10GB
+VIDEO_CACHE_MAX_BYTES = int(os.getenv("VIDEO_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+# 同时进行的下载数量上限
+VIDEO_CACHE_CONCURRENCY = int(os.getenv("VIDEO_CACHE_CONCURRENCY", "2"))
+# 任务完成时是否预先下载
+VIDEO_CACHE_PREFETCH = os.getenv("VIDEO_CACHE_PREFETCH", "1") != "0"
+# 访问未缓存的视频时最多等待下载的时间（秒），超时后重定向到原链接
+VIDEO_CACHE_WAIT = float(os.getenv("VIDEO_CACHE_WAIT", "30"))
+# 下载读取超时（秒）
+VIDEO_CACHE_TIMEOUT = 30
+
+
+def cache_name(conversation_id: str, message_id: str, index: int) -> str:
+  """缓存文件名，由任务和视频序号生成（不直接使用请求参数拼接路径）"""
+  return hashlib.sha1(f"{conversation_id}/{message_id}/{index}".encode()).hexdigest() + ".mp4"
+
+
+def _content_total(response: httpx.Response) -> int | None:
+  """响应对应的完整文件大小，未知时返回 None"""
+  if response.status_code == 206:
+    total = response.headers.get("content-range", "").rpartition("/")[2]
+  else:
+    total = response.headers.get("content-length", "")
+  return int(total) if total.isdigit() else None
+
+
+def _validator(headers) -> str | None:
+  """If-Range 可用的校验值：强 ETag 优先，其次 Last-Modified（弱 ETag 不能用于 If-Range）"""
+  etag = headers.get("etag")
+  if etag and not etag.startswith("W/"):
+    return etag
+  return headers.get("last-modified")
+
+
+def _part_meta(url: str, headers) -> dict:
+  """.part 文件的来源信息，视频版本不含过期时间（刷新后的链接仍是同一版本）"""
+  return {
+    "url": url,
+    "asset": video_asset_key(url),
+    "variant": list(variant_rank(url)[:2]),
+    "validator": _validator(headers),
+  }
+
+
+def _resume_validator(meta: dict | None, url: str) -> str | None:
+  """.part 文件可以续传时返回 If-Range 校验值，来源信息缺失、没有校验值或视频版本不同时返回 None"""
+  if not meta or not meta.get("validator"):
+    return None
+  if meta.get("asset") != video_asset_key(url) or meta.get("variant") != list(variant_rank(url)[:2]):
+    return None
+  return meta["validator"]
+
+
+class VideoCache:
+  """视频本地缓存，按字节数做 LRU 淘汰"""
+
+  def __init__(self, directory: Path = VIDEO_CACHE_DIR, max_bytes: int = VIDEO_CACHE_MAX_BYTES, concurrency: int = VIDEO_CACHE_CONCURRENCY, enabled: bool = VIDEO_CACHE_ENABLED):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.enabled = enabled
+    # 文件名 -> 大小，按最近访问时间排序（最早的在前）
+    self._entries: OrderedDict[str, int] = OrderedDict()
+    self._bytes = 0
+    self._loaded = False
+    self._semaphore = asyncio.Semaphore(concurrency)
+    self._inflight: dict[str, asyncio.Future] = {}
+    self._prefetches: set[asyncio.Task] = set()
+    self._client: httpx.AsyncClient | None = None
+    self._runner: asyncio.Task | None = None
+    self._counters = {
+      "hits": 0,
+      "misses": 0,
+      "downloads": 0,
+      "resumed": 0,
+      "failed": 0,
+      "downloaded_bytes": 0,
+      "evicted": 0,
+    }
+
+  def _load(self):
+    """扫描缓存目录，按修改时间恢复访问顺序"""
+    if self._loaded:
+      return
+    self.directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for path in self.directory.glob("*.mp4"):
+      try:
+        stat = path.stat()
+      except OSError:
+        continue
+      files.append((stat.st_mtime, path.name, stat.st_size))
+    for _, name, size in sorted(files):
+      self._entries[name] = size
+      self._bytes += size
+    self._loaded = True
+    self._evict()
+
+  def _evict(self, keep: str | None = None):
+    """超过大小上限时删除最久未访问的文件，keep 为刚下载的文件，不删除"""
+    skipped = []
+    while self._bytes > self.max_bytes and self._entries:
+      name, size = self._entries.popitem(last=False)
+      if name == keep:
+        skipped.append((name, size))
+        continue
+      try:
+        (self.directory / name).unlink(missing_ok=True)
+      except OSError as e:
+        # 文件正在被发送时部分系统（Windows）无法删除，下次再淘汰
+        logger.warning(f"视频缓存淘汰失败: {name} - {str(e)}")
+        skipped.append((name, size))
+        continue
+      self._bytes -= size
+      self._counters["evicted"] += 1
+    for name, size in reversed(skipped):
+      self._entries[name] = size
+      self._entries.move_to_end(name, last=False)
+
+  def lookup(self, conversation_id: str, message_id: str, index: int) -> Path | None:
+    """已缓存时返回文件路径并更新访问顺序，否则返回 None"""
+    self._load()
+    name = cache_name(conversation_id, message_id, index)
+    if name not in self._entries:
+      return None
+    path = self.directory / name
+    try:
+      os.utime(path)
+    except OSError:
+      # 文件已被外部删除
+      self._bytes -= self._entries.pop(name)
+      return None
+    self._entries.move_to_end(name)
+    return path
+
+  async def fetch(self, task: VideoTask, index: int) -> Path:
+    """返回视频的本地文件，未缓存时下载，同一视频进行中的下载直接复用"""
+    path = self.lookup(task.conversation_id, task.message_id, index)
+    if path is not None:
+      self._counters["hits"] += 1
+      return path
+    self._counters["misses"] += 1
+    name = cache_name(task.conversation_id, task.message_id, index)
+    future = self._inflight.get(name)
+    if future is None:
+      future = asyncio.ensure_future(self._download(task, index, name))
+      self._inflight[name] = future
+      future.add_done_callback(lambda _: self._inflight.pop(name, None))
+    return await asyncio.shield(future)
+
+  async def _download(self, task: VideoTask, index: int, name: str) -> Path:
+    path = self.directory / name
+    part = path.with_suffix(".part")
+    meta_path = path.with_suffix(".meta")
+    async with self._semaphore:
+      # 排队期间链接可能已过期
+      task = await url_refresher.ensure_fresh(task)
+      if index >= len(task.video_urls):
+        raise LookupError(f"视频不存在: {task.conversation_id} - {task.message_id} #{index}")
+      if self._client is None:
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(VIDEO_CACHE_TIMEOUT), follow_redirects=True)
+      url = task.video_urls[index]
+      offset = part.stat().st_size if part.exists() else 0
+      validator = None
+      if offset:
+        try:
+          validator = _resume_validator(json.loads(meta_path.read_text(encoding="utf-8")), url)
+        except (OSError, ValueError):
+          pass
+      # 无法确认 .part 文件与当前视频是同一文件时从头下载
+      headers = {"Range": f"bytes={offset}-", "If-Range": validator} if validator else {}
+      try:
+        async with self._client.stream("GET", url, headers=headers) as response:
+          if response.status_code == 416:
+            # .part 文件与当前视频不一致，删除后下次从头下载
+            self._discard_part(part, meta_path)
+            response.raise_for_status()
+          if validator and response.status_code == 206 and response.headers.get("content-range", "").startswith(f"bytes {offset}-"):
+            if (current := _validator(response.headers)) is not None and current != validator:
+              # 服务端忽略了 If-Range，返回的是已变化文件的片段
+              self._discard_part(part, meta_path)
+              raise IOError("源文件已变化，无法续传")
+            mode = "ab"
+            self._counters["resumed"] += 1
+          elif response.status_code == 200:
+            # 首次下载、源文件已变化（If-Range 不匹配）或服务端不支持断点续传时从头下载
+            mode = "wb"
+            meta_path.write_text(json.dumps(_part_meta(url, response.headers)), encoding="utf-8")
+          else:
+            response.raise_for_status()
+            raise httpx.HTTPStatusError(f"意外的响应: HTTP {response.status_code}", request=response.request, response=response)
+          total = _content_total(response)
+          with open(part, mode) as f:
+            # 按收到的数据写入，连接中断时已收到的部分都保留在 .part 文件中
+            async for chunk in response.aiter_bytes():
+              f.write(chunk)
+              self._counters["downloaded_bytes"] += len(chunk)
+        size = part.stat().st_size
+        if total is not None and size != total:
+          raise IOError(f"下载不完整: {size}/{total} 字节")
+      except Exception as e:
+        self._counters["failed"] += 1
+        logger.warning(f"视频缓存下载失败: {task.conversation_id} - {task.message_id} #{index} - {type(e).__name__}: {str(e)}")
+        raise
+    os.replace(part, path)
+    meta_path.unlink(missing_ok=True)
+    self._load()
+    self._entries[name] = size
+    self._bytes += size
+    self._counters["downloads"] += 1
+    self._evict(keep=name)
+    logger.info(f"视频已缓存: {task.conversation_id} - {task.message_id} #{index} ({size} 字节)")
+    return path
+
+  @staticmethod
+  def _discard_part(part: Path, meta_path: Path):
+    part.unlink(missing_ok=True)
+    meta_path.unlink(missing_ok=True)
+
+  def prefetch(self, task: VideoTask):
+    """后台下载任务的全部视频，失败时忽略（访问时会重新下载）"""
+    for index in range(len(task.video_urls)):
+      if self.lookup(task.conversation_id, task.message_id, index) is not None:
+        continue
+      prefetch = asyncio.create_task(self.fetch(task, index))
+      prefetch.add_done_callback(lambda t: t.cancelled() or t.exception())
+      self._prefetches.add(prefetch)
+      prefetch.add_done_callback(self._prefetches.discard)
+
+  async def _run(self):
+    """订阅任务事件，任务完成时预先下载"""
+    while True:
+      subscription = task_events.subscribe()
+      try:
+        while True:
+          event = await subscription.get()
+          if event and event["event"] == "completed":
+            task = await VideoStorage.get_task_async(event["task"]["conversation_id"], event["task"]["message_id"])
+            if task is not None and task.status == "completed":
+              self.prefetch(task)
+      except ConnectionError:
+        continue
+      finally:
+        task_events.unsubscribe(subscription)
+
+  def start(self):
+    """开启缓存时启动预先下载（已启动时直接返回）"""
+    if not self.enabled:
+      return
+    self._load()
+    if VIDEO_CACHE_PREFETCH and (self._runner is None or self._runner.done()):
+      self._runner = asyncio.create_task(self._run())
+
+  async def stop(self):
+    """停止下载，未完成的 .part 文件保留，下次从断点继续"""
+    if self._runner:
+      self._runner.cancel()
+      self._runner = None
+    pending = [*self._prefetches, *self._inflight.values()]
+    for future in pending:
+      future.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+  def stats(self) -> dict:
+    return {
+      "enabled": self.enabled,
+      "files": len(self._entries),
+      "bytes": self._bytes,
+      "max_bytes": self.max_bytes,
+      "downloading": len(self._inflight),
+      **self._counters,
+    }
+
+
+video_cache = VideoCache()
+
+__all__ = ["VideoCache", "video_cache", "cache_name"]
@@ -0,0 +1,121 @@
+"""
+视频链接解析服务（无浏览器）
+直接通过 HTTP 请求会话消息数据（即页面 XHR 加载的同一份数据），从中解析视频播放信息，
+解析不到时回退到 Playwright 渲染页面获取
+只拉取会话最近的 MESSAGE_BATCH_SIZE 条消息（不向前翻页），更早的消息在 HTTP 解析中找不到
+"""
+import os
+import time
+import httpx
+from loguru import logger
+from src.pool.session_pool import session_pool
+from src.service.video_service import get_video_url
+from src.service.video_urls import extract_video_job, extract_message_video_urls
+
+
+# 会话消息列表接口，可通过环境变量覆盖（便于本地替身测试）
+MESSAGE_LIST_URL = os.getenv("DOUBAO_MESSAGE_LIST_URL", "https://www.doubao.com/samantha/message/list")
+# 拉取的会话最近消息条数，更早的消息不会拉取（服务端可能限制上限）
+MESSAGE_BATCH_SIZE = int(os.getenv("DOUBAO_MESSAGE_BATCH_SIZE", "20"))
+
+_client: httpx.AsyncClient | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+  global _client
+  if _client is None:
+    _client = httpx.AsyncClient(limits=httpx.Limits(max_connections=50, max_keepalive_connections=10))
+  return _client
+
+
+async def close_client():
+  """关闭共享连接池"""
+  global _client
+  if _client is not None:
+    await _client.aclose()
+    _client = None
+
+
+async def _fetch_messages(conversation_id: str, timeout: int) -> dict:
+  """拉取会话最近 MESSAGE_BATCH_SIZE 条消息的数据（即页面 XHR 首次加载的同一份数据）"""
+  session = session_pool.get_session(conversation_id) or session_pool.get_session()
+  if not session:
+    raise Exception("无可用的 session 配置")
+
+  params = {
+    "aid": "497858",
+    "device_id": session.device_id,
+    "device_platform": "web",
+    "language": "zh",
+    "pc_version": "2.23.2",
+    "pkg_type": "release_version",
+    "real_aid": "497858",
+    "region": "CN",
+    "samantha_web": "1",
+    "sys_region": "CN",
+    "tea_uuid": session.tea_uuid,
+    "use-olympus-account": "1",
+    "version_code": "20800",
+    "web_id": session.web_id,
+  }
+  headers = {
+    "content-type": "application/json",
+    "cookie": session.cookie,
+    "origin": "https://www.doubao.com",
+    "referer": f"https://www.doubao.com/chat/{conversation_id}",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36 Edg/137.0.0.0",
+  }
+  body = {
+    "conversation_id": conversation_id,
+    "cursor": "",
+    "batch_size": MESSAGE_BATCH_SIZE,
+  }
+  response = await _get_client().post(MESSAGE_LIST_URL, params=params, headers=headers, json=body, timeout=timeout / 1000)
+  if response.status_code != 200:
+    raise Exception(f"获取会话消息失败: HTTP {response.status_code}")
+  return response.json()
+
+
+async def fetch_video_urls(conversation_id: str, message_id: str | None = None, timeout: int = 15000) -> dict:
+  """
+  通过一次 HTTP 请求获取会话消息数据并解析视频链接
+  返回结果中的 job 为该消息的视频任务标识和状态字段，可用于轻量的状态检查
+  """
+  job = extract_video_job(await _fetch_messages(conversation_id, timeout), message_id)
+  video_urls = job.pop('video_urls', [])
+  return {
+    'success': True,
+    'conversation_id': conversation_id,
+    'video_count': len(video_urls),
+    'video_urls': video_urls,
+    'job': job
+  }
+
+
+async def fetch_conversation_video_urls(conversation_id: str, message_ids, timeout: int = 15000) -> dict[str, list[str]]:
+  """
+  一次 HTTP 请求获取同一会话中多条消息的视频链接，返回 {message_id: 视频链接}
+  只覆盖会话最近的 MESSAGE_BATCH_SIZE 条消息，更早的或找不到的消息不在结果中，
+  调用方需要自行处理（url_refresher 后台刷新视为失败并退避，按需刷新时回退到 resolve_video_url）
+  """
+  return extract_message_video_urls(await _fetch_messages(conversation_id, timeout), message_ids)
+
+
+async def resolve_video_url(conversation_id: str, message_id: str | None = None, timeout: int = 15000) -> dict:
+  """
+  获取视频链接：优先通过 HTTP 解析消息数据，未解析到时回退到浏览器
+  返回结构与 get_video_url 一致
+  """
+  start = time.perf_counter()
+  try:
+    result = await fetch_video_urls(conversation_id, message_id, timeout)
+    if result['video_urls']:
+      logger.info(f"HTTP 解析到 {result['video_count']} 个视频URL, 耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
+      return result
+    logger.info("HTTP 未解析到视频URL，回退到浏览器获取")
+  except Exception as e:
+    logger.warning(f"HTTP 解析视频URL失败，回退到浏览器获取: {str(e)}")
+  return await get_video_url(conversation_id, message_id, timeout)
+
+
+__all__ = ['resolve_video_url', 'fetch_video_urls', 'fetch_conversation_video_urls', 'close_client']
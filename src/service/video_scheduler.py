@@ -0,0 +1,422 @@
+"""
+视频任务调度器
+用一个定时堆统一调度所有视频任务的探测，替代每个任务一个休眠协程：
+- 限制同时进行的探测数量，轻量状态检查单独限制，不占用浏览器探测的名额
+- 相同 (conversation_id, message_id) 的任务去重
+- 支持取消任务
+- 导出队列深度和探测耗时
+- 按历史完成耗时分布自适应安排探测时间（见 probe_policy）
+- 探测间隙内用单次 HTTP 请求做轻量状态检查，视频就绪后数秒内完成任务
+- 服务启动时恢复存储中未完成的任务
+- 任务完成或失败时投递回调（见 webhooks）
+- 任务状态变化记录到变更流（见 change_feed）
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import deque
+from loguru import logger
+from src.service.probe_policy import ProbePolicy
+from src.service.video_storage import VideoStorage, VideoTask
+from src.service.video_resolver import resolve_video_url, fetch_video_urls
+from src.service.webhooks import webhook_dispatcher
+
+
+# 首次探测前的等待时间（秒），历史样本不足时使用
+VIDEO_FIRST_PROBE_DELAY = int(os.getenv("VIDEO_FIRST_PROBE_DELAY", "180"))
+# 两次探测之间的间隔（秒），历史样本不足时使用
+VIDEO_PROBE_INTERVAL = int(os.getenv("VIDEO_PROBE_INTERVAL", "180"))
+# 同时进行的探测数量上限
+VIDEO_PROBE_CONCURRENCY = int(os.getenv("VIDEO_PROBE_CONCURRENCY", "4"))
+# 同时进行的轻量状态检查数量上限
+VIDEO_STATUS_CHECK_CONCURRENCY = int(os.getenv("VIDEO_STATUS_CHECK_CONCURRENCY", "16"))
+# 轻量状态检查间隔（秒），0 表示关闭
+VIDEO_STATUS_CHECK_INTERVAL = int(os.getenv("VIDEO_STATUS_CHECK_INTERVAL", "10"))
+# 任务创建后进行轻量状态检查的时长（秒），之后只按探测策略探测
+VIDEO_STATUS_CHECK_WINDOW = int(os.getenv("VIDEO_STATUS_CHECK_WINDOW", "1200"))
+# 启动恢复任务时每秒最多安排的探测数，避免重启后大量任务同时探测
+VIDEO_RECOVERY_RATE = float(os.getenv("VIDEO_RECOVERY_RATE", "2"))
+# 启动恢复任务时每次读取的任务数
+VIDEO_RECOVERY_PAGE_SIZE = 500
+# 指标保留的最近样本数
+METRICS_WINDOW = 200
+
+
+class _ScheduledTask:
+  """调度中的视频任务"""
+  __slots__ = ("conversation_id", "message_id", "timeout", "due", "full_due", "check_from", "check_until", "probe", "cancelled")
+
+  def __init__(self, conversation_id: str, message_id: str, timeout: int, due: float):
+    self.conversation_id = conversation_id
+    self.message_id = message_id
+    self.timeout = timeout
+    self.due = due
+    # 下一次完整探测（HTTP + 浏览器回退）的时间，在此之前只做轻量状态检查
+    self.full_due = due
+    # 轻量状态检查的时间窗口
+    self.check_from = 0.0
+    self.check_until = 0.0
+    self.probe: asyncio.Task | None = None
+    self.cancelled = False
+
+
+def _task_key(conversation_id: str, message_id: str) -> str:
+  return f"{conversation_id}_{message_id}"
+
+
+class VideoTaskScheduler:
+  """视频任务调度器"""
+
+  def __init__(
+    self,
+    max_concurrent_probes: int = VIDEO_PROBE_CONCURRENCY,
+    probe_interval: int = VIDEO_PROBE_INTERVAL,
+    max_concurrent_checks: int = VIDEO_STATUS_CHECK_CONCURRENCY
+  ):
+    self.max_concurrent_probes = max_concurrent_probes
+    self.policy = ProbePolicy(VIDEO_FIRST_PROBE_DELAY, probe_interval)
+    # (到期时间, 序号, key)，同一 key 重新调度后旧条目通过 due 比对失效
+    self._heap: list[tuple[float, int, str]] = []
+    self._tasks: dict[str, _ScheduledTask] = {}
+    # 正在读写存储、尚未加入调度的提交，用于去重
+    self._submitting: set[str] = set()
+    self._seq = itertools.count()
+    self._semaphore = asyncio.Semaphore(max_concurrent_probes)
+    self._check_semaphore = asyncio.Semaphore(max_concurrent_checks)
+    self._wakeup = asyncio.Event()
+    self._runner: asyncio.Task | None = None
+    self._recovery: asyncio.Task | None = None
+    self._in_flight = 0
+    self._probe_latency: deque[float] = deque(maxlen=METRICS_WINDOW)
+    self._counters = {
+      "submitted": 0,
+      "deduplicated": 0,
+      "cancelled": 0,
+      "recovered": 0,
+      "probes": 0,
+      "status_checks": 0,
+      "completed": 0,
+      "failed": 0,
+    }
+
+  def start(self):
+    """启动调度循环（已启动时直接返回）"""
+    if self._runner is None or self._runner.done():
+      self._runner = asyncio.create_task(self._run())
+
+  async def stop(self):
+    """停止调度循环和进行中的探测，任务状态保留在存储中"""
+    if self._recovery:
+      self._recovery.cancel()
+      await asyncio.gather(self._recovery, return_exceptions=True)
+      self._recovery = None
+    if self._runner:
+      self._runner.cancel()
+      self._runner = None
+    probes = [entry.probe for entry in self._tasks.values() if entry.probe]
+    for probe in probes:
+      probe.cancel()
+    await asyncio.gather(*probes, return_exceptions=True)
+    self._tasks.clear()
+    self._heap.clear()
+
+  def _schedule(self, entry: _ScheduledTask, delay: float):
+    """delay 秒后进行完整探测，期间按间隔穿插轻量状态检查"""
+    now = time.monotonic()
+    entry.full_due = now + delay
+    entry.due = entry.full_due
+    check_at = max(now + VIDEO_STATUS_CHECK_INTERVAL, entry.check_from)
+    if VIDEO_STATUS_CHECK_INTERVAL > 0 and check_at < min(entry.check_until, entry.full_due):
+      entry.due = check_at
+    heapq.heappush(self._heap, (entry.due, next(self._seq), _task_key(entry.conversation_id, entry.message_id)))
+    self._wakeup.set()
+
+  async def submit(
+    self,
+    conversation_id: str,
+    message_id: str,
+    timeout: int = 25000,
+    delay: float | None = None,
+    content_type: int = 2020,
+    prompt_kind: str = "text",
+    job: dict | None = None,
+    callback_url: str | None = None
+  ) -> bool:
+    """
+    提交视频任务，delay 秒后开始第一次探测（为空时由探测策略决定）
+    job 为生成流中解析到的任务字段，已包含视频链接时任务直接完成
+    callback_url 为任务完成或失败时的回调地址
+    相同任务已在调度中时返回 False
+    """
+    key = _task_key(conversation_id, message_id)
+    if key in self._tasks or key in self._submitting:
+      self._counters["deduplicated"] += 1
+      return False
+    # 读写存储期间占用 key，避免并发提交重复调度
+    self._submitting.add(key)
+    try:
+      task = await VideoStorage.get_task_async(conversation_id, message_id)
+      is_new = task is None
+      if is_new:
+        task = VideoTask(conversation_id, message_id, content_type, prompt_kind)
+      if callback_url:
+        task.callback_url = callback_url
+      if job:
+        task.job = {**(task.job or {}), **{k: v for k, v in job.items() if k != "video_urls"}}
+      completed = bool(job and job.get("video_urls"))
+      # 新任务先记录创建，生成流中已获取到视频时再记录完成
+      if is_new or not completed:
+        await VideoStorage.save_task_async(task, "created" if is_new else None)
+      if completed:
+        task.status = "completed"
+        task.video_urls = tuple(job["video_urls"])
+        await self._finish(task)
+        self._counters["completed"] += 1
+        logger.info(f"✅ 视频任务完成: {conversation_id} - 生成流中获取到 {len(task.video_urls)} 个视频")
+        return True
+      if delay is None:
+        delay = self.policy.next_delay(task)
+      entry = _ScheduledTask(conversation_id, message_id, timeout, 0.0)
+      # 首次完整探测前的前半段时间视频基本不可能完成，不做状态检查
+      entry.check_from = time.monotonic() + delay / 2
+      entry.check_until = time.monotonic() + VIDEO_STATUS_CHECK_WINDOW
+      self._tasks[key] = entry
+      self._counters["submitted"] += 1
+      self._schedule(entry, delay)
+      self.start()
+      return True
+    finally:
+      self._submitting.discard(key)
+
+  async def cancel(self, conversation_id: str, message_id: str) -> bool:
+    """取消任务，返回任务是否在调度中"""
+    entry = self._tasks.pop(_task_key(conversation_id, message_id), None)
+    if entry is None:
+      return False
+    entry.cancelled = True
+    if probe := entry.probe:
+      probe.cancel()
+      # 等待探测结束再写入：探测已提交到存储线程的保存先执行，不会覆盖取消后的状态
+      await asyncio.gather(probe, return_exceptions=True)
+    self._counters["cancelled"] += 1
+    if (task := await VideoStorage.get_task_async(conversation_id, message_id)) and task.status not in ("completed", "failed"):
+      task.status = "failed"
+      task.error = "任务已取消"
+      await self._finish(task)
+    return True
+
+  async def recover(self) -> int:
+    """
+    恢复存储中未完成（pending/processing）的任务，按剩余重试次数继续探测
+    - 重试次数已用完的任务直接标记为失败
+    - 按创建时间分页读取，内存中只保留一页任务
+    - 每秒最多安排 VIDEO_RECOVERY_RATE 个探测：探测时间按 1/VIDEO_RECOVERY_RATE 秒划分为时间槽，
+      每个任务占用策略探测时间之后第一个空闲的槽
+    返回恢复的任务数
+    """
+    # 先拟合探测策略，恢复的任务按历史分布安排探测时间
+    if self.policy.enabled:
+      await self.policy.refresh()
+    occupied: set[int] = set()
+    total = recovered = 0
+    cursor = None
+    while True:
+      tasks, cursor = await VideoStorage.query_tasks_async(statuses=("pending", "processing"), cursor=cursor, limit=VIDEO_RECOVERY_PAGE_SIZE)
+      total += len(tasks)
+      for task in tasks:
+        if _task_key(task.conversation_id, task.message_id) in self._tasks:
+          continue
+        if task.retry_count >= task.max_retries:
+          task.status = "failed"
+          task.error = task.error or "服务重启时已达到最大重试次数"
+          await self._finish(task)
+          continue
+        slot = math.ceil(self.policy.next_delay(task) * VIDEO_RECOVERY_RATE)
+        while slot in occupied:
+          slot += 1
+        occupied.add(slot)
+        # processing 状态的探测已随进程退出中断
+        if task.status == "processing":
+          task.status = "pending"
+          await VideoStorage.save_task_async(task)
+        if await self.submit(task.conversation_id, task.message_id, delay=slot / VIDEO_RECOVERY_RATE):
+          recovered += 1
+          self._counters["recovered"] += 1
+      if cursor is None:
+        break
+    if total:
+      logger.info(f"视频任务恢复: 未完成 {total} 个, 已恢复 {recovered} 个")
+    return recovered
+
+  def start_recovery(self):
+    """在后台恢复未完成的任务，不阻塞服务启动"""
+    if self._recovery is None or self._recovery.done():
+      self._recovery = asyncio.create_task(self._recover_in_background())
+
+  async def _recover_in_background(self):
+    try:
+      await self.recover()
+    except Exception as e:
+      logger.error(f"视频任务恢复失败: {str(e)}")
+
+  async def _run(self):
+    while True:
+      self._wakeup.clear()
+      now = time.monotonic()
+      while self._heap and self._heap[0][0] <= now:
+        due, _, key = heapq.heappop(self._heap)
+        entry = self._tasks.get(key)
+        # 已取消、已重新调度或正在探测的条目直接丢弃
+        if entry is None or entry.cancelled or entry.due != due or entry.probe:
+          continue
+        # 到达完整探测时间前只做状态检查，两者分别限制并发，在探测任务内等待名额
+        entry.probe = asyncio.create_task(self._probe(entry, full=now >= entry.full_due))
+      timeout = self._heap[0][0] - now if self._heap else None
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+  async def _finish(self, task: VideoTask):
+    """保存已完成或失败的任务并投递回调"""
+    await VideoStorage.save_task_async(task, task.status)
+    try:
+      await webhook_dispatcher.enqueue(task)
+    except Exception as e:
+      logger.warning(f"视频任务回调加入队列失败: {task.conversation_id} - {str(e)}")
+
+  async def _complete(self, task: VideoTask, video_urls: list[str], source: str):
+    task.status = "completed"
+    task.video_urls = tuple(video_urls)
+    task.error = None
+    await self._finish(task)
+    self._counters["completed"] += 1
+    logger.info(f"✅ 视频任务完成: {task.conversation_id} - {source}获取到 {len(task.video_urls)} 个视频")
+
+  async def _status_check(self, entry: _ScheduledTask, task: VideoTask) -> bool:
+    """轻量状态检查：只发一次 HTTP 请求，不消耗重试次数，返回任务是否已完成"""
+    self._counters["status_checks"] += 1
+    try:
+      result = await fetch_video_urls(entry.conversation_id, entry.message_id, entry.timeout)
+    except Exception as e:
+      logger.debug(f"视频任务状态检查失败: {entry.conversation_id} - {str(e)}")
+      return False
+    job = {**(task.job or {}), **result["job"]}
+    if result["video_urls"]:
+      task.job = job
+      await self._complete(task, result["video_urls"], "状态检查")
+      return True
+    if job != (task.job or {}):
+      task.job = job
+      await VideoStorage.save_task_async(task)
+    return False
+
+  async def _probe(self, entry: _ScheduledTask, full: bool):
+    """
+    在对应的并发名额内执行一次完整探测或状态检查
+    名额用 async with 在任务内获取，任务在开始前被取消（cancel / stop）时不会占用名额
+    """
+    async with (self._semaphore if full else self._check_semaphore):
+      await self._attempt(entry, full)
+
+  async def _attempt(self, entry: _ScheduledTask, full: bool):
+    """执行一次探测（full 为 False 时只做状态检查），根据结果完成任务或重新调度"""
+    key = _task_key(entry.conversation_id, entry.message_id)
+    self._in_flight += 1
+    start = time.perf_counter()
+    retry_delay = None
+    try:
+      task = await VideoStorage.get_task_async(entry.conversation_id, entry.message_id) or VideoTask(entry.conversation_id, entry.message_id)
+      if task.status in ("completed", "failed"):
+        return
+      if not full:
+        if not await self._status_check(entry, task):
+          retry_delay = entry.full_due - time.monotonic()
+        return
+      try:
+        change = "processing" if task.status != "processing" else None
+        task.status = "processing"
+        task.retry_count += 1
+        await VideoStorage.save_task_async(task, change)
+        self._counters["probes"] += 1
+
+        # 调用获取视频链接的API
+        result = await resolve_video_url(entry.conversation_id, entry.message_id, entry.timeout)
+
+        if result["success"] and result["video_urls"]:
+          # 成功获取到视频链接
+          await self._complete(task, result["video_urls"], "")
+          return
+        # 未获取到视频，继续重试
+        task.error = result.get("error", "未获取到视频")
+        task.last_miss_at = time.time()
+        await VideoStorage.save_task_async(task, "retry")
+        logger.info(f"⏳ 视频任务重试 {task.retry_count}/{task.max_retries}: {entry.conversation_id}")
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        task.error = str(e)
+        await VideoStorage.save_task_async(task, "retry")
+        logger.warning(f"❌ 视频任务出错 (重试 {task.retry_count}/{task.max_retries}): {str(e)}")
+
+      if task.retry_count < task.max_retries:
+        retry_delay = self.policy.next_delay(task)
+        return
+      # 所有重试都失败
+      task.status = "failed"
+      await self._finish(task)
+      self._counters["failed"] += 1
+      logger.warning(f"❌ 视频任务失败: {entry.conversation_id} - 已达到最大重试次数")
+    finally:
+      self._in_flight -= 1
+      self._probe_latency.append(time.perf_counter() - start)
+      entry.probe = None
+      if self._tasks.get(key) is entry:
+        if retry_delay is None:
+          del self._tasks[key]
+        elif not entry.cancelled:
+          self._schedule(entry, retry_delay)
+
+  @property
+  def busy(self) -> bool:
+    """完整探测的并发已满"""
+    return self._semaphore.locked()
+
+  def stats(self) -> dict:
+    """导出调度器状态和指标"""
+    latency_ms = sorted(t * 1000 for t in self._probe_latency)
+
+    def _quantile(q: float) -> float:
+      return round(latency_ms[min(len(latency_ms) - 1, int(len(latency_ms) * q))], 1) if latency_ms else 0.0
+
+    return {
+      "running": bool(self._runner and not self._runner.done()),
+      "tasks": len(self._tasks),
+      "queue_depth": len(self._tasks) - self._in_flight,
+      "in_flight": self._in_flight,
+      "max_concurrent_probes": self.max_concurrent_probes,
+      **self._counters,
+      "probe_latency_ms": {"p50": _quantile(0.5), "p99": _quantile(0.99), "max": round(latency_ms[-1], 1) if latency_ms else 0.0},
+    }
+
+
+video_scheduler = VideoTaskScheduler()
+
+
+async def start_video_fetch_task(
+  conversation_id: str,
+  message_id: str,
+  timeout: int = 25000,
+  prompt_kind: str = "text",
+  job: dict | None = None,
+  callback_url: str | None = None
+):
+  """启动视频获取后台任务"""
+  if await video_scheduler.submit(conversation_id, message_id, timeout, prompt_kind=prompt_kind, job=job, callback_url=callback_url):
+    print(f"🎬 启动视频获取任务: {conversation_id}")
+
+
+__all__ = ["VideoTaskScheduler", "video_scheduler", "start_video_fetch_task"]
@@ -1,245 +1,216 @@
 """
 视频链接获取服务
-使用 Playwright 从豆包网页获取视频链接（无头模式，优化速度）
+使用 Playwright 从豆包网页获取视频链接（无头模式，复用浏览器池）
+拦截页面自身的 JSON 接口响应解析播放信息，屏蔽图片、字体、媒体和埋点请求，
+捕获到视频链接后立即返回，timeout 仅作为整体截止时间
 """
-import asyncio
-import os
-import glob
-import sys
-from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout
 from loguru import logger
-import json
-import re
+import asyncio
+import time
 from src.pool.session_pool import session_pool
+from src.service.browser_pool import browser_pool
+from src.service.video_urls import is_video_url, extract_video_urls, extract_video_job, VideoUrlSet, VIDEO_JOB_ID_KEYS
+
+
+# 视频卡片（缩略图）选择器，点击后页面会请求播放信息
+VIDEO_CARD_SELECTOR = 'img[src*="tplv-a9rns2rl98-web-thumb"], [class*="VideoCard"] img'
+
+# 读取 video 元素地址
+VIDEO_SOURCES_JS = "() => Array.from(document.querySelectorAll('video')).map(v => v.currentSrc || v.src).filter(Boolean)"
+
+# 提取视频链接不需要的资源类型，直接拦截
+BLOCKED_RESOURCE_TYPES = {'image', 'font', 'media'}
+
+# 埋点、监控等分析类请求
+BLOCKED_URL_PATTERNS = ['mcs.doubao.com', 'mon.', 'slardar', 'monitor_browser', 'apmplus', 'analytics', '/collect']
+
+# 播放信息接口（点击视频卡片后请求），响应中不带 message_id
+PLAY_INFO_URL_PATTERN = 'play_info'
+
+
+class _Deadline:
+  """整体截止时间"""
+
+  def __init__(self, timeout_ms: int):
+    self.end = time.perf_counter() + timeout_ms / 1000
+
+  def remaining(self) -> float:
+    return max(0.0, self.end - time.perf_counter())
+
+  def remaining_ms(self) -> int:
+    return int(self.remaining() * 1000)
+
+
+async def _wait_until(found: asyncio.Event, action, timeout: float):
+  """
+  等待视频链接被捕获或 action 完成，以先发生者为准
+  返回 action 的结果（视频链接先被捕获、超时或 action 出错时返回 None）
+  """
+  if found.is_set() or timeout <= 0:
+    if asyncio.iscoroutine(action):
+      action.close()
+    return None
+  found_task = asyncio.ensure_future(found.wait())
+  action_task = asyncio.ensure_future(action)
+  try:
+    done, _ = await asyncio.wait([found_task, action_task], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+  finally:
+    for task in (found_task, action_task):
+      if not task.done():
+        task.cancel()
+  if action_task in done and not action_task.cancelled() and action_task.exception() is None:
+    return action_task.result()
+  if action_task.done() and not action_task.cancelled():
+    action_task.exception()
+  return None
+
+
+def _requests_video(request, video_ids: set[str]) -> bool:
+  """请求地址或请求体中是否带有其中一个视频标识"""
+  if not video_ids:
+    return False
+  try:
+    body = request.post_data or ''
+  except Exception:
+    body = ''
+  return any(video_id in request.url or video_id in body for video_id in video_ids)
 
 
 async def get_video_url(conversation_id: str, message_id: str = None, timeout: int = 15000):
   """
   从豆包网页获取视频链接（无头模式，优化速度）
-  
+
   Args:
     conversation_id: 会话ID
     message_id: 消息ID（可选）
-    timeout: 超时时间（毫秒），默认15秒
-  
+    timeout: 整体超时时间（毫秒），默认15秒
+
   Returns:
     dict: 包含视频URL列表和相关信息
   """
   video_urls = []
-  
-  async with async_playwright() as p:
-    try:
-      # 尝试查找系统中已安装的 Playwright Chromium
-      chromium_path = None
-      
-      # 检查多个可能的安装位置
-      search_paths = [
-        # venv 环境
-        os.path.join(os.getcwd(), 'venv', 'Lib', 'site-packages', 'playwright', 'driver', 'package', '.local-browsers', 'chromium-*', 'chrome-win', 'chrome.exe'),
-        # .venv 环境
-        os.path.join(os.getcwd(), '.venv', 'Lib', 'site-packages', 'playwright', 'driver', 'package', '.local-browsers', 'chromium-*', 'chrome-win', 'chrome.exe'),
-        # 用户目录
-        os.path.expanduser('~\\AppData\\Local\\ms-playwright\\chromium-*\\chrome-win\\chrome.exe'),
-        # Python site-packages
-        os.path.join(sys.prefix, 'Lib', 'site-packages', 'playwright', 'driver', 'package', '.local-browsers', 'chromium-*', 'chrome-win', 'chrome.exe'),
-      ]
-      
-      for pattern in search_paths:
-        matches = glob.glob(pattern)
-        if matches:
-          chromium_path = matches[0]
-          logger.info(f"找到 Chromium 浏览器: {chromium_path}")
-          break
-      
-      # 启动浏览器配置
-      launch_options = {
-        'headless': True,  # 无头模式
-        'args': [
-          '--disable-blink-features=AutomationControlled',
-          '--disable-dev-shm-usage',
-          '--no-sandbox',
-          '--disable-setuid-sandbox'
-        ]
-      }
-      
-      if chromium_path and os.path.exists(chromium_path):
-        launch_options['executable_path'] = chromium_path
-        logger.info(f"使用指定路径启动浏览器")
-      else:
-        logger.warning("未找到 Chromium，尝试使用默认路径")
-      
-      browser = await p.chromium.launch(**launch_options)
-      
-      # 创建上下文
-      context = await browser.new_context(
-        viewport={'width': 1280, 'height': 720},
-        user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-      )
-      
-      # 不拦截资源，确保视频能正常加载
-      page = await context.new_page()
-      
-      # 获取 session 配置
-      session = session_pool.get_session()
-      if not session:
-        raise Exception("无可用的 session 配置")
-      
-      # 设置 cookie
-      cookies = []
-      for cookie_str in session.cookie.split('; '):
-        if '=' in cookie_str:
-          name, value = cookie_str.split('=', 1)
-          cookies.append({
-            'name': name,
-            'value': value,
-            'domain': '.doubao.com',
-            'path': '/'
-          })
-      
-      await context.add_cookies(cookies)
-      
-      # 监听网络请求，捕获视频URL
-      captured_urls = []
-      
-      def handle_response(response):
-        url = response.url
-        # 只捕获真正的视频播放链接，排除 API 端点
-        if any(ext in url for ext in ['.mp4', '.webm', '.m3u8', 'douyinvod']):
-          # 排除 API 端点
-          if 'get_play_info' not in url and url not in captured_urls:
-            captured_urls.append(url)
-            logger.info(f"捕获到视频URL: {url[:100]}...")
-      
+  timings: dict[str, int] = {}
+  start = time.perf_counter()
+  deadline = _Deadline(timeout)
+
+  def mark(step: str, step_start: float):
+    timings[step] = int((time.perf_counter() - step_start) * 1000)
+
+  # 优先使用创建该会话的 session，否则随机选择登录账号
+  session = session_pool.get_session(conversation_id) or session_pool.get_session()
+  if not session:
+    return {
+      'success': False,
+      'error': "无可用的 session 配置",
+      'conversation_id': conversation_id,
+      'video_count': 0,
+      'video_urls': []
+    }
+
+  try:
+    step_start = time.perf_counter()
+    async with browser_pool.page(session) as page:
+      mark('acquire_page', step_start)
+
+      # 拦截页面自身的 JSON 接口响应，从中解析视频播放信息
+      # 同一视频的多个版本（码率、水印、CDN 节点）只保留最好的一个
+      captured_urls = VideoUrlSet()
+      found = asyncio.Event()
+      # 该消息的视频标识（vid 等），用于识别属于该消息的播放信息请求
+      video_ids: set[str] = set()
+
+      def capture(urls: list[str], source: str):
+        for url in urls:
+          if captured_urls.add(url):
+            found.set()
+            logger.info(f"从{source}捕获到视频URL: {url[:100]}...")
+
+      async def handle_response(response):
+        if response.request.resource_type not in ('xhr', 'fetch'):
+          return
+        if 'json' not in response.headers.get('content-type', ''):
+          return
+        try:
+          data = await response.json()
+        except Exception:
+          return
+        if not message_id:
+          capture(extract_video_urls(data), "接口响应")
+          return
+        # 只接受该消息节点中的链接，信息流、历史记录等其他消息的播放信息不会误判为该消息的视频
+        job = extract_video_job(data, message_id)
+        video_ids.update(str(job[key]) for key in VIDEO_JOB_ID_KEYS if job.get(key))
+        if urls := job.get('video_urls'):
+          capture(urls, "接口响应")
+        elif PLAY_INFO_URL_PATTERN in response.url and _requests_video(response.request, video_ids):
+          capture(extract_video_urls(data), "播放信息")
+
+      async def handle_route(route):
+        request = route.request
+        # 被拦截的视频请求本身也是有效的播放链接（无法确定属于哪条消息，只在未指定消息时使用）
+        if not message_id and is_video_url(request.url):
+          capture([request.url], "视频请求")
+        if request.resource_type in BLOCKED_RESOURCE_TYPES or any(p in request.url for p in BLOCKED_URL_PATTERNS):
+          await route.abort()
+        else:
+          await route.continue_()
+
+      await page.route('**/*', handle_route)
       page.on('response', handle_response)
-      
+
       # 访问会话页面
       url = f"https://www.doubao.com/chat/{conversation_id}"
       logger.info(f"正在访问: {url}")
-      
-      try:
-        await page.goto(url, wait_until='networkidle', timeout=timeout)
-      except PlaywrightTimeout:
-        logger.warning("页面加载超时，继续尝试获取视频")
-      
-      # 等待页面初始化（与脚本一致）
-      await page.wait_for_timeout(5000)
-      
-      # 尝试点击视频缩略图触发加载
-      try:
-        # 查找视频缩略图（多种选择器）
-        video_selectors = [
-          'img[src*="tplv-a9rns2rl98-web-thumb"]',
-          'img[src*="video"]',
-          'img[src*="douyinvod"]',
-          '[class*="video"] img',
-          '[class*="VideoCard"] img'
-        ]
-        
-        video_thumbnail = None
-        for selector in video_selectors:
-          try:
-            video_thumbnail = await page.wait_for_selector(selector, timeout=3000)
-            if video_thumbnail:
-              logger.info(f"找到视频缩略图: {selector}")
-              break
-          except:
-            continue
-        
-        if video_thumbnail:
-          # 滚动到元素可见
-          await video_thumbnail.scroll_into_view_if_needed()
-          await page.wait_for_timeout(500)
-          
-          # 点击缩略图
-          await page.evaluate('(element) => element.click()', video_thumbnail)
-          logger.info("已点击视频缩略图，等待视频加载...")
-          await page.wait_for_timeout(5000)  # 增加等待时间
-        else:
-          logger.warning("未找到视频缩略图")
-      except Exception as e:
-        logger.warning(f"点击视频缩略图失败: {str(e)}")
-      
-      # 滚动页面触发懒加载
-      await page.evaluate('window.scrollTo(0, document.body.scrollHeight)')
-      await page.wait_for_timeout(2000)
-      await page.evaluate('window.scrollTo(0, 0)')
-      await page.wait_for_timeout(1000)
-      
-      # 获取 video 标签的 src
-      video_elements = await page.query_selector_all('video')
-      logger.info(f"找到 {len(video_elements)} 个 video 元素")
-      
-      for video in video_elements:
-        src = await video.get_attribute('src')
-        current_src = await video.get_attribute('currentSrc')
-        video_url = src or current_src
-        if video_url and video_url not in video_urls:
-          video_urls.append(video_url)
-          logger.info(f"从 video 标签获取: {video_url[:100]}...")
-      
-      # 使用 JavaScript 获取性能API中的视频请求
-      performance_urls = await page.evaluate('''() => {
-        return performance.getEntriesByType('resource')
-          .filter(entry => 
-            entry.name.includes('.mp4') || 
-            entry.name.includes('.webm') || 
-            entry.name.includes('.m3u8') ||
-            entry.name.includes('douyinvod')
-          )
-          .map(entry => entry.name);
-      }''')
-      
-      for url in performance_urls:
-        if url not in video_urls:
-          video_urls.append(url)
-      
-      # 从页面内容提取视频URL（只要真正的视频链接）
-      page_content = await page.content()
-      video_url_pattern = r'https://[^"\'<>\s]+\.(?:mp4|webm|m3u8)'
-      found_urls = re.findall(video_url_pattern, page_content)
-      
-      for url in found_urls:
-        # 排除 API 端点
-        if 'get_play_info' not in url and url not in video_urls:
-          video_urls.append(url)
-      
-      # 添加从网络请求捕获的URL
-      for url in captured_urls:
-        if url not in video_urls:
-          video_urls.append(url)
-      
-      # 最终过滤：只保留真正的视频播放链接
-      filtered_urls = []
-      for url in video_urls:
-        # 只保留包含 douyinvod 或视频文件扩展名的链接
-        if ('douyinvod.com' in url or url.endswith('.mp4') or url.endswith('.webm') or url.endswith('.m3u8')):
-          if 'get_play_info' not in url:  # 排除 API 端点
-            filtered_urls.append(url)
-      
-      video_urls = filtered_urls
-      
-      await browser.close()
-      
-      logger.info(f"共找到 {len(video_urls)} 个视频URL")
-      
-      return {
-        'success': True,
-        'conversation_id': conversation_id,
-        'video_count': len(video_urls),
-        'video_urls': video_urls
-      }
-      
-    except Exception as e:
-      logger.error(f"获取视频URL失败: {str(e)}")
-      if 'browser' in locals():
-        await browser.close()
-      return {
-        'success': False,
-        'error': str(e),
-        'conversation_id': conversation_id,
-        'video_count': 0,
-        'video_urls': []
-      }
+
+      # 页面加载超时或失败时继续尝试获取视频
+      step_start = time.perf_counter()
+      await _wait_until(found, page.goto(url, wait_until='domcontentloaded', timeout=max(1, deadline.remaining_ms())), deadline.remaining())
+      mark('goto', step_start)
+
+      # 等待页面加载消息数据，超过一半剩余时间仍未解析到时点击视频卡片触发播放信息请求
+      step_start = time.perf_counter()
+      await _wait_until(found, asyncio.sleep(deadline.remaining() / 2), deadline.remaining())
+      mark('wait_json', step_start)
+      # 截止时间已到时不再点击（Playwright 的 timeout=0 表示不限时）
+      if not found.is_set() and (click_timeout := deadline.remaining_ms()) > 0:
+        step_start = time.perf_counter()
+        try:
+          await page.click(VIDEO_CARD_SELECTOR, timeout=click_timeout, force=True)
+          logger.info("已点击视频卡片，等待播放信息...")
+        except Exception as e:
+          logger.warning(f"点击视频卡片失败: {str(e)}")
+        mark('click', step_start)
+        step_start = time.perf_counter()
+        await _wait_until(found, asyncio.sleep(deadline.remaining()), deadline.remaining())
+        mark('wait_play_info', step_start)
+
+      # 兜底：读取 video 元素地址（媒体请求被拦截，但地址仍写在元素上；同样只在未指定消息时使用）
+      if not found.is_set() and not message_id:
+        video_sources = await page.evaluate(VIDEO_SOURCES_JS)
+        capture([u for u in video_sources if is_video_url(u)], "video 标签")
+
+      video_urls = list(captured_urls)
+
+    mark('total', start)
+    logger.info(f"共找到 {len(video_urls)} 个视频URL, 耗时明细(ms): {timings}")
+
+    return {
+      'success': True,
+      'conversation_id': conversation_id,
+      'video_count': len(video_urls),
+      'video_urls': video_urls
+    }
+
+  except Exception as e:
+    mark('total', start)
+    logger.error(f"获取视频URL失败: {str(e)}, 耗时明细(ms): {timings}")
+    return {
+      'success': False,
+      'error': str(e),
+      'conversation_id': conversation_id,
+      'video_count': 0,
+      'video_urls': []
+    }
 
 
 __all__ = ['get_video_url']
@@ -1,169 +1,882 @@
 """
 视频链接存储管理模块
 用于存储和查询视频生成任务的状态和链接
+
+存储后端通过环境变量 VIDEO_STORAGE_BACKEND 选择：
+- sqlite（默认）: SQLite 数据库，按 (conversation_id, message_id)、status、updated_at 建索引，
+  首次启动时自动导入已有的 video_links.json
+- journal: 内存索引 + 追加写日志，读取不访问磁盘，写入批量落盘并定期压缩
+- json: 旧版 JSON 文件，每次操作整体读写
+
+列表查询（query）按 (created_at, conversation_id, message_id) 排序，用上一页最后一个任务的排序键作为游标，
+排序键的表示由各后端决定，游标对调用方不透明
+
+事件循环中的调用方使用 *_async 方法，存储操作在单独的存储线程中执行，SQLite 查询和提交不阻塞事件循环
 """
-import json
 import asyncio
+import base64
+import bisect
+import functools
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from typing import Optional
-from src.service.video_service import get_video_url
+from loguru import logger
+from src.service.task_events import task_events
+from src.service.change_feed import change_feed
+from src.service.video_urls import video_urls_expire_at
 
 
-# 视频链接存储文件路径
+# 存储后端: sqlite / journal / json
+VIDEO_STORAGE_BACKEND = os.getenv("VIDEO_STORAGE_BACKEND", "sqlite")
+# 视频链接存储文件路径（json 后端，sqlite 后端首次启动时从该文件导入）
 VIDEO_STORAGE_FILE = Path("video_links.json")
+# SQLite 数据库路径
+VIDEO_STORAGE_DB = Path(os.getenv("VIDEO_STORAGE_DB", "video_tasks.db"))
+# 日志文件路径（journal 后端），快照文件为同名 .snapshot
+VIDEO_STORAGE_JOURNAL = Path(os.getenv("VIDEO_STORAGE_JOURNAL", "video_tasks.journal"))
+# 日志批量落盘间隔（秒），宕机时最多丢失该时间内的写入
+VIDEO_JOURNAL_FLUSH_INTERVAL = float(os.getenv("VIDEO_JOURNAL_FLUSH_INTERVAL", "0.2"))
+# 日志记录数超过 max(该值, 任务数 * 2) 时压缩为快照
+VIDEO_JOURNAL_COMPACT_MIN = int(os.getenv("VIDEO_JOURNAL_COMPACT_MIN", "10000"))
+
+
+def _to_epoch(value) -> Optional[float]:
+  """ISO 时间字符串或时间戳转换为时间戳"""
+  if value is None or isinstance(value, (int, float)):
+    return value
+  try:
+    return datetime.fromisoformat(value).timestamp()
+  except ValueError:
+    return None
+
+
+def _to_iso(value: Optional[float]) -> Optional[str]:
+  return None if value is None else datetime.fromtimestamp(value).isoformat()
+
+
+def encode_cursor(key: tuple) -> str:
+  return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+  """解析分页游标，格式错误时抛出 ValueError"""
+  try:
+    key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+  except (ValueError, TypeError) as e:
+    raise ValueError(f"无效的分页游标: {cursor}") from e
+  if not isinstance(key, list) or len(key) != 3:
+    raise ValueError(f"无效的分页游标: {cursor}")
+  return tuple(key)
+
+
+def _iso_key(task: "VideoTask") -> tuple:
+  """按 ISO 时间字符串排序的排序键（json、sqlite 后端）"""
+  return (_to_iso(task.created_at) or "", task.conversation_id, task.message_id)
+
+
+def _completion_sample(task: "VideoTask") -> tuple:
+  return (task.content_type, task.prompt_kind, task.created_at, task.completed_at, task.last_miss_at)
+
+
+def _expiry_key(task: "VideoTask") -> tuple:
+  """即将过期任务的排序键"""
+  return (task.urls_expire_at, task.conversation_id, task.message_id)
+
+
+def _query_filter(statuses: tuple, conversation_id: Optional[str]):
+  def match(task: "VideoTask") -> bool:
+    return (not statuses or task.status in statuses) and (conversation_id is None or task.conversation_id == conversation_id)
+  return match
 
 
 class VideoTask:
-  """视频任务状态"""
-  def __init__(self, conversation_id: str, message_id: str):
-    self.conversation_id = conversation_id
+  """
+  视频任务状态
+  节点上可能同时保存数十万个任务，因此使用 __slots__，时间保存为时间戳，视频链接保存为元组，
+  只在 to_dict 时转换为接口和存储使用的 JSON 结构（ISO 时间字符串、列表）
+  """
+  __slots__ = (
+    "conversation_id", "message_id", "content_type", "prompt_kind", "status", "video_urls",
+    "retry_count", "max_retries", "created_at", "updated_at", "completed_at", "error", "last_miss_at", "job", "callback_url"
+  )
+
+  def __init__(self, conversation_id: str, message_id: str, content_type: int = 2020, prompt_kind: str = "text"):
+    now = time.time()
+    # 同一会话的任务共享 conversation_id 字符串
+    self.conversation_id = sys.intern(conversation_id)
     self.message_id = message_id
+    self.content_type = content_type
+    self.prompt_kind = sys.intern(prompt_kind)  # text: 文生视频, image: 图生视频
     self.status = "pending"  # pending, processing, completed, failed
-    self.video_urls: list[str] = []
+    self.video_urls: tuple[str, ...] = ()
     self.retry_count = 0
     self.max_retries = 10
-    self.created_at = datetime.now().isoformat()
-    self.updated_at = datetime.now().isoformat()
+    self.created_at: float = now
+    self.updated_at: float = now
+    # 首次保存为 completed 的时间，之后刷新链接等保存只更新 updated_at
+    self.completed_at: Optional[float] = None
     self.error: Optional[str] = None
+    # 最近一次未获取到视频的探测时间，用于估计视频完成时间
+    self.last_miss_at: Optional[float] = None
+    # 生成流和状态检查中解析到的视频任务标识和状态字段，更新时整体替换而不是原地修改
+    self.job: Optional[dict] = None
+    # 任务完成或失败时的回调地址
+    self.callback_url: Optional[str] = None
+
+  @property
+  def urls_expire_at(self) -> Optional[float]:
+    """视频链接中最早的过期时间，由链接解析得到，不单独保存"""
+    return video_urls_expire_at(self.video_urls)
+
+  def copy(self) -> "VideoTask":
+    """浅拷贝，video_urls 为元组、job 整体替换，拷贝之间互不影响"""
+    task = VideoTask.__new__(VideoTask)
+    task.conversation_id = self.conversation_id
+    task.message_id = self.message_id
+    task.content_type = self.content_type
+    task.prompt_kind = self.prompt_kind
+    task.status = self.status
+    task.video_urls = self.video_urls
+    task.retry_count = self.retry_count
+    task.max_retries = self.max_retries
+    task.created_at = self.created_at
+    task.updated_at = self.updated_at
+    task.completed_at = self.completed_at
+    task.error = self.error
+    task.last_miss_at = self.last_miss_at
+    task.job = self.job
+    task.callback_url = self.callback_url
+    return task
 
-  def to_dict(self):
-    return {
+  def to_dict(self, include_private: bool = False):
+    """
+    任务数据，用于接口返回、事件推送和回调
+    callback_url 可能带有访问令牌，只在 include_private=True（存储）时包含
+    """
+    data = {
       "conversation_id": self.conversation_id,
       "message_id": self.message_id,
+      "content_type": self.content_type,
+      "prompt_kind": self.prompt_kind,
       "status": self.status,
-      "video_urls": self.video_urls,
+      "video_urls": list(self.video_urls),
       "retry_count": self.retry_count,
       "max_retries": self.max_retries,
-      "created_at": self.created_at,
-      "updated_at": self.updated_at,
-      "error": self.error
+      "created_at": _to_iso(self.created_at),
+      "updated_at": _to_iso(self.updated_at),
+      "completed_at": _to_iso(self.completed_at),
+      "error": self.error,
+      "last_miss_at": _to_iso(self.last_miss_at),
+      "job": self.job or {},
+      "urls_expire_at": _to_iso(self.urls_expire_at)
     }
+    if include_private:
+      data["callback_url"] = self.callback_url
+    return data
 
   @classmethod
   def from_dict(cls, data: dict):
-    task = cls(data["conversation_id"], data["message_id"])
-    task.status = data.get("status", "pending")
-    task.video_urls = data.get("video_urls", [])
+    task = cls(data["conversation_id"], data["message_id"], data.get("content_type", 2020), data.get("prompt_kind", "text"))
+    task.status = sys.intern(data.get("status", "pending"))
+    task.video_urls = tuple(data.get("video_urls", ()))
     task.retry_count = data.get("retry_count", 0)
     task.max_retries = data.get("max_retries", 10)
-    task.created_at = data.get("created_at", task.created_at)
-    task.updated_at = data.get("updated_at", task.updated_at)
+    task.created_at = _to_epoch(data.get("created_at")) or task.created_at
+    task.updated_at = _to_epoch(data.get("updated_at")) or task.updated_at
+    task.completed_at = _to_epoch(data.get("completed_at"))
     task.error = data.get("error")
+    task.last_miss_at = _to_epoch(data.get("last_miss_at"))
+    task.job = data.get("job") or None
+    task.callback_url = data.get("callback_url")
     return task
 
 
-class VideoStorage:
-  """视频链接存储管理器"""
+class _JsonBackend:
+  """JSON 文件存储，每次操作整体读写文件"""
 
-  @staticmethod
-  def _load_storage() -> dict:
-    """加载存储文件"""
-    if not VIDEO_STORAGE_FILE.exists():
+  def __init__(self, path: Path):
+    self.path = path
+
+  def _load(self) -> dict:
+    if not self.path.exists():
       return {}
     try:
-      with open(VIDEO_STORAGE_FILE, 'r', encoding='utf-8') as f:
+      with open(self.path, 'r', encoding='utf-8') as f:
         return json.load(f)
     except Exception:
       return {}
 
-  @staticmethod
-  def _save_storage(data: dict):
-    """保存存储文件"""
-    with open(VIDEO_STORAGE_FILE, 'w', encoding='utf-8') as f:
+  def _dump(self, data: dict):
+    with open(self.path, 'w', encoding='utf-8') as f:
       json.dump(data, f, ensure_ascii=False, indent=2)
 
+  def save(self, task: VideoTask):
+    self.save_many([task])
+
+  def save_many(self, tasks: list[VideoTask]):
+    storage = self._load()
+    for task in tasks:
+      storage[f"{task.conversation_id}_{task.message_id}"] = task.to_dict(include_private=True)
+    self._dump(storage)
+
+  def get(self, conversation_id: str, message_id: str) -> VideoTask | None:
+    data = self._load().get(f"{conversation_id}_{message_id}")
+    return VideoTask.from_dict(data) if data else None
+
+  def get_many(self, keys: list[tuple[str, str]]) -> list[VideoTask]:
+    storage = self._load()
+    return [VideoTask.from_dict(data) for cid, mid in keys if (data := storage.get(f"{cid}_{mid}"))]
+
+  def by_conversation(self, conversation_id: str) -> list[VideoTask]:
+    return [VideoTask.from_dict(data) for data in self._load().values() if data.get("conversation_id") == conversation_id]
+
+  def by_status(self, statuses: tuple[str, ...]) -> list[VideoTask]:
+    return [VideoTask.from_dict(data) for data in self._load().values() if data.get("status") in statuses]
+
+  def all(self) -> list[VideoTask]:
+    return [VideoTask.from_dict(data) for data in self._load().values()]
+
+  def expiring(self, after: float, before: float, limit: int, after_key: Optional[tuple] = None) -> list[VideoTask]:
+    tasks = [t for t in self.all() if t.status == "completed" and (e := t.urls_expire_at) is not None and after <= e < before]
+    tasks = sorted(tasks, key=_expiry_key)
+    if after_key is not None:
+      tasks = [t for t in tasks if _expiry_key(t) > tuple(after_key)]
+    return tasks[:limit]
+
+  def completion_samples(self, limit: int) -> list[tuple]:
+    tasks = sorted(self.by_status(("completed",)), key=lambda t: t.updated_at, reverse=True)[:limit]
+    return [_completion_sample(task) for task in tasks]
+
+  def query(self, statuses, conversation_id, created_after, created_before, after, limit) -> list[tuple[tuple, VideoTask]]:
+    match = _query_filter(statuses, conversation_id)
+    low = _to_iso(created_after) if created_after is not None else None
+    high = _to_iso(created_before) if created_before is not None else None
+    rows = sorted((_iso_key(task), task) for task in self.all() if match(task))
+    rows = [
+      row for row in rows
+      if (low is None or row[0][0] >= low) and (high is None or row[0][0] < high) and (after is None or row[0] > after)
+    ]
+    return rows if limit is None else rows[:limit]
+
+
+class _SqliteBackend:
+  """
+  SQLite 存储
+  - 主键 (conversation_id, message_id)，status、updated_at 单独建索引
+  - urls_expire_at 列保存视频链接的过期时间并建索引，用于查找即将过期的链接
+  - WAL 模式，其他进程读取时不阻塞写入
+  - 单连接 + 锁，可在事件循环或线程池中调用
+  """
+
+  def __init__(self, path: Path):
+    self.path = path
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("PRAGMA synchronous=NORMAL")
+    self._conn.executescript("""
+      CREATE TABLE IF NOT EXISTS video_tasks (
+        conversation_id TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        data TEXT NOT NULL,
+        urls_expire_at REAL,
+        PRIMARY KEY (conversation_id, message_id)
+      );
+      CREATE INDEX IF NOT EXISTS idx_video_tasks_status ON video_tasks (status);
+      CREATE INDEX IF NOT EXISTS idx_video_tasks_updated_at ON video_tasks (updated_at);
+      CREATE INDEX IF NOT EXISTS idx_video_tasks_status_updated_at ON video_tasks (status, updated_at);
+      CREATE INDEX IF NOT EXISTS idx_video_tasks_created_at ON video_tasks (created_at, conversation_id, message_id);
+      CREATE TABLE IF NOT EXISTS video_storage_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+      );
+    """)
+    self._migrate()
+    # 过期时间相同的任务按主键排序，分页时用 (过期时间, 主键) 定位
+    self._conn.execute("DROP INDEX IF EXISTS idx_video_tasks_urls_expire_at")
+    self._conn.execute("CREATE INDEX IF NOT EXISTS idx_video_tasks_urls_expiry ON video_tasks (urls_expire_at, conversation_id, message_id)")
+
+  def _migrate(self):
+    """旧数据库补充 urls_expire_at 列，并从已保存的视频链接计算过期时间"""
+    columns = {row[1] for row in self._conn.execute("PRAGMA table_info(video_tasks)")}
+    if "urls_expire_at" in columns:
+      return
+    self._conn.execute("ALTER TABLE video_tasks ADD COLUMN urls_expire_at REAL")
+    rows = self._conn.execute("SELECT rowid, data FROM video_tasks WHERE status = 'completed'").fetchall()
+    updates = [(video_urls_expire_at(json.loads(data).get("video_urls", ())), rowid) for rowid, data in rows]
+    self._conn.execute("BEGIN")
+    self._conn.executemany("UPDATE video_tasks SET urls_expire_at = ? WHERE rowid = ?", updates)
+    self._conn.execute("COMMIT")
+    logger.info(f"视频任务数据库已添加链接过期时间: {len(updates)} 个任务")
+
   @staticmethod
-  def save_task(task: VideoTask):
-    """保存任务"""
-    storage = VideoStorage._load_storage()
-    key = f"{task.conversation_id}_{task.message_id}"
-    task.updated_at = datetime.now().isoformat()
-    storage[key] = task.to_dict()
-    VideoStorage._save_storage(storage)
+  def _row(task: VideoTask) -> tuple:
+    data = task.to_dict(include_private=True)
+    return (
+      data["conversation_id"],
+      data["message_id"],
+      data.get("status", "pending"),
+      data.get("created_at") or "",
+      data.get("updated_at") or "",
+      json.dumps(data, ensure_ascii=False),
+      task.urls_expire_at
+    )
+
+  _UPSERT = """
+    INSERT INTO video_tasks (conversation_id, message_id, status, created_at, updated_at, data, urls_expire_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (conversation_id, message_id) DO UPDATE SET
+      status = excluded.status,
+      created_at = excluded.created_at,
+      updated_at = excluded.updated_at,
+      data = excluded.data,
+      urls_expire_at = excluded.urls_expire_at
+  """
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
+
+  def _query(self, sql: str, params: tuple = ()) -> list[VideoTask]:
+    with self._lock:
+      rows = self._conn.execute(sql, params).fetchall()
+    return [VideoTask.from_dict(json.loads(row[0])) for row in rows]
+
+  def save(self, task: VideoTask):
+    with self._lock:
+      self._conn.execute(self._UPSERT, self._row(task))
+
+  def save_many(self, tasks: list[VideoTask]):
+    """在一个事务中批量写入"""
+    with self._lock:
+      self._conn.execute("BEGIN")
+      try:
+        self._conn.executemany(self._UPSERT, (self._row(task) for task in tasks))
+        self._conn.execute("COMMIT")
+      except Exception:
+        self._conn.execute("ROLLBACK")
+        raise
+
+  def get(self, conversation_id: str, message_id: str) -> VideoTask | None:
+    rows = self._query("SELECT data FROM video_tasks WHERE conversation_id = ? AND message_id = ?", (conversation_id, message_id))
+    return rows[0] if rows else None
+
+  # 批量查询时每条 SQL 的任务数，避免超过 SQLite 参数个数上限
+  _BATCH_SIZE = 400
+
+  def get_many(self, keys: list[tuple[str, str]]) -> list[VideoTask]:
+    """按主键批量查询，每批一条 SQL"""
+    tasks = []
+    for i in range(0, len(keys), self._BATCH_SIZE):
+      batch = keys[i:i + self._BATCH_SIZE]
+      values = ", ".join(["(?, ?)"] * len(batch))
+      params = tuple(v for key in batch for v in key)
+      # 与 VALUES 列表做连接才会走主键索引（row value IN (VALUES ...) 会全表扫描）
+      tasks += self._query(
+        f"SELECT t.data FROM (VALUES {values}) AS k JOIN video_tasks AS t ON t.conversation_id = k.column1 AND t.message_id = k.column2",
+        params
+      )
+    return tasks
+
+  def by_conversation(self, conversation_id: str) -> list[VideoTask]:
+    return self._query("SELECT data FROM video_tasks WHERE conversation_id = ? ORDER BY rowid", (conversation_id,))
+
+  def by_status(self, statuses: tuple[str, ...]) -> list[VideoTask]:
+    placeholders = ",".join("?" * len(statuses))
+    return self._query(f"SELECT data FROM video_tasks WHERE status IN ({placeholders}) ORDER BY rowid", statuses)
+
+  def all(self) -> list[VideoTask]:
+    return self._query("SELECT data FROM video_tasks ORDER BY rowid")
+
+  def query(self, statuses, conversation_id, created_after, created_before, after, limit) -> list[tuple[tuple, VideoTask]]:
+    """排序键为 (created_at ISO 字符串, conversation_id, message_id)，走 created_at 索引"""
+    where, params = [], []
+    if statuses:
+      where.append(f"status IN ({','.join('?' * len(statuses))})")
+      params += statuses
+    if conversation_id is not None:
+      where.append("conversation_id = ?")
+      params.append(conversation_id)
+    if created_after is not None:
+      where.append("created_at >= ?")
+      params.append(_to_iso(created_after))
+    if created_before is not None:
+      where.append("created_at < ?")
+      params.append(_to_iso(created_before))
+    if after is not None:
+      where.append("(created_at, conversation_id, message_id) > (?, ?, ?)")
+      params += after
+    sql = "SELECT created_at, conversation_id, message_id, data FROM video_tasks"
+    if where:
+      sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at, conversation_id, message_id"
+    if limit is not None:
+      sql += " LIMIT ?"
+      params.append(limit)
+    with self._lock:
+      rows = self._conn.execute(sql, params).fetchall()
+    return [((row[0], row[1], row[2]), VideoTask.from_dict(json.loads(row[3]))) for row in rows]
+
+  def expiring(self, after: float, before: float, limit: int, after_key: Optional[tuple] = None) -> list[VideoTask]:
+    """视频链接过期时间在 [after, before) 内的已完成任务，按 (过期时间, 主键) 排序"""
+    sql = "SELECT data FROM video_tasks WHERE urls_expire_at >= ? AND urls_expire_at < ? AND status = 'completed'"
+    params: tuple = (after, before)
+    if after_key is not None:
+      sql += " AND (urls_expire_at, conversation_id, message_id) > (?, ?, ?)"
+      params += tuple(after_key)
+    return self._query(sql + " ORDER BY urls_expire_at, conversation_id, message_id LIMIT ?", params + (limit,))
+
+  def completion_samples(self, limit: int) -> list[tuple]:
+    """只取出样本字段，不解析完整的任务数据，走 (status, updated_at) 索引"""
+    with self._lock:
+      rows = self._conn.execute(
+        "SELECT json_extract(data, '$.content_type'), json_extract(data, '$.prompt_kind'), json_extract(data, '$.created_at'),"
+        " json_extract(data, '$.completed_at'), json_extract(data, '$.last_miss_at')"
+        " FROM video_tasks WHERE status = 'completed' ORDER BY updated_at DESC LIMIT ?",
+        (limit,)
+      ).fetchall()
+    return [(content_type, prompt_kind, _to_epoch(created), _to_epoch(completed), _to_epoch(missed)) for content_type, prompt_kind, created, completed, missed in rows]
+
+  def import_json(self, path: Path) -> int:
+    """一次性导入旧版 JSON 存储文件，已导入过时跳过，返回导入的任务数"""
+    with self._lock:
+      imported = self._conn.execute("SELECT value FROM video_storage_meta WHERE key = 'json_imported'").fetchone()
+    if imported or not path.exists():
+      return 0
+    items = _JsonBackend(path).all()
+    self.save_many(items)
+    with self._lock:
+      self._conn.execute(
+        "INSERT OR REPLACE INTO video_storage_meta (key, value) VALUES ('json_imported', ?)",
+        (datetime.now().isoformat(),)
+      )
+    logger.info(f"已从 {path} 导入 {len(items)} 个视频任务到 {self.path}")
+    return len(items)
+
+
+class _JournalBackend:
+  """
+  内存索引 + 追加写日志
+  - 内存中的任务索引是权威数据，读取不访问磁盘
+  - 索引中保存 VideoTask 的拷贝，读取时返回拷贝，调用方修改任务不会影响索引
+  - 每次写入在日志缓冲区追加一行，由后台线程按间隔批量写入并 fsync
+  - 日志过长时把当前索引写成快照（写临时文件后原子替换），并清空日志
+  - 启动时加载快照并重放日志
+  - 按 (created_at 时间戳, conversation_id, message_id) 维护有序列表，分页查询时二分定位游标
+  - 已完成任务的视频链接过期时间单独索引
+  """
+
+  def __init__(self, path: Path, flush_interval: float = VIDEO_JOURNAL_FLUSH_INTERVAL, compact_min: int = VIDEO_JOURNAL_COMPACT_MIN):
+    self.path = path
+    self.snapshot_path = path.with_name(path.name + ".snapshot")
+    self.flush_interval = flush_interval
+    self.compact_min = compact_min
+    self._tasks: dict[str, VideoTask] = {}
+    self._by_conversation: dict[str, dict[str, None]] = {}
+    self._by_status: dict[str, dict[str, None]] = {}
+    self._order: list[tuple[float, str, str]] = []
+    # 已完成任务的视频链接过期时间
+    self._expires: dict[str, float] = {}
+    self._lock = threading.Lock()
+    self._flushed = threading.Condition(self._lock)
+    self._buffer: list[str] = []
+    # 已进入缓冲区 / 已落盘的写入序号
+    self._seq_buffered = 0
+    self._seq_flushed = 0
+    self._journal_entries = 0
+    self._closed = False
+    # 写入指标：bytes_logical 为任务数据本身的字节数，bytes_written 为实际写入磁盘的字节数
+    self.stats = {"writes": 0, "flushes": 0, "compactions": 0, "bytes_logical": 0, "bytes_written": 0}
+    self._load()
+    self._journal = open(self.path, "a", encoding="utf-8")
+    self._flusher = threading.Thread(target=self._flush_loop, name="video-journal", daemon=True)
+    self._flusher.start()
+
+  @staticmethod
+  def _key(conversation_id: str, message_id: str) -> str:
+    return f"{conversation_id}_{message_id}"
+
+  def _apply(self, task: VideoTask):
+    key = self._key(task.conversation_id, task.message_id)
+    if (old := self._tasks.get(key)) is not None:
+      self._by_status.get(old.status, {}).pop(key, None)
+    if old is None or old.created_at != task.created_at:
+      if old is not None:
+        self._order.pop(bisect.bisect_left(self._order, self._sort_key(old)))
+      order_key = self._sort_key(task)
+      # 新任务的创建时间通常最晚，直接追加
+      if not self._order or order_key > self._order[-1]:
+        self._order.append(order_key)
+      else:
+        bisect.insort(self._order, order_key)
+    if task.status == "completed" and (expires := task.urls_expire_at) is not None:
+      self._expires[key] = expires
+    else:
+      self._expires.pop(key, None)
+    self._tasks[key] = task
+    self._by_conversation.setdefault(task.conversation_id, {})[key] = None
+    self._by_status.setdefault(task.status, {})[key] = None
+
+  @staticmethod
+  def _sort_key(task: VideoTask) -> tuple[float, str, str]:
+    return (task.created_at, task.conversation_id, task.message_id)
+
+  def _load(self):
+    if self.snapshot_path.exists():
+      with open(self.snapshot_path, "r", encoding="utf-8") as f:
+        for data in json.load(f):
+          self._apply(VideoTask.from_dict(data))
+    if self.path.exists():
+      valid_size = 0
+      with open(self.path, "rb") as f:
+        for line in f:
+          try:
+            self._apply(VideoTask.from_dict(json.loads(line)))
+            self._journal_entries += 1
+            valid_size += len(line)
+          except ValueError:
+            # 宕机时最后一行可能只写了一半，截掉以免与后续追加的记录拼在一起
+            logger.warning(f"视频任务日志存在不完整记录，已忽略: {line[:100]!r}")
+            break
+      if valid_size < self.path.stat().st_size:
+        os.truncate(self.path, valid_size)
+
+  def _flush_loop(self):
+    while True:
+      with self._lock:
+        # 攒一个间隔的写入再落盘，flush/close 时提前唤醒
+        if not self._closed:
+          self._flushed.wait(self.flush_interval)
+        lines, self._buffer = self._buffer, []
+        seq = self._seq_buffered
+        self._journal_entries += len(lines)
+        snapshot = None
+        if self._journal_entries > max(self.compact_min, len(self._tasks) * 2):
+          snapshot = list(self._tasks.values())
+          self._journal_entries = 0
+        closed = self._closed
+      try:
+        if snapshot is not None:
+          self._compact(snapshot)
+        elif lines:
+          self._write(lines)
+      except Exception as e:
+        logger.error(f"视频任务日志写入失败: {str(e)}")
+      with self._lock:
+        self._seq_flushed = seq
+        self._flushed.notify_all()
+      if closed:
+        return
+
+  def _write(self, lines: list[str]):
+    data = "".join(lines)
+    self._journal.write(data)
+    self._journal.flush()
+    os.fsync(self._journal.fileno())
+    self.stats["flushes"] += 1
+    self.stats["bytes_written"] += len(data.encode("utf-8"))
+
+  def _compact(self, snapshot: list[VideoTask]):
+    """快照已包含缓冲区中的所有写入，写完快照后直接清空日志"""
+    tmp_path = self.snapshot_path.with_name(self.snapshot_path.name + ".tmp")
+    data = json.dumps([task.to_dict(include_private=True) for task in snapshot], ensure_ascii=False)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, self.snapshot_path)
+    self._journal.close()
+    self._journal = open(self.path, "w", encoding="utf-8")
+    self.stats["compactions"] += 1
+    self.stats["bytes_written"] += len(data.encode("utf-8"))
+    logger.debug(f"视频任务日志已压缩: {len(snapshot)} 个任务")
+
+  def save(self, task: VideoTask):
+    line = json.dumps(task.to_dict(include_private=True), ensure_ascii=False) + "\n"
+    task = task.copy()
+    with self._lock:
+      self._apply(task)
+      self._buffer.append(line)
+      self._seq_buffered += 1
+      self.stats["writes"] += 1
+      self.stats["bytes_logical"] += len(line.encode("utf-8"))
+
+  def save_many(self, tasks: list[VideoTask]):
+    for task in tasks:
+      self.save(task)
+
+  def flush(self):
+    """立即落盘并等待此前的所有写入完成"""
+    with self._lock:
+      target = self._seq_buffered
+      while self._seq_flushed < target and self._flusher.is_alive():
+        self._flushed.notify_all()
+        self._flushed.wait(self.flush_interval)
+
+  def close(self):
+    with self._lock:
+      self._closed = True
+      self._flushed.notify_all()
+    self._flusher.join()
+    self._journal.close()
+
+  def get(self, conversation_id: str, message_id: str) -> VideoTask | None:
+    task = self._tasks.get(self._key(conversation_id, message_id))
+    return task.copy() if task else None
+
+  def get_many(self, keys: list[tuple[str, str]]) -> list[VideoTask]:
+    with self._lock:
+      return [task.copy() for cid, mid in keys if (task := self._tasks.get(self._key(cid, mid)))]
+
+  def by_conversation(self, conversation_id: str) -> list[VideoTask]:
+    with self._lock:
+      return [self._tasks[key].copy() for key in self._by_conversation.get(conversation_id, {})]
+
+  def by_status(self, statuses: tuple[str, ...]) -> list[VideoTask]:
+    with self._lock:
+      return [self._tasks[key].copy() for status in statuses for key in self._by_status.get(status, {})]
+
+  def all(self) -> list[VideoTask]:
+    with self._lock:
+      return [task.copy() for task in self._tasks.values()]
+
+  def expiring(self, after: float, before: float, limit: int, after_key: Optional[tuple] = None) -> list[VideoTask]:
+    with self._lock:
+      tasks = sorted((_expiry_key(self._tasks[key]), key) for key, e in self._expires.items() if after <= e < before)
+      if after_key is not None:
+        tasks = [item for item in tasks if item[0] > tuple(after_key)]
+      return [self._tasks[key].copy() for _, key in tasks[:limit]]
+
+  def completion_samples(self, limit: int) -> list[tuple]:
+    """状态索引按最后保存顺序排列，从末尾取最近完成的任务"""
+    with self._lock:
+      keys = itertools.islice(reversed(self._by_status.get("completed", {})), limit)
+      return [_completion_sample(self._tasks[key]) for key in keys]
+
+  def query(self, statuses, conversation_id, created_after, created_before, after, limit) -> list[tuple[tuple, VideoTask]]:
+    match = _query_filter(statuses, conversation_id)
+    rows = []
+    with self._lock:
+      if conversation_id is not None:
+        # 单个会话的任务很少，按会话索引取出后排序
+        keys = sorted(self._sort_key(self._tasks[key]) for key in self._by_conversation.get(conversation_id, {}))
+        start = 0
+      else:
+        keys = self._order
+        start = bisect.bisect_left(keys, (created_after,)) if created_after is not None else 0
+      if after is not None:
+        start = max(start, bisect.bisect_right(keys, after))
+      for i in range(start, len(keys)):
+        if limit is not None and len(rows) >= limit:
+          break
+        key = keys[i]
+        if created_before is not None and key[0] >= created_before:
+          break
+        if created_after is not None and key[0] < created_after:
+          continue
+        task = self._tasks[self._key(key[1], key[2])]
+        if match(task):
+          rows.append((key, task.copy()))
+    return rows
+
+
+_backend = None
+_backend_lock = threading.Lock()
+# 存储版本号，每次保存任务加一，列表接口据此生成 ETag；
+# 前缀为进程启动时间，重启后的版本号不会与重启前的相同
+_version = 0
+_version_epoch = f"{time.time_ns():x}"
+_version_lock = threading.Lock()
+# 存储线程：单线程与后端的单连接一致，异步调用按提交顺序执行
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+  global _executor
+  if _executor is None:
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="video-storage")
+  return _executor
+
+
+async def _run(func, *args, **kwargs):
+  """在存储线程中执行存储操作"""
+  return await asyncio.get_running_loop().run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _get_backend():
+  global _backend
+  if _backend is None:
+    with _backend_lock:
+      if _backend is None:
+        if VIDEO_STORAGE_BACKEND == "json":
+          _backend = _JsonBackend(VIDEO_STORAGE_FILE)
+        elif VIDEO_STORAGE_BACKEND == "journal":
+          is_new = not VIDEO_STORAGE_JOURNAL.exists() and not VIDEO_STORAGE_JOURNAL.with_name(VIDEO_STORAGE_JOURNAL.name + ".snapshot").exists()
+          backend = _JournalBackend(VIDEO_STORAGE_JOURNAL)
+          if is_new and VIDEO_STORAGE_FILE.exists():
+            backend.save_many(_JsonBackend(VIDEO_STORAGE_FILE).all())
+            logger.info(f"已从 {VIDEO_STORAGE_FILE} 导入视频任务到 {VIDEO_STORAGE_JOURNAL}")
+          _backend = backend
+        else:
+          backend = _SqliteBackend(VIDEO_STORAGE_DB)
+          backend.import_json(VIDEO_STORAGE_FILE)
+          _backend = backend
+  return _backend
+
+
+class VideoStorage:
+  """视频链接存储管理器"""
+
+  @staticmethod
+  def close():
+    """关闭存储后端，journal 后端会先把缓冲区写入磁盘"""
+    global _backend, _executor
+    # 等待存储线程中已提交的操作完成
+    if _executor is not None:
+      _executor.shutdown(wait=True)
+      _executor = None
+    with _backend_lock:
+      if _backend is not None and hasattr(_backend, "close"):
+        _backend.close()
+      _backend = None
+
+  @staticmethod
+  def save_task(task: VideoTask, change: Optional[str] = None):
+    """保存任务，change 为状态变化类型（created/processing/retry/completed/failed）时记录到变更流"""
+    global _version
+    task.updated_at = time.time()
+    if task.status == "completed" and task.completed_at is None:
+      task.completed_at = task.updated_at
+    _get_backend().save(task)
+    with _version_lock:
+      _version += 1
+    if change:
+      try:
+        change_feed.append(task, change)
+      except Exception as e:
+        logger.error(f"任务变更记录失败: {task.conversation_id}/{task.message_id} {change} - {str(e)}")
+    task_events.publish_task(task)
+
+  @staticmethod
+  def version() -> str:
+    """存储版本，任意任务保存后改变"""
+    return f"{_version_epoch}-{_version}"
 
   @staticmethod
   def get_task(conversation_id: str, message_id: str) -> Optional[VideoTask]:
     """获取任务"""
-    storage = VideoStorage._load_storage()
-    key = f"{conversation_id}_{message_id}"
-    data = storage.get(key)
-    if data:
-      return VideoTask.from_dict(data)
-    return None
+    return _get_backend().get(conversation_id, message_id)
+
+  @staticmethod
+  def get_tasks(keys: list[tuple[str, str]]) -> dict[tuple[str, str], VideoTask]:
+    """批量获取任务，返回 {(conversation_id, message_id): 任务}，不存在的任务不在结果中"""
+    return {(task.conversation_id, task.message_id): task for task in _get_backend().get_many(list(dict.fromkeys(keys)))}
 
   @staticmethod
   def get_tasks_by_conversation(conversation_id: str) -> list[VideoTask]:
     """根据 conversation_id 获取所有相关任务"""
-    storage = VideoStorage._load_storage()
-    tasks = []
-    for data in storage.values():
-      if data.get("conversation_id") == conversation_id:
-        tasks.append(VideoTask.from_dict(data))
-    return tasks
+    return _get_backend().by_conversation(conversation_id)
+
+  @staticmethod
+  def get_tasks_by_status(*statuses: str) -> list[VideoTask]:
+    """获取指定状态的任务"""
+    return _get_backend().by_status(statuses)
 
   @staticmethod
   def get_all_tasks() -> list[VideoTask]:
     """获取所有任务"""
-    storage = VideoStorage._load_storage()
-    return [VideoTask.from_dict(data) for data in storage.values()]
+    return _get_backend().all()
 
+  @staticmethod
+  def get_expiring_tasks(after: float, before: float, limit: int = 100, after_key: Optional[tuple] = None) -> list[VideoTask]:
+    """
+    视频链接过期时间在 [after, before)（时间戳）内的已完成任务，按 (过期时间, conversation_id, message_id) 排序
+    after_key 为上一页最后一个任务的排序键，用于分页
+    """
+    return _get_backend().expiring(after, before, limit, after_key)
 
-async def fetch_video_task(conversation_id: str, message_id: str, timeout: int = 25000):
-  """
-  后台任务：定时获取视频链接
-  - 每隔3分钟重试一次
-  - 最多重试10次
-  - 获取成功后停止
-  """
-  task = VideoStorage.get_task(conversation_id, message_id)
-  if not task:
-    task = VideoTask(conversation_id, message_id)
-    VideoStorage.save_task(task)
+  @staticmethod
+  def get_completion_samples(limit: int) -> list[tuple]:
+    """
+    最近完成（按最后保存时间）的 limit 个任务的耗时样本，用于拟合探测策略
+    返回 (content_type, prompt_kind, created_at, completed_at, last_miss_at) 元组，时间为时间戳
+    """
+    return _get_backend().completion_samples(limit)
 
-  # 等待3分钟后开始第一次尝试
-  await asyncio.sleep(180)
+  @staticmethod
+  def query_tasks(
+    statuses: tuple[str, ...] = (),
+    conversation_id: Optional[str] = None,
+    created_after: Optional[float] = None,
+    created_before: Optional[float] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None
+  ) -> tuple[list[VideoTask], Optional[str]]:
+    """
+    按条件分页查询任务，按创建时间排序
+    created_after 包含、created_before 不包含；返回 (任务列表, 下一页游标)，没有下一页时游标为 None
+    游标格式错误时抛出 ValueError
+    """
+    after = decode_cursor(cursor) if cursor else None
+    rows = _get_backend().query(tuple(statuses), conversation_id, created_after, created_before, after, None if limit is None else limit + 1)
+    if limit is None or len(rows) <= limit:
+      return [task for _, task in rows], None
+    rows = rows[:limit]
+    return [task for _, task in rows], encode_cursor(rows[-1][0])
 
-  while task.retry_count < task.max_retries:
-    try:
-      task.status = "processing"
-      task.retry_count += 1
-      VideoStorage.save_task(task)
-
-      # 调用获取视频链接的API
-      result = await get_video_url(conversation_id, message_id, timeout)
-
-      if result["success"] and result["video_urls"]:
-        # 成功获取到视频链接
-        task.status = "completed"
-        task.video_urls = result["video_urls"]
-        task.error = None
-        VideoStorage.save_task(task)
-        print(f"✅ 视频任务完成: {conversation_id} - 获取到 {len(task.video_urls)} 个视频")
-        break
-      else:
-        # 未获取到视频，继续重试
-        task.error = result.get("error", "未获取到视频")
-        VideoStorage.save_task(task)
-        print(f"⏳ 视频任务重试 {task.retry_count}/{task.max_retries}: {conversation_id}")
-
-    except Exception as e:
-      task.error = str(e)
-      VideoStorage.save_task(task)
-      print(f"❌ 视频任务出错 (重试 {task.retry_count}/{task.max_retries}): {str(e)}")
-
-    # 如果还没达到最大重试次数，等待3分钟后继续
-    if task.retry_count < task.max_retries:
-      await asyncio.sleep(180)
-
-  # 所有重试都失败
-  if task.status != "completed":
-    task.status = "failed"
-    VideoStorage.save_task(task)
-    print(f"❌ 视频任务失败: {conversation_id} - 已达到最大重试次数")
-
-
-def start_video_fetch_task(conversation_id: str, message_id: str, timeout: int = 25000):
-  """启动视频获取后台任务"""
-  asyncio.create_task(fetch_video_task(conversation_id, message_id, timeout))
-  print(f"🎬 启动视频获取任务: {conversation_id} (将在3分钟后开始)")
+  # 异步接口：在存储线程中执行，供事件循环中的调用方使用
+
+  @staticmethod
+  async def save_task_async(task: VideoTask, change: Optional[str] = None):
+    await _run(VideoStorage.save_task, task, change)
+
+  @staticmethod
+  async def get_task_async(conversation_id: str, message_id: str) -> Optional[VideoTask]:
+    return await _run(VideoStorage.get_task, conversation_id, message_id)
+
+  @staticmethod
+  async def get_tasks_async(keys: list[tuple[str, str]]) -> dict[tuple[str, str], VideoTask]:
+    return await _run(VideoStorage.get_tasks, keys)
+
+  @staticmethod
+  async def get_tasks_by_conversation_async(conversation_id: str) -> list[VideoTask]:
+    return await _run(VideoStorage.get_tasks_by_conversation, conversation_id)
+
+  @staticmethod
+  async def get_tasks_by_status_async(*statuses: str) -> list[VideoTask]:
+    return await _run(VideoStorage.get_tasks_by_status, *statuses)
+
+  @staticmethod
+  async def get_expiring_tasks_async(after: float, before: float, limit: int = 100, after_key: Optional[tuple] = None) -> list[VideoTask]:
+    return await _run(VideoStorage.get_expiring_tasks, after, before, limit, after_key)
+
+  @staticmethod
+  async def get_completion_samples_async(limit: int) -> list[tuple]:
+    return await _run(VideoStorage.get_completion_samples, limit)
+
+  @staticmethod
+  async def query_tasks_async(**kwargs) -> tuple[list[VideoTask], Optional[str]]:
+    return await _run(VideoStorage.query_tasks, **kwargs)
+
+  @staticmethod
+  def iter_tasks(page_size: int = 500, limit: Optional[int] = None, cursor: Optional[str] = None, **filters):
+    """按页迭代查询结果，内存中最多保留一页任务（同步生成器，由 StreamingResponse 在线程池中迭代）"""
+    while limit is None or limit > 0:
+      size = page_size if limit is None else min(page_size, limit)
+      tasks, cursor = VideoStorage.query_tasks(cursor=cursor, limit=size, **filters)
+      yield from tasks
+      if limit is not None:
+        limit -= len(tasks)
+      if cursor is None:
+        return
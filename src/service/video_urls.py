@@ -0,0 +1,241 @@
+"""
+视频链接工具函数
+同一视频常被捕获到多个版本（不同 CDN 节点、码率、水印参数），按视频去重后只保留最好的版本：
+- 视频标识：douyinvod 链接取签名和过期时间之后的对象路径（与 CDN 节点无关），其他链接取域名和路径，
+  加上 VIDEO_ASSET_QUERY_KEYS 中的查询参数
+- 版本排序：无水印优先，其次码率（br / bt）高的，最后过期时间晚的
+"""
+import json
+import re
+from urllib.parse import urlsplit, parse_qs
+
+
+# 视频生成消息中的任务标识字段
+VIDEO_JOB_ID_KEYS = ('task_id', 'job_id', 'gen_id', 'creation_id', 'video_id', 'vid', 'item_id')
+# 视频生成消息中的任务状态字段
+VIDEO_JOB_STATUS_KEYS = ('status', 'gen_status', 'task_status', 'progress', 'queue_position', 'fail_reason', 'error_code')
+# 带过期时间的查询参数（时间戳）
+EXPIRY_QUERY_KEYS = ('x-expires', 'expires')
+# 路径相同时用于区分不同视频的查询参数（其余查询参数只区分同一视频的不同版本）
+VIDEO_ASSET_QUERY_KEYS = ('vid', 'video_id', 'item_id', 'file_id', 'id')
+# 码率查询参数（kbps）
+BITRATE_QUERY_KEYS = ('br', 'bt')
+# 表示无水印的 lr 参数取值
+UNWATERMARKED_VALUES = ('unwatermarked', 'no_watermark', 'nowatermark')
+
+_HEX_SIGNATURE = re.compile(r'[0-9a-f]{32}')
+_HEX_EXPIRY = re.compile(r'[0-9a-f]{8}')
+
+
+def is_video_url(url: str) -> bool:
+  """只保留真正的视频播放链接，排除 API 端点"""
+  if not url.startswith('http') or 'get_play_info' in url:
+    return False
+  return any(ext in url for ext in ['.mp4', '.webm', '.m3u8', 'douyinvod'])
+
+
+def _split_signed_path(path: str) -> tuple[str, str] | None:
+  """douyinvod 链接路径拆分为 (过期时间, 签名之后的对象路径)，不是该格式时返回 None"""
+  segments = path.strip('/').split('/')
+  for i, (signature, expiry) in enumerate(zip(segments, segments[1:])):
+    if _HEX_SIGNATURE.fullmatch(signature) and _HEX_EXPIRY.fullmatch(expiry):
+      return expiry, '/'.join(segments[i + 2:])
+  return None
+
+
+def url_expires_at(url: str) -> float | None:
+  """
+  解析视频链接的过期时间（时间戳），解析不到时返回 None
+  douyinvod 链接的路径为 /<32 位十六进制签名>/<8 位十六进制过期时间>/video/...，
+  其他 CDN 链接可能用 x-expires 查询参数
+  """
+  try:
+    parts = urlsplit(url)
+  except ValueError:
+    return None
+  if signed := _split_signed_path(parts.path):
+    return float(int(signed[0], 16))
+  query = parse_qs(parts.query)
+  for key in EXPIRY_QUERY_KEYS:
+    if (value := query.get(key)) and value[0].isdigit():
+      return float(value[0])
+  return None
+
+
+def video_urls_expire_at(urls) -> float | None:
+  """一组视频链接中最早的过期时间"""
+  expiries = [e for url in urls if (e := url_expires_at(url)) is not None]
+  return min(expiries) if expiries else None
+
+
+def video_asset_key(url: str) -> str:
+  """视频标识，同一视频的不同版本（CDN 节点、码率、水印）标识相同"""
+  try:
+    parts = urlsplit(url)
+  except ValueError:
+    return url
+  if signed := _split_signed_path(parts.path):
+    key = signed[1]
+  else:
+    key = parts.netloc.lower() + parts.path
+  query = parse_qs(parts.query)
+  ids = '&'.join(f'{k}={query[k][0]}' for k in VIDEO_ASSET_QUERY_KEYS if k in query)
+  return f'{key}?{ids}' if ids else key
+
+
+def _watermark_rank(query: dict) -> int:
+  """2: 无水印，1: 未知，0: 有水印"""
+  if (flag := query.get('watermark')) and flag[0] in ('0', '1'):
+    return 2 if flag[0] == '0' else 0
+  lr = query.get('lr', [''])[0].lower()
+  if lr in UNWATERMARKED_VALUES:
+    return 2
+  return 0 if 'watermark' in lr else 1
+
+
+def variant_rank(url: str) -> tuple:
+  """同一视频不同版本的排序键，越大越好"""
+  try:
+    query = parse_qs(urlsplit(url).query)
+  except ValueError:
+    return (0, 0, 0.0)
+  bitrate = max((int(v[0]) for k in BITRATE_QUERY_KEYS if (v := query.get(k)) and v[0].isdigit()), default=0)
+  return (_watermark_rank(query), bitrate, url_expires_at(url) or 0.0)
+
+
+class VideoUrlSet:
+  """按视频去重的链接集合，每个视频只保留最好的版本，按视频首次出现的顺序排列"""
+
+  def __init__(self, urls=()):
+    # 视频标识 -> (版本排序键, 链接)
+    self._best: dict[str, tuple[tuple, str]] = {}
+    for url in urls:
+      self.add(url)
+
+  def add(self, url: str) -> bool:
+    """加入链接，是新视频或比已有版本更好时返回 True"""
+    key = video_asset_key(url)
+    rank = variant_rank(url)
+    current = self._best.get(key)
+    if current is not None and current[0] >= rank:
+      return False
+    self._best[key] = (rank, url)
+    return True
+
+  def __len__(self) -> int:
+    return len(self._best)
+
+  def __iter__(self):
+    return (url for _, url in self._best.values())
+
+
+def select_video_urls(urls) -> list[str]:
+  """链接按视频去重，每个视频返回最好的版本"""
+  return list(VideoUrlSet(urls))
+
+
+def extract_message_video_urls(data, message_ids) -> dict[str, list[str]]:
+  """
+  从一次拉取的会话消息数据中分别提取多条消息的视频链接
+  只返回能找到对应消息且解析到视频的 message_id，不回退到整个会话
+  """
+  result = {}
+  for message_id in message_ids:
+    nodes = []
+    _find_messages(data, message_id, nodes)
+    if nodes and (urls := extract_video_urls(nodes)):
+      result[message_id] = urls
+  return result
+
+
+def _walk(node, urls: VideoUrlSet):
+  """递归遍历 JSON，消息内容是嵌套的 JSON 字符串时继续解析"""
+  if isinstance(node, dict):
+    for value in node.values():
+      _walk(value, urls)
+  elif isinstance(node, list):
+    for value in node:
+      _walk(value, urls)
+  elif isinstance(node, str):
+    text = node.strip()
+    if text[:1] in ('{', '['):
+      try:
+        _walk(json.loads(text), urls)
+      except ValueError:
+        pass
+    elif is_video_url(text):
+      urls.add(text)
+
+
+def _find_messages(node, message_id: str, found: list):
+  """查找 message_id 匹配的消息节点"""
+  if isinstance(node, dict):
+    if str(node.get("message_id", "")) == message_id:
+      found.append(node)
+      return
+    for value in node.values():
+      _find_messages(value, message_id, found)
+  elif isinstance(node, list):
+    for value in node:
+      _find_messages(value, message_id, found)
+
+
+def extract_video_urls(data, message_id: str | None = None) -> list[str]:
+  """
+  从消息数据中提取视频播放链接
+  指定 message_id 时只解析该消息，找不到该消息时返回空列表（不回退到整个会话，避免取到其他消息的视频）
+  """
+  if message_id:
+    nodes = []
+    _find_messages(data, message_id, nodes)
+    if not nodes:
+      return []
+    data = nodes
+  urls = VideoUrlSet()
+  _walk(data, urls)
+  return list(urls)
+
+
+def _walk_fields(node, keys: tuple, fields: dict):
+  """递归遍历 JSON，记录每个字段第一次出现的标量值"""
+  if isinstance(node, dict):
+    for key, value in node.items():
+      if key in keys and key not in fields and isinstance(value, (str, int, float, bool)):
+        fields[key] = value
+      else:
+        _walk_fields(value, keys, fields)
+  elif isinstance(node, list):
+    for value in node:
+      _walk_fields(value, keys, fields)
+  elif isinstance(node, str):
+    text = node.strip()
+    if text[:1] in ('{', '['):
+      try:
+        _walk_fields(json.loads(text), keys, fields)
+      except ValueError:
+        pass
+
+
+def extract_video_job(data, message_id: str | None = None) -> dict:
+  """
+  从视频生成消息（content_type=2020）中提取任务标识和状态字段
+  返回扁平字典，解析到视频链接时附带 video_urls
+  指定 message_id 时字段和链接都只从该消息中解析，找不到该消息时返回空字典
+  """
+  if message_id:
+    nodes = []
+    _find_messages(data, message_id, nodes)
+    if not nodes:
+      return {}
+    data = nodes
+  job: dict = {}
+  _walk_fields(data, VIDEO_JOB_ID_KEYS + VIDEO_JOB_STATUS_KEYS, job)
+  if urls := extract_video_urls(data):
+    job['video_urls'] = urls
+  return job
+
+
+__all__ = [
+  'is_video_url', 'extract_video_urls', 'extract_video_job', 'extract_message_video_urls',
+  'url_expires_at', 'video_urls_expire_at', 'video_asset_key', 'variant_rank', 'VideoUrlSet', 'select_video_urls'
+]
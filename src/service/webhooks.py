@@ -0,0 +1,308 @@
+"""
+视频任务回调（webhook）
+任务完成或失败时向生成请求中的 callback_url POST 任务数据：
+- 请求体用 WEBHOOK_SECRET 做 HMAC-SHA256 签名，签名内容为 "{时间戳}.{请求体}"，
+  通过 X-Webhook-Timestamp、X-Webhook-Signature 请求头发送
+- 待投递的回调保存在 SQLite 队列中，服务重启后继续投递
+- 投递失败（非 2xx 或网络错误）后按指数退避重试，超过最大次数后标记为 dead
+- 限制同时进行的投递数量
+- callback_url 解析到内网、回环、链路本地等非公网地址时拒绝（WEBHOOK_ALLOWED_HOSTS 中的主机除外），
+  提交任务和每次投递前都会检查，投递时直接连接检查过的 IP
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+import httpx
+from loguru import logger
+from src.service.url_guard import parse_allowed_hosts, resolve_public_url, build_pinned_request
+
+
+# 签名密钥，为空时不签名
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# 投递队列数据库路径
+WEBHOOK_QUEUE_DB = Path(os.getenv("WEBHOOK_QUEUE_DB", "webhooks.db"))
+# 同时进行的投递数量上限
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "4"))
+# 最大投递次数（含首次）
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+# 重试退避基数（秒），第 n 次失败后等待 base * 2^(n-1)，上限 WEBHOOK_RETRY_MAX
+WEBHOOK_RETRY_BASE = float(os.getenv("WEBHOOK_RETRY_BASE", "5"))
+WEBHOOK_RETRY_MAX = float(os.getenv("WEBHOOK_RETRY_MAX", "3600"))
+# 单次投递超时（秒）
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+# 投递中的记录在该时间（秒）后视为中断，重新投递（进程在投递过程中退出时）
+WEBHOOK_LEASE = WEBHOOK_TIMEOUT + 30
+# 允许解析到非公网地址的回调主机（逗号分隔），用于回调到内网服务或本地测试
+WEBHOOK_ALLOWED_HOSTS = parse_allowed_hosts(os.getenv("WEBHOOK_ALLOWED_HOSTS", ""))
+
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+  """计算回调签名"""
+  message = timestamp.encode() + b"." + body
+  return "sha256=" + hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret: str, timestamp: str, body: bytes, signature: str, tolerance: int = 300) -> bool:
+  """校验回调签名，时间戳与当前时间相差超过 tolerance 秒时视为重放"""
+  try:
+    if abs(time.time() - int(timestamp)) > tolerance:
+      return False
+  except ValueError:
+    return False
+  return hmac.compare_digest(sign(secret, timestamp, body), signature)
+
+
+async def validate_callback_url(url: str, allowed_hosts: frozenset = WEBHOOK_ALLOWED_HOSTS):
+  """
+  检查回调地址，不可用时抛出 ValueError，域名解析失败时抛出 OSError
+  主机解析到的任一地址不是公网地址时拒绝（防止通过回调访问内网服务）
+  """
+  await resolve_public_url(url, allowed_hosts)
+
+
+def retry_delay(attempts: int) -> float:
+  """第 attempts 次投递失败后的等待时间，加 ±20% 抖动避免大量回调同时重试"""
+  delay = min(WEBHOOK_RETRY_BASE * 2 ** (attempts - 1), WEBHOOK_RETRY_MAX)
+  return delay * random.uniform(0.8, 1.2)
+
+
+class _DeliveryQueue:
+  """SQLite 投递队列，单连接 + 锁"""
+
+  def __init__(self, path: Path):
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._conn.execute("PRAGMA journal_mode=WAL")
+    self._conn.execute("PRAGMA synchronous=NORMAL")
+    self._conn.executescript("""
+      CREATE TABLE IF NOT EXISTS webhook_deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at REAL NOT NULL
+      );
+      CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_due ON webhook_deliveries (status, next_attempt_at);
+    """)
+
+  def add(self, url: str, payload: str) -> int:
+    now = time.time()
+    with self._lock:
+      cursor = self._conn.execute(
+        "INSERT INTO webhook_deliveries (url, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+        (url, payload, now, now)
+      )
+      return cursor.lastrowid
+
+  def claim(self, now: float) -> tuple | None:
+    """
+    取出一条到期的记录，延后其到期时间（租约）并计入一次投递，返回 (id, url, payload, attempts)
+    投递结果未能写回时（进程退出、写入失败），租约到期后重新投递且已计入次数
+    """
+    with self._lock:
+      while True:
+        row = self._conn.execute(
+          "SELECT id, url, payload, attempts FROM webhook_deliveries WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+          (now,)
+        ).fetchone()
+        if row is None:
+          return None
+        delivery_id, url, payload, attempts = row
+        if attempts < WEBHOOK_MAX_ATTEMPTS:
+          break
+        # 中断的投递已用完次数
+        self._conn.execute(
+          "UPDATE webhook_deliveries SET status = 'dead', last_error = COALESCE(last_error, '投递中断') WHERE id = ?",
+          (delivery_id,)
+        )
+      self._conn.execute(
+        "UPDATE webhook_deliveries SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+        (attempts + 1, now + WEBHOOK_LEASE, delivery_id)
+      )
+      return delivery_id, url, payload, attempts + 1
+
+  def next_due(self) -> float | None:
+    with self._lock:
+      row = self._conn.execute("SELECT MIN(next_attempt_at) FROM webhook_deliveries WHERE status = 'pending'").fetchone()
+    return row[0]
+
+  def delivered(self, delivery_id: int):
+    with self._lock:
+      self._conn.execute("DELETE FROM webhook_deliveries WHERE id = ?", (delivery_id,))
+
+  def failed(self, delivery_id: int, attempts: int, error: str, next_attempt_at: float | None):
+    """记录失败，next_attempt_at 为空时标记为 dead"""
+    with self._lock:
+      if next_attempt_at is None:
+        self._conn.execute(
+          "UPDATE webhook_deliveries SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+          (attempts, error, delivery_id)
+        )
+      else:
+        self._conn.execute(
+          "UPDATE webhook_deliveries SET attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+          (attempts, error, next_attempt_at, delivery_id)
+        )
+
+  def counts(self) -> dict:
+    with self._lock:
+      return dict(self._conn.execute("SELECT status, COUNT(*) FROM webhook_deliveries GROUP BY status").fetchall())
+
+  def close(self):
+    with self._lock:
+      self._conn.close()
+
+
+class WebhookDispatcher:
+  """回调投递器"""
+
+  def __init__(self, path: Path = WEBHOOK_QUEUE_DB, concurrency: int = WEBHOOK_CONCURRENCY, secret: str = WEBHOOK_SECRET):
+    self.path = path
+    self.concurrency = concurrency
+    self.secret = secret
+    self._queue: _DeliveryQueue | None = None
+    self._client: httpx.AsyncClient | None = None
+    self._semaphore = asyncio.Semaphore(concurrency)
+    self._wakeup = asyncio.Event()
+    self._runner: asyncio.Task | None = None
+    self._deliveries: set[asyncio.Task] = set()
+    self._counters = {
+      "enqueued": 0,
+      "delivered": 0,
+      "retried": 0,
+      "dead": 0,
+    }
+
+  def _get_queue(self) -> _DeliveryQueue:
+    if self._queue is None:
+      self._queue = _DeliveryQueue(self.path)
+    return self._queue
+
+  def start(self):
+    """启动投递循环（已启动时直接返回），队列中未投递的回调会继续投递"""
+    if self._runner is None or self._runner.done():
+      self._runner = asyncio.create_task(self._run())
+
+  async def stop(self):
+    """停止投递，未完成的回调保留在队列中"""
+    if self._runner:
+      self._runner.cancel()
+      self._runner = None
+    for delivery in self._deliveries:
+      delivery.cancel()
+    await asyncio.gather(*self._deliveries, return_exceptions=True)
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+    if self._queue is not None:
+      self._queue.close()
+      self._queue = None
+
+  async def enqueue(self, task) -> bool:
+    """任务有 callback_url 时加入投递队列（写入在线程中执行），返回是否已加入"""
+    if not task.callback_url:
+      return False
+    payload = json.dumps({"event": task.status, "task": task.to_dict()}, ensure_ascii=False)
+    await asyncio.to_thread(self._get_queue().add, task.callback_url, payload)
+    self._counters["enqueued"] += 1
+    self._wakeup.set()
+    self.start()
+    return True
+
+  async def _run(self):
+    queue = self._get_queue()
+    while True:
+      self._wakeup.clear()
+      try:
+        # 只在有空闲投递名额时取出记录，避免租约在排队期间过期
+        while len(self._deliveries) < self.concurrency:
+          row = await asyncio.to_thread(queue.claim, time.time())
+          if row is None:
+            break
+          delivery = asyncio.create_task(self._deliver(*row))
+          self._deliveries.add(delivery)
+          delivery.add_done_callback(self._delivery_done)
+        if len(self._deliveries) >= self.concurrency:
+          # 名额已满，等待投递完成
+          timeout = None
+        else:
+          next_due = await asyncio.to_thread(queue.next_due)
+          timeout = max(0.0, next_due - time.time()) if next_due is not None else None
+      except Exception as e:
+        # 队列读取失败时稍后重试，不退出投递循环
+        logger.error(f"回调队列读取失败: {type(e).__name__}: {str(e)}")
+        timeout = WEBHOOK_RETRY_BASE
+      try:
+        await asyncio.wait_for(self._wakeup.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+  def _delivery_done(self, delivery: asyncio.Task):
+    self._deliveries.discard(delivery)
+    self._wakeup.set()
+
+  async def _deliver(self, delivery_id: int, url: str, payload: str, attempts: int):
+    # 在投递任务内获取名额，任务开始前被取消时不会占用名额
+    async with self._semaphore:
+      body = payload.encode("utf-8")
+      timestamp = str(int(time.time()))
+      headers = {"Content-Type": "application/json", "X-Webhook-Timestamp": timestamp, "X-Webhook-Id": str(delivery_id)}
+      if self.secret:
+        headers["X-Webhook-Signature"] = sign(self.secret, timestamp, body)
+      if self._client is None:
+        self._client = httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT)
+      rejected = False
+      try:
+        # 每次投递前重新检查并直接连接检查过的 IP，避免域名解析结果在检查后变化
+        request = await build_pinned_request(self._client, "POST", url, WEBHOOK_ALLOWED_HOSTS, content=body, headers=headers)
+        response = await self._client.send(request)
+        error = None if response.is_success else f"HTTP {response.status_code}"
+      except ValueError as e:
+        error, rejected = f"回调地址不可用: {str(e)}", True
+      except Exception as e:
+        error = f"{type(e).__name__}: {str(e)}"
+      try:
+        await self._record(delivery_id, url, attempts, error, rejected)
+      except Exception as e:
+        # 写回失败时保留租约，到期后重新投递（本次已计入次数）
+        logger.error(f"回调投递结果写入失败: {url} - {type(e).__name__}: {str(e)}")
+
+  async def _record(self, delivery_id: int, url: str, attempts: int, error: str | None, rejected: bool):
+    if error is None:
+      await asyncio.to_thread(self._queue.delivered, delivery_id)
+      self._counters["delivered"] += 1
+      return
+    if rejected or attempts >= WEBHOOK_MAX_ATTEMPTS:
+      await asyncio.to_thread(self._queue.failed, delivery_id, attempts, error, None)
+      self._counters["dead"] += 1
+      logger.warning(f"回调投递失败，已放弃: {url} - {error}")
+      return
+    await asyncio.to_thread(self._queue.failed, delivery_id, attempts, error, time.time() + retry_delay(attempts))
+    self._counters["retried"] += 1
+    logger.info(f"回调投递失败，稍后重试 ({attempts}/{WEBHOOK_MAX_ATTEMPTS}): {url} - {error}")
+
+  def stats(self) -> dict:
+    """导出投递队列状态和指标"""
+    counts = self._get_queue().counts() if self._queue is not None or self.path.exists() else {}
+    return {
+      "running": bool(self._runner and not self._runner.done()),
+      "in_flight": len(self._deliveries),
+      "pending": counts.get("pending", 0),
+      "dead_letters": counts.get("dead", 0),
+      **self._counters,
+    }
+
+
+webhook_dispatcher = WebhookDispatcher()
+
+__all__ = ["WebhookDispatcher", "webhook_dispatcher", "sign", "verify_signature", "validate_callback_url"]
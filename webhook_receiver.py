@@ -0,0 +1,54 @@
+"""
+本地回调接收端，用于测试视频任务回调
+校验签名并打印收到的任务数据，可以模拟失败来测试重试
+
+用法:
+  python webhook_receiver.py [端口，默认 9000] [前 N 次请求返回 500，默认 0]
+  服务端设置相同的 WEBHOOK_SECRET 和 WEBHOOK_ALLOWED_HOSTS=localhost，生成视频时传入 "callback_url": "http://localhost:9000/"
+"""
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from src.service.webhooks import verify_signature
+
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 9000
+FAIL_FIRST = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+received = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+  def do_POST(self):
+    global received
+    received += 1
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    timestamp = self.headers.get("X-Webhook-Timestamp", "")
+    signature = self.headers.get("X-Webhook-Signature", "")
+    if SECRET and not verify_signature(SECRET, timestamp, body, signature):
+      print(f"❌ 签名校验失败: {self.headers.get('X-Webhook-Id')}")
+      self.send_response(401)
+      self.end_headers()
+      return
+    if received <= FAIL_FIRST:
+      print(f"⚠️  模拟失败 ({received}/{FAIL_FIRST}): {self.headers.get('X-Webhook-Id')}")
+      self.send_response(500)
+      self.end_headers()
+      return
+    payload = json.loads(body)
+    task = payload["task"]
+    print(f"✅ 收到回调 {self.headers.get('X-Webhook-Id')}: {payload['event']} {task['conversation_id']}/{task['message_id']}")
+    for url in task["video_urls"]:
+      print(f"   {url}")
+    self.send_response(204)
+    self.end_headers()
+
+  def log_message(self, format, *args):
+    pass
+
+
+if __name__ == "__main__":
+  print(f"回调接收端已启动: http://localhost:{PORT}/ (签名校验: {'开启' if SECRET else '关闭'})")
+  HTTPServer(("0.0.0.0", PORT), Handler).serve_forever()